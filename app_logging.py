@@ -0,0 +1,150 @@
+"""アプリのログ（JSON Lines・ローテーション付き・バックグラウンド書き出し）。
+
+リクエストを処理するスレッドはログをメモリ上のキューに積むだけで、ファイルへの書き込みは
+`QueueListener` のスレッドが行う。キューが満杯（`LOG_QUEUE_SIZE`）のときは捨てて数えるので、
+ディスクが遅くてもスクリプトの実行を止めない。
+
+1 行 1 JSON で、`ts` / `level` / `logger` / `event` に加えて `log_event()` に渡した
+キーワード引数がそのまま入る:
+
+    {"ts": "2026-01-01T12:00:00.123+00:00", "level": "INFO", "logger": "cocock.app",
+     "event": "turnstile_candidate_resolved", "source": "token_store", "resolve_ms": 12.3}
+
+設定は環境変数で行う。
+- `LOG_PATH`: 出力先（既定 `logs/app.jsonl`。`-` なら標準エラー）
+- `LOG_LEVEL`: DEBUG / INFO / WARNING / ERROR（既定 INFO。知らない名前なら INFO）
+- `LOG_ROTATION`: `size`（`LOG_MAX_BYTES` ごと、既定）または `time`（`LOG_ROTATE_WHEN` ごと、既定 midnight）
+- `LOG_BACKUP_COUNT`: 残す世代数（既定 5）
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from pathlib import Path
+from typing import Any, Optional
+
+from db import _env_int
+
+BASE_DIR = Path(__file__).resolve().parent
+DEFAULT_LOG_PATH = BASE_DIR / "logs" / "app.jsonl"
+ROOT_LOGGER = "cocock"
+
+# 標準の LogRecord 属性（これ以外は log_event の追加フィールドとして出力する）
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload: dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """キューが満杯なら待たずに捨てる（捨てた件数は `dropped`）。"""
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _build_file_handler(path: Path) -> logging.Handler:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    backups = _env_int("LOG_BACKUP_COUNT", 5)
+    if os.environ.get("LOG_ROTATION", "size").lower() == "time":
+        return TimedRotatingFileHandler(
+            path, when=os.environ.get("LOG_ROTATE_WHEN", "midnight"), backupCount=backups, encoding="utf-8", utc=True
+        )
+    return RotatingFileHandler(
+        path, maxBytes=_env_int("LOG_MAX_BYTES", 10 * 1024 * 1024), backupCount=backups, encoding="utf-8"
+    )
+
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[_DroppingQueueHandler] = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging() -> logging.Logger:
+    """`cocock` ロガーにキュー経由の JSON Lines 出力を取り付けて返す（2 回目以降は何もしない）。
+
+    Streamlit はスクリプトを rerun のたびに実行し直すが、このモジュールは 1 回だけ
+    読み込まれるので、ハンドラやリスナーのスレッドが増えることはない。
+    """
+    global _listener, _queue_handler
+    logger = logging.getLogger(ROOT_LOGGER)
+    if _listener is not None:
+        return logger
+    with _setup_lock:
+        if _listener is not None:
+            return logger
+        raw_path = os.environ.get("LOG_PATH", str(DEFAULT_LOG_PATH))
+        try:
+            target = logging.StreamHandler(sys.stderr) if raw_path == "-" else _build_file_handler(Path(raw_path))
+        except OSError:
+            # 書き込めない場所が指定されていてもアプリは止めない
+            target = logging.StreamHandler(sys.stderr)
+        target.setFormatter(JsonLinesFormatter())
+        _queue_handler = _DroppingQueueHandler(queue.Queue(maxsize=_env_int("LOG_QUEUE_SIZE", 10000)))
+        level = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").strip().upper())
+        # 知らないレベル名（getLevelName が "Level xxx" を返す）なら INFO にする
+        logger.setLevel(level if isinstance(level, int) else logging.INFO)
+        logger.addHandler(_queue_handler)
+        logger.propagate = False
+        _listener = QueueListener(_queue_handler.queue, target, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+        # プロセスの起動（= このモジュールの初回設定）を 1 回だけ記録する
+        log_event(logger, logging.INFO, "startup", pid=os.getpid(), path=raw_path)
+    return logger
+
+
+def shutdown_logging() -> None:
+    """キューに残っているログを書き出してリスナーを止める。"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+            if _queue_handler is not None:
+                logging.getLogger(ROOT_LOGGER).removeHandler(_queue_handler)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """`cocock.<name>` のロガー（出力先の設定は `setup_logging()` が行う）。"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def log_event(logger: logging.Logger, level: int, event: str, exc_info: bool = False, **fields: Any) -> None:
+    """`event` とキーワード引数を 1 行の JSON として記録する。`exc_info=True` なら例外も含める。"""
+    if logger.isEnabledFor(level):
+        # LogRecord の属性名（name / module など）と重なるキーは末尾に _ を付ける
+        extra = {(f"{k}_" if k in _RESERVED else k): v for k, v in fields.items()}
+        logger.log(level, event, exc_info=exc_info, extra=extra)
+
+
+def dropped_count() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
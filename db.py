@@ -1,14 +1,29 @@
-"""SQLite のマイグレーション適用ユーティリティ。
+"""SQLite のマイグレーション適用と接続管理のユーティリティ。
 
 アプリ起動時に `apply_migrations()` を呼び出すと、`migrations/` ディレクトリにある
 未適用の SQL ファイルを順番に実行して `receipts.db` に `dishes` テーブルなどを用意する。
+
+読み書きには `read_connection()` / `run_write()` を使う。どちらもプロセス全体で
+共有する `ConnectionManager` から接続を借りるため、Streamlit の rerun ごとに
+`sqlite3.connect()` と close を繰り返さずに済む。アプリからの書き込みは `run_write()` で
+専用の書き込みスレッドに渡し、まとめて 1 トランザクションで commit する。
 """
 
 from __future__ import annotations
 
+import argparse
+import hashlib
+import importlib.util
+import os
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 # ベースディレクトリ（このファイルと同じ場所）
 BASE_DIR = Path(__file__).resolve().parent
@@ -20,62 +35,768 @@ DB_PATH = BASE_DIR / "receipts.db"
 MIGRATIONS_DIR = BASE_DIR / "migrations"
 
 
+def _env_int(name: str, default: int) -> int:
+    """環境変数を整数として読む。未設定や不正値なら既定値を返す。"""
+    raw = os.environ.get(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    """環境変数を小数として読む。未設定や不正値なら既定値を返す。"""
+    raw = os.environ.get(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class SQLiteTuning:
+    """接続ごとに適用する PRAGMA の設定値。
+
+    `from_env()` で環境変数から上書きできる（未設定なら既定値）:
+    `SQLITE_SYNCHRONOUS`, `SQLITE_CACHE_SIZE`, `SQLITE_MMAP_SIZE`,
+    `SQLITE_BUSY_TIMEOUT_MS`, `SQLITE_READ_POOL_SIZE`, `SQLITE_WRITE_BATCH_MAX`。
+    """
+
+    journal_mode: str = "WAL"
+    # WAL と組み合わせる場合は NORMAL でもクラッシュ時に DB は壊れない
+    synchronous: str = "NORMAL"
+    # 負の値は KiB 単位（-16000 ≒ 16MB）
+    cache_size: int = -16000
+    mmap_size: int = 64 * 1024 * 1024
+    busy_timeout_ms: int = 5000
+    read_pool_size: int = 4
+    # 書き込みスレッドが 1 トランザクションにまとめる最大リクエスト数
+    write_batch_max: int = 64
+
+    @classmethod
+    def from_env(cls) -> "SQLiteTuning":
+        default = cls()
+        synchronous = os.environ.get("SQLITE_SYNCHRONOUS", default.synchronous).strip().upper()
+        if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            synchronous = default.synchronous
+        return cls(
+            synchronous=synchronous,
+            cache_size=_env_int("SQLITE_CACHE_SIZE", default.cache_size),
+            mmap_size=max(0, _env_int("SQLITE_MMAP_SIZE", default.mmap_size)),
+            busy_timeout_ms=max(0, _env_int("SQLITE_BUSY_TIMEOUT_MS", default.busy_timeout_ms)),
+            read_pool_size=max(1, _env_int("SQLITE_READ_POOL_SIZE", default.read_pool_size)),
+            write_batch_max=max(1, _env_int("SQLITE_WRITE_BATCH_MAX", default.write_batch_max)),
+        )
+
+
+class ConnectionManager:
+    """読み取り用の接続プールと、単一の書き込み用接続を管理する。
+
+    - 読み取り接続は `read_pool_size` 本まで作ってキューで使い回す（`query_only`）。
+    - 書き込み接続は 1 本だけで、ロックで直列化する。SQLite は同時に 1 つしか
+      書き込めないため、アプリ内で順番待ちさせて SQLITE_BUSY を避ける。
+    - `submit()` / `run_write()` は書き込みを専用スレッドのキューに積む。スレッドは
+      溜まったリクエストを 1 トランザクション（リクエストごとに SAVEPOINT）で実行し、
+      commit 後に結果を Future で返す。小さな書き込みが多数同時に来ても、commit
+      （fsync）は 1 回で済み、SQLITE_BUSY で失敗することもない。
+    - Streamlit のスクリプトスレッドをまたいで使うので `check_same_thread=False`。
+    """
+
+    def __init__(self, db_path: Path, tuning: Optional[SQLiteTuning] = None) -> None:
+        self.db_path = Path(db_path)
+        self.tuning = tuning or SQLiteTuning.from_env()
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.RLock()
+        self._closed = False
+        # apply_migrations() が「スキーマは最新」と確認したときのマイグレーション指紋
+        self.schema_fingerprint: Optional[str] = None
+        # このプロセスの書き込み接続が変更を commit するたびに増える
+        self.write_generation = 0
+        # PRAGMA data_version 監視用の接続（他接続・他プロセスの commit を検知する）
+        self._probe: Optional[sqlite3.Connection] = None
+        self._probe_lock = threading.Lock()
+        # 書き込みスレッドへのリクエストキュー（None は停止の合図）
+        self._write_queue: "queue.Queue[Optional[tuple[Callable[[sqlite3.Connection], Any], Future]]]" = queue.Queue()
+        self._write_thread: Optional[threading.Thread] = None
+        self._write_thread_lock = threading.Lock()
+
+    def _connect(self, *, readonly: bool) -> sqlite3.Connection:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.tuning.busy_timeout_ms / 1000,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        t = self.tuning
+        if not readonly:
+            # journal_mode は DB ファイルに保存されるので書き込み側で一度設定すれば良い
+            conn.execute(f"PRAGMA journal_mode={t.journal_mode}")
+        conn.execute(f"PRAGMA synchronous={t.synchronous}")
+        conn.execute(f"PRAGMA cache_size={int(t.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size={int(t.mmap_size)}")
+        conn.execute(f"PRAGMA busy_timeout={int(t.busy_timeout_ms)}")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _get_writer(self) -> sqlite3.Connection:
+        if self._writer is None:
+            self._writer = self._connect(readonly=False)
+        return self._writer
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """読み取り専用の接続を借りる。ブロックを抜けるとプールへ返却される。"""
+        if self._closed:
+            raise RuntimeError("ConnectionManager is closed")
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._reader_lock:
+                if self._reader_count < self.tuning.read_pool_size:
+                    self._reader_count += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect(readonly=True)
+                except Exception:
+                    with self._reader_lock:
+                        self._reader_count -= 1
+                    raise
+            else:
+                conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._closed:
+                conn.close()
+            else:
+                self._readers.put(conn)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """書き込み用接続を排他的に借りる。
+
+        正常終了で commit、例外時は rollback してから再送出する。
+        """
+        if self._closed:
+            raise RuntimeError("ConnectionManager is closed")
+        with self._writer_lock:
+            conn = self._get_writer()
+            changes_before = conn.total_changes
+            try:
+                yield conn
+                if conn.in_transaction:
+                    conn.commit()
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            finally:
+                if conn.total_changes != changes_before:
+                    self.write_generation += 1
+
+    def submit(self, fn: Callable[[sqlite3.Connection], Any]) -> "Future[Any]":
+        """`fn(conn)` を書き込みスレッドで実行するよう依頼し、結果の Future を返す。
+
+        `fn` は渡された書き込み接続で SQL を実行するだけにし、commit / rollback は
+        呼ばないこと（まとめて commit される）。`fn` が例外を送出した場合はその
+        リクエストの変更だけが取り消され、例外は Future 経由で呼び出し元に返る。
+        """
+        if self._closed:
+            raise RuntimeError("ConnectionManager is closed")
+        self._ensure_write_thread()
+        future: "Future[Any]" = Future()
+        self._write_queue.put((fn, future))
+        return future
+
+    def run_write(self, fn: Callable[[sqlite3.Connection], Any], timeout: Optional[float] = None) -> Any:
+        """`submit()` して commit まで待ち、`fn` の戻り値を返す。"""
+        return self.submit(fn).result(timeout)
+
+    def _ensure_write_thread(self) -> None:
+        if self._write_thread is not None:
+            return
+        with self._write_thread_lock:
+            if self._write_thread is None:
+                self._write_thread = threading.Thread(
+                    target=self._write_loop, name="sqlite-writer", daemon=True
+                )
+                self._write_thread.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            # 待っている間に溜まったリクエストをまとめて処理する
+            while len(batch) < self.tuning.write_batch_max:
+                try:
+                    nxt = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            self._run_write_batch(batch)
+            if stop:
+                return
+
+    def _run_write_batch(self, batch: list[tuple[Callable[[sqlite3.Connection], Any], Future]]) -> None:
+        outcomes: list[tuple[Future, bool, Any]] = []
+        try:
+            with self.writer() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for fn, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute("SAVEPOINT write_request")
+                    try:
+                        result = fn(conn)
+                    except BaseException as exc:  # noqa: BLE001 - 呼び出し元へそのまま返す
+                        conn.execute("ROLLBACK TO write_request")
+                        conn.execute("RELEASE write_request")
+                        outcomes.append((future, False, exc))
+                    else:
+                        conn.execute("RELEASE write_request")
+                        outcomes.append((future, True, result))
+        except BaseException as exc:  # noqa: BLE001 - commit 失敗はバッチ全体の失敗
+            for _, future in batch:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(exc)
+            return
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def data_version(self) -> tuple[int, int]:
+        """DB の内容が変わったかを判定するための値を返す。
+
+        `(write_generation, PRAGMA data_version)` の組。前者はこのプロセスの書き込みで、
+        後者は監視用接続以外（他プロセスを含む）の commit で変化する。読み取り結果の
+        キャッシュを無効化する判定に使う。
+        """
+        with self._probe_lock:
+            if self._probe is None:
+                self._probe = self._connect(readonly=True)
+            version = self._probe.execute("PRAGMA data_version").fetchone()[0]
+        return (self.write_generation, version)
+
+    def close(self) -> None:
+        """書き込みスレッドを止め、プール内の接続をすべて閉じる（テストやベンチマーク用）。"""
+        self._closed = True
+        if self._write_thread is not None:
+            self._write_queue.put(None)
+            self._write_thread.join()
+            self._write_thread = None
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._probe_lock:
+            if self._probe is not None:
+                self._probe.close()
+                self._probe = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_manager: Optional[ConnectionManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_manager() -> ConnectionManager:
+    """`DB_PATH` 用のプロセス共通 `ConnectionManager` を返す（初回呼び出しで生成）。"""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ConnectionManager(DB_PATH)
+    return _manager
+
+
+@contextmanager
+def read_connection() -> Iterator[sqlite3.Connection]:
+    """共有プールから読み取り用接続を借りる。"""
+    with get_manager().reader() as conn:
+        yield conn
+
+
+@contextmanager
+def write_connection() -> Iterator[sqlite3.Connection]:
+    """共有の書き込み用接続を借りる（ブロック終了時に commit）。
+
+    マイグレーションや CLI のように、まとまった処理を自分でトランザクション管理
+    したい場合に使う。アプリの通常の書き込みは `run_write()` を使う。
+    """
+    with get_manager().writer() as conn:
+        yield conn
+
+
+def run_write(fn: Callable[[sqlite3.Connection], Any], timeout: Optional[float] = None) -> Any:
+    """共有の書き込みスレッドで `fn(conn)` を実行し、commit 後にその戻り値を返す。"""
+    return get_manager().run_write(fn, timeout)
+
+
 def _list_migration_files() -> Iterable[Path]:
-    """`migrations` フォルダ内の SQL ファイルを番号順に返す。"""
+    """`migrations` フォルダ内の SQL / Python ファイルを番号順に返す。
+
+    Python のマイグレーションは `upgrade(conn)` 関数を定義する。バッチ単位で
+    commit しながら大量の行を処理したい場合など、SQL だけでは書けない処理に使う。
+    テーブルの作り直し（create-copy-replace）は `upgrade()` の代わりに
+    `REBUILD = TableRebuild(...)` を定義すると、オンラインのバッチコピーで実行される。
+    """
     if not MIGRATIONS_DIR.exists():
         return []
-    return sorted(MIGRATIONS_DIR.glob("*.sql"))
+    return sorted(
+        [*MIGRATIONS_DIR.glob("*.sql"), *MIGRATIONS_DIR.glob("*.py")],
+        key=lambda p: p.name,
+    )
+
+
+@dataclass(frozen=True)
+class TableRebuild:
+    """テーブルを作り直すマイグレーションの定義。
+
+    `create_sql` で新しい定義のテーブルを `<table>_new` として作り、`columns` の列を
+    `key` の順に `batch_size` 件ずつコピーしてから、短いトランザクションで元の
+    テーブルと差し替える。コピー中の INSERT / UPDATE / DELETE はトリガーで
+    `<table>_new` にも反映されるので、アプリを動かしたまま実行できる。
+
+    - `before_sql`: コピー開始前に実行する SQL（関連テーブルの作成など）
+    - `after_sql`: 差し替えと同じトランザクションで実行する SQL。元のテーブルに
+      付いていたトリガーやインデックスは DROP で消えるため、ここで作り直す。
+    """
+
+    table: str
+    create_sql: str
+    columns: tuple[str, ...]
+    key: str = "id"
+    before_sql: str = ""
+    after_sql: str = ""
+
+    @property
+    def shadow(self) -> str:
+        return f"{self.table}_new"
+
+    def sync_trigger_names(self) -> tuple[str, str, str]:
+        return (f"{self.table}_online_ai", f"{self.table}_online_au", f"{self.table}_online_ad")
+
+
+# オンライン作り直しのバッチサイズとバッチ間の待ち時間（アプリの書き込みを通すため）
+MIGRATION_BATCH_SIZE = _env_int("MIGRATION_BATCH_SIZE", 2000)
+MIGRATION_BATCH_PAUSE_MS = _env_int("MIGRATION_BATCH_PAUSE_MS", 0)
+
+
+def _load_migration_module(path: Path):
+    spec = importlib.util.spec_from_file_location(f"migrations.{path.stem}", path)
+    if spec is None or spec.loader is None:
+        raise RuntimeError(f"cannot load migration {path}")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _run_python_migration(conn: sqlite3.Connection, path: Path) -> None:
+    """`migrations/*.py` を読み込んで `upgrade(conn)` を実行する。"""
+    _load_migration_module(path).upgrade(conn)
+
+
+def _split_sql(script: str) -> list[str]:
+    """SQL スクリプトを文ごとに分ける（トリガー本体の `;` では分けない）。
+
+    末尾に残ったコメントだけの断片は捨てる。
+    """
+    statements: list[str] = []
+    buffer = ""
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ""
+    return statements
+
+
+def _execute_statements(conn: sqlite3.Connection, script: str) -> None:
+    """executescript と違い、呼び出し側のトランザクションを commit せずに実行する。"""
+    for statement in _split_sql(script):
+        conn.execute(statement)
+
+
+def _sync_triggers_sql(rebuild: TableRebuild) -> str:
+    """コピー中の変更を `<table>_new` に反映するトリガー。"""
+    ai, au, ad = rebuild.sync_trigger_names()
+    cols = ", ".join(rebuild.columns)
+    new_values = ", ".join(f"NEW.{c}" for c in rebuild.columns)
+    return f"""
+CREATE TRIGGER {ai} AFTER INSERT ON {rebuild.table} BEGIN
+    INSERT OR REPLACE INTO {rebuild.shadow} ({cols}) VALUES ({new_values});
+END;
+CREATE TRIGGER {au} AFTER UPDATE ON {rebuild.table} BEGIN
+    DELETE FROM {rebuild.shadow} WHERE {rebuild.key} = OLD.{rebuild.key};
+    INSERT OR REPLACE INTO {rebuild.shadow} ({cols}) VALUES ({new_values});
+END;
+CREATE TRIGGER {ad} AFTER DELETE ON {rebuild.table} BEGIN
+    DELETE FROM {rebuild.shadow} WHERE {rebuild.key} = OLD.{rebuild.key};
+END;
+"""
+
+
+def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return (
+        conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+        is not None
+    )
+
+
+def _copy_batch(conn: sqlite3.Connection, rebuild: TableRebuild, after_key: int, batch_size: int) -> tuple[int, int]:
+    """`after_key` より後の行を 1 バッチコピーし、(最後のキー, 件数) を返す。"""
+    high, count = conn.execute(
+        f"SELECT MAX({rebuild.key}), COUNT(*) FROM"
+        f" (SELECT {rebuild.key} FROM {rebuild.table} WHERE {rebuild.key} > ? ORDER BY {rebuild.key} LIMIT ?)",
+        (after_key, batch_size),
+    ).fetchone()
+    if not count:
+        return after_key, 0
+    cols = ", ".join(rebuild.columns)
+    # トリガーで先に反映済みの行（コピー中に更新された行）は上書きしない
+    conn.execute(
+        f"INSERT OR IGNORE INTO {rebuild.shadow} ({cols})"
+        f" SELECT {cols} FROM {rebuild.table} WHERE {rebuild.key} > ? AND {rebuild.key} <= ?",
+        (after_key, high),
+    )
+    return high, count
+
+
+def run_table_rebuild(
+    manager: ConnectionManager,
+    version: str,
+    rebuild: TableRebuild,
+    batch_size: int = MIGRATION_BATCH_SIZE,
+    pause: float = MIGRATION_BATCH_PAUSE_MS / 1000,
+) -> int:
+    """`rebuild` をバッチコピーで適用し、コピーした行数を返す。
+
+    1. `before_sql`・`<table>_new` の作成・同期トリガーの作成を 1 トランザクションで行い、
+       schema_migrations に `state='in_progress', checkpoint=0` を記録する。
+    2. `key` の順に `batch_size` 件ずつコピーし、同じトランザクションで checkpoint を進める。
+       バッチごとに commit して `pause` 秒待つので、他の書き込みは長く待たされない。
+       WAL もバッチ分しか伸びない（1 トランザクションでコピーすると WAL がテーブル
+       と同じ大きさまで膨らみ、一時的にディスクを 3 倍使う）。
+    3. 同期トリガーの削除・元テーブルの DROP・RENAME・`after_sql` と
+       `state='applied'` の記録を 1 トランザクションで行う。
+
+    途中で止まっても、次回は checkpoint の続きからコピーを再開する。複数のプロセスが
+    同時に実行しても、各バッチは書き込みロックの中で checkpoint を読み直すので
+    同じ範囲を二重にコピーしない。
+    """
+    with manager.writer() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        state = _migration_state(conn, version)
+        if state is None:
+            _execute_statements(conn, rebuild.before_sql)
+            _execute_statements(conn, rebuild.create_sql)
+            _execute_statements(conn, _sync_triggers_sql(rebuild))
+            conn.execute(
+                "INSERT INTO schema_migrations (version, state, checkpoint) VALUES (?, 'in_progress', 0)",
+                (version,),
+            )
+        elif state[0] == "applied":
+            return 0
+
+    copied = 0
+    while True:
+        with manager.writer() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            state = _migration_state(conn, version)
+            if state is None or state[0] == "applied":
+                return copied
+            high, count = _copy_batch(conn, rebuild, state[1], batch_size)
+            if count:
+                conn.execute(
+                    "UPDATE schema_migrations SET checkpoint = ? WHERE version = ?", (high, version)
+                )
+            else:
+                # コピー完了。差し替えまで同じトランザクションで行う
+                for trigger in rebuild.sync_trigger_names():
+                    conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+                conn.execute(f"DROP TABLE {rebuild.table}")
+                conn.execute(f"ALTER TABLE {rebuild.shadow} RENAME TO {rebuild.table}")
+                _execute_statements(conn, rebuild.after_sql)
+                _mark_as_applied(conn, version)
+                return copied
+        copied += count
+        if pause:
+            time.sleep(pause)
+
+
+def _estimate_table_rebuild(
+    manager: ConnectionManager,
+    version: str,
+    rebuild: TableRebuild,
+    batch_size: int,
+) -> tuple[int, Optional[float]]:
+    """(残りの行数, 1 行あたりのコピー秒数)。1 バッチを実際にコピーしてロールバックして測る。
+
+    前のマイグレーションが未適用でまだコピーできない形のテーブルなら秒数は None。
+    """
+    with manager.writer() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not _table_exists(conn, rebuild.table):
+                return 0, None
+            state = _migration_state(conn, version)
+            after_key = state[1] if state else 0
+            remaining = conn.execute(
+                f"SELECT COUNT(*) FROM {rebuild.table} WHERE {rebuild.key} > ?", (after_key,)
+            ).fetchone()[0]
+            try:
+                if state is None:
+                    _execute_statements(conn, rebuild.before_sql)
+                    _execute_statements(conn, rebuild.create_sql)
+                t0 = time.perf_counter()
+                _, sampled = _copy_batch(conn, rebuild, after_key, batch_size)
+                elapsed = time.perf_counter() - t0
+            except sqlite3.OperationalError:
+                return remaining, None
+        finally:
+            conn.rollback()
+    return remaining, (elapsed / sampled if sampled else 0.0)
 
 
 def _ensure_migration_table(conn: sqlite3.Connection) -> None:
-    """マイグレーションの実行履歴を管理するテーブルを作成する。"""
+    """マイグレーションの実行履歴を管理するテーブルを作成する。
+
+    `state` は `applied`（適用済み）か `in_progress`（オンライン作り直しの途中）。
+    `checkpoint` は作り直し中にコピー済みの最後のキー。
+    """
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS schema_migrations (
             version TEXT PRIMARY KEY,
-            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            state TEXT NOT NULL DEFAULT 'applied',
+            checkpoint INTEGER
         )
         """
     )
+    # 列を追加する前に作られたテーブルを移行する
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(schema_migrations)")}
+    if "state" not in columns:
+        conn.execute("ALTER TABLE schema_migrations ADD COLUMN state TEXT NOT NULL DEFAULT 'applied'")
+    if "checkpoint" not in columns:
+        conn.execute("ALTER TABLE schema_migrations ADD COLUMN checkpoint INTEGER")
 
 
-def _is_applied(conn: sqlite3.Connection, version: str) -> bool:
-    """指定バージョンが既に適用済みかを確認する。"""
-    cur = conn.execute(
-        "SELECT 1 FROM schema_migrations WHERE version = ? LIMIT 1", (version,)
-    )
-    return cur.fetchone() is not None
+def _load_applied_versions(conn: sqlite3.Connection) -> set[str]:
+    """適用済みバージョンを 1 回のクエリでまとめて取得する。"""
+    return {row[0] for row in conn.execute("SELECT version FROM schema_migrations WHERE state = 'applied'")}
+
+
+def _migration_state(conn: sqlite3.Connection, version: str) -> Optional[tuple[str, int]]:
+    row = conn.execute(
+        "SELECT state, COALESCE(checkpoint, 0) FROM schema_migrations WHERE version = ?", (version,)
+    ).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+# (パス, mtime_ns, サイズ) -> 内容の sha256。変更が無いファイルは読み直さない
+_checksum_cache: dict[tuple[str, int, int], str] = {}
+
+
+def _migration_fingerprint(paths: Iterable[Path]) -> str:
+    """マイグレーションファイル一式（ファイル名と内容）の指紋を返す。"""
+    digest = hashlib.sha256()
+    for path in paths:
+        st = path.stat()
+        key = (str(path), st.st_mtime_ns, st.st_size)
+        checksum = _checksum_cache.get(key)
+        if checksum is None:
+            checksum = hashlib.sha256(path.read_bytes()).hexdigest()
+            _checksum_cache[key] = checksum
+        digest.update(f"{path.name}:{checksum}\n".encode("utf-8"))
+    return digest.hexdigest()
 
 
 def _mark_as_applied(conn: sqlite3.Connection, version: str) -> None:
     """マイグレーションを適用済みとして記録する。"""
     conn.execute(
-        "INSERT INTO schema_migrations (version) VALUES (?)",
+        """
+        INSERT INTO schema_migrations (version, state, checkpoint) VALUES (?, 'applied', NULL)
+        ON CONFLICT (version) DO UPDATE SET
+            state = 'applied', checkpoint = NULL, applied_at = CURRENT_TIMESTAMP
+        """,
         (version,),
     )
 
 
-def apply_migrations() -> None:
-    """未適用のマイグレーションを順番に実行する。"""
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    try:
+def _pending_migrations(manager: ConnectionManager, paths: list[Path]) -> list[Path]:
+    with manager.writer() as conn:
         _ensure_migration_table(conn)
+        conn.commit()
+        applied = _load_applied_versions(conn)
+    return [path for path in paths if path.stem not in applied]
 
-        for path in _list_migration_files():
-            version = path.stem  # 例: "001_create_dishes"
-            if _is_applied(conn, version):
-                continue
 
-            sql = path.read_text(encoding="utf-8")
-            # 複数ステートメントを含むので executescript を利用
-            conn.executescript(sql)
-            _mark_as_applied(conn, version)
-            conn.commit()
-    finally:
-        conn.close()
+def apply_migrations(
+    manager: Optional[ConnectionManager] = None,
+    timings: Optional[dict[str, float]] = None,
+    batch_size: int = MIGRATION_BATCH_SIZE,
+    pause: float = MIGRATION_BATCH_PAUSE_MS / 1000,
+) -> None:
+    """未適用のマイグレーションを順番に実行する。
 
+    `manager` を省略すると `DB_PATH` 用の共有マネージャを使う（ベンチマークなどで
+    別の DB ファイルに適用したい場合に指定する）。
 
-if __name__ == "__main__":
-    apply_migrations()
+    Streamlit は rerun のたびにこの関数を呼ぶため、一度「最新」と確認したら
+    マイグレーションファイル一式の指紋をマネージャに記録し、指紋が変わらない限り
+    DB には触れずに戻る。
+
+    `timings` に dict を渡すと、起動時チェック（`"check"`）と各マイグレーションの
+    所要秒数が書き込まれる。`REBUILD` を定義したマイグレーションは
+    `run_table_rebuild()` で `batch_size` 件ずつコピーする。
+    """
+    manager = manager or get_manager()
+    started = time.perf_counter()
+    paths = list(_list_migration_files())
+    fingerprint = _migration_fingerprint(paths)
+    if manager.schema_fingerprint == fingerprint:
+        if timings is not None:
+            timings["check"] = time.perf_counter() - started
+        return
+
+    # 書き込み用の共有接続を使う（初回はここで WAL への切り替えも行われる）
+    pending = _pending_migrations(manager, paths)
+    if timings is not None:
+        timings["check"] = time.perf_counter() - started
+
+    for path in pending:
+        version = path.stem  # 例: "001_create_dishes"
+        t0 = time.perf_counter()
+        module = _load_migration_module(path) if path.suffix == ".py" else None
+        rebuild = getattr(module, "REBUILD", None)
+        if rebuild is not None:
+            # バッチごとに書き込みロックを手放すので、ここでは writer() を握らない
+            run_table_rebuild(manager, version, rebuild, batch_size, pause)
+        else:
+            with manager.writer() as conn:
+                if module is not None:
+                    module.upgrade(conn)
+                else:
+                    sql = path.read_text(encoding="utf-8")
+                    # 複数ステートメントを含むので executescript を利用
+                    conn.executescript(sql)
+                _mark_as_applied(conn, version)
+                conn.commit()
+        if timings is not None:
+            timings[version] = time.perf_counter() - t0
+
+    manager.schema_fingerprint = fingerprint
+
+
+def estimate_migrations(
+    manager: Optional[ConnectionManager] = None,
+    batch_size: int = MIGRATION_BATCH_SIZE,
+    pause: float = MIGRATION_BATCH_PAUSE_MS / 1000,
+) -> list[tuple[str, Optional[int], Optional[float]]]:
+    """未適用のマイグレーションを実行せずに (バージョン, 対象行数, 推定秒数) を返す。
+
+    `REBUILD` を定義したマイグレーションだけが見積もり対象で、それ以外は行数・秒数とも None。
+    見積もりでは 1 バッチ分を実際にコピーしてロールバックするので、その間だけ書き込みロックを取る。
+    前のマイグレーションが未適用でまだコピーできない場合は、同じテーブルについて先に測った
+    速度を使う（それも無ければ秒数は None）。
+    """
+    manager = manager or get_manager()
+    results: list[tuple[str, Optional[int], Optional[float]]] = []
+    rates: dict[str, float] = {}
+    for path in _pending_migrations(manager, list(_list_migration_files())):
+        module = _load_migration_module(path) if path.suffix == ".py" else None
+        rebuild = getattr(module, "REBUILD", None)
+        if rebuild is None:
+            results.append((path.stem, None, None))
+            continue
+        rows, rate = _estimate_table_rebuild(manager, path.stem, rebuild, batch_size)
+        if rate is None:
+            rate = rates.get(rebuild.table)
+        else:
+            rates[rebuild.table] = rate
+        seconds = None if rate is None else rows * rate + -(-rows // batch_size) * pause
+        results.append((path.stem, rows, seconds))
+    return results
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="receipts.db にマイグレーションを適用する")
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="起動時チェックと各マイグレーションの所要時間を表示する",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="適用せずに、未適用のマイグレーションと作り直しの推定所要時間を表示する",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=MIGRATION_BATCH_SIZE, help="テーブル作り直しのコピー件数/バッチ"
+    )
+    parser.add_argument(
+        "--pause-ms",
+        type=float,
+        default=MIGRATION_BATCH_PAUSE_MS,
+        help="テーブル作り直しのバッチ間の待ち時間（アプリ稼働中に流す場合に増やす）",
+    )
+    args = parser.parse_args(argv)
+    batch_size = max(1, args.batch_size)
+    pause = max(0.0, args.pause_ms) / 1000
+
+    if args.dry_run:
+        pending = estimate_migrations(batch_size=batch_size, pause=pause)
+        if not pending:
+            print(f"{DB_PATH} is up to date")
+        for version, rows, seconds in pending:
+            if rows is None:
+                print(f"  {version:<40} (schema only)")
+            elif seconds is None:
+                print(f"  {version:<40} rows={rows:<8} ~?s (needs earlier migrations first)")
+            else:
+                print(f"  {version:<40} rows={rows:<8} ~{seconds:.1f}s")
+        return 0
+
+    timings: dict[str, float] = {}
+    apply_migrations(timings=timings, batch_size=batch_size, pause=pause)
     print(f"Applied migrations into {DB_PATH}")
+    if args.timings:
+        for name, seconds in timings.items():
+            print(f"  {name:<40} {seconds * 1000:8.2f} ms")
+        # 2 回目はプロセス内ラッチが効くので、ウォームな rerun のコストの目安になる
+        warm: dict[str, float] = {}
+        apply_migrations(timings=warm)
+        print(f"  {'check (warm)':<40} {warm['check'] * 1000:8.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,349 @@
+"""料理データ（dishes）と写真の一括エクスポート / インポート CLI。
+
+エクスポート先はディレクトリで、次の構成になる:
+
+    <dir>/dishes.jsonl  もしくは  <dir>/dishes.csv
+    <dir>/photos/<元の id>.<ext>
+
+各レコードの `photo` 列は `photos/...` への相対パス（写真が無ければ空）。
+
+Usage:
+  python dish_io.py export <dir> [--format jsonl|csv] [--public-only]
+  python dish_io.py import <dir> [--batch-size 500] [--restart]
+
+インポートは `--batch-size` 件ごとに 1 トランザクションで `executemany` し、写真は
+内容のハッシュで決まる保存先（photo_store.py）へコピーする（同じ写真は 1 つにまとまる）。進捗は import_checkpoints
+テーブルにバッチと同じトランザクションで記録するので、中断後に同じコマンドを
+再実行すると続きから取り込む。レコードはストリームで読み書きするため、
+データ量に関係なくメモリ使用量は 1 バッチ分で一定。
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import json
+import shutil
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from db import DB_PATH, ConnectionManager, apply_migrations
+from photo_store import discard_unreferenced_photo, put_photo
+from storage import _sanitize_suffix, discard_staged_upload, hash_photo_file, stage_upload
+
+# エクスポートする列（edit_token などの秘密情報は含めない）
+EXPORT_COLUMNS = [
+    "id",
+    "name",
+    "date",
+    "recipe_url",
+    "memo_user",
+    "ai_summary",
+    "ai_tips",
+    "ingredients_json",
+    "tags",
+    "favorite",
+    "is_public",
+    "owner_id",
+    "author_display_name",
+    "created_at",
+    "updated_at",
+]
+
+# インポート時に dishes へ書き込む列（id は取り込み先で採番し直す）
+IMPORT_COLUMNS = [c for c in EXPORT_COLUMNS if c not in ("id", "updated_at")] + ["photo_path", "photo_hash"]
+
+INT_COLUMNS = {"favorite", "is_public", "owner_id"}
+
+PHOTOS_DIRNAME = "photos"
+
+
+def _data_file(directory: Path, fmt: Optional[str] = None) -> Path:
+    if fmt:
+        return directory / f"dishes.{fmt}"
+    for candidate in ("jsonl", "csv"):
+        path = directory / f"dishes.{candidate}"
+        if path.exists():
+            return path
+    raise FileNotFoundError(f"{directory} に dishes.jsonl / dishes.csv がありません")
+
+
+def _progress(label: str, done: int, started: float, processed: Optional[int] = None) -> None:
+    """進捗を stderr に出す。`processed` は今回処理した件数（再開時は done より少ない）。"""
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    rate = (done if processed is None else processed) / elapsed
+    print(f"{label}: {done} records ({rate:.0f} rec/s)", file=sys.stderr, flush=True)
+
+
+# ---------------------------------------------------------------------------
+# export
+# ---------------------------------------------------------------------------
+
+
+def _iter_dishes(manager: ConnectionManager, public_only: bool, fetch_size: int = 500):
+    where = "WHERE is_public = 1" if public_only else ""
+    with manager.reader() as conn:
+        cur = conn.execute(
+            f"SELECT {', '.join(EXPORT_COLUMNS)}, photo_path FROM dishes {where} ORDER BY id"
+        )
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
+
+
+def export_dishes(
+    manager: ConnectionManager, directory: Path, fmt: str = "jsonl", public_only: bool = False
+) -> int:
+    """dishes と写真を `directory` へ書き出し、件数を返す。"""
+    photos_dir = directory / PHOTOS_DIRNAME
+    photos_dir.mkdir(parents=True, exist_ok=True)
+    data_path = _data_file(directory, fmt)
+    started = time.perf_counter()
+    count = 0
+
+    with data_path.open("w", encoding="utf-8", newline="") as f:
+        writer = None
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS + ["photo"])
+            writer.writeheader()
+        for row in _iter_dishes(manager, public_only):
+            record = {c: row[c] for c in EXPORT_COLUMNS}
+            record["photo"] = ""
+            src = Path(row["photo_path"]) if row["photo_path"] else None
+            if src is not None and src.exists():
+                rel = Path(PHOTOS_DIRNAME) / f"{row['id']}{src.suffix.lower()}"
+                shutil.copyfile(src, directory / rel)
+                record["photo"] = rel.as_posix()
+            if writer is not None:
+                writer.writerow({k: "" if v is None else v for k, v in record.items()})
+            else:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+            if count % 1000 == 0:
+                _progress("exported", count, started)
+
+    _progress("exported", count, started)
+    return count
+
+
+# ---------------------------------------------------------------------------
+# import
+# ---------------------------------------------------------------------------
+
+
+def _iter_records(data_path: Path) -> Iterator[dict]:
+    with data_path.open("r", encoding="utf-8", newline="") as f:
+        if data_path.suffix == ".csv":
+            for record in csv.DictReader(f):
+                yield {k: (None if v == "" else v) for k, v in record.items()}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _source_key(data_path: Path) -> str:
+    """再開用のキー。ファイルの場所とサイズが同じなら同じ取り込みとみなす。"""
+    st = data_path.stat()
+    raw = f"{data_path.resolve()}:{st.st_size}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+def _split_tags(tags_field: Optional[str]) -> list[str]:
+    if not tags_field:
+        return []
+    return [t.strip() for t in str(tags_field).split(",") if t.strip()]
+
+
+def _to_row(record: dict) -> dict:
+    row = {c: record.get(c) for c in IMPORT_COLUMNS if c not in ("photo_path", "photo_hash")}
+    for c in INT_COLUMNS:
+        if row.get(c) not in (None, ""):
+            row[c] = int(row[c])
+    row["favorite"] = row.get("favorite") or 0
+    row["is_public"] = row.get("is_public") or 0
+    row["name"] = row.get("name") or ""
+    row["memo_user"] = row.get("memo_user") or ""
+    row["tags"] = row.get("tags") or ""
+    return row
+
+
+def _discard_copied_photos(conn, copied: list[tuple[str, Path]]) -> None:
+    """rollback したバッチで新しく置いた写真を片付ける。
+
+    rollback から削除までの間に、別の書き込み（アプリの書き込みスレッドなど別プロセスも）が
+    同じ写真を置き直して参照しているかもしれないので、書き込みロックを取り直して
+    `photo_blobs` に行が無いものだけを消す。ロックが取れなければ参照されないファイルが残るだけ。
+    """
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for photo_hash, path in copied:
+            discard_unreferenced_photo(conn, photo_hash, path)
+        conn.commit()
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.rollback()
+
+
+def _write_batch(conn, directory: Path, batch: list[dict], source: str, records_done: int) -> None:
+    """1 バッチ分の料理・タグ・写真を書き込み、進捗を同じトランザクションで記録する。"""
+    conn.execute("BEGIN IMMEDIATE")
+    # 書き込みロックを持った状態で id をまとめて採番する（タグの対応付けに id が必要なため）
+    next_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM dishes").fetchone()[0]
+
+    rows = []
+    copied: list[tuple[str, Path]] = []
+    staged_files: list[Path] = []
+    try:
+        for offset, record in enumerate(batch):
+            dish_id = next_id + offset
+            row = _to_row(record)
+            row["photo_path"] = None
+            row["photo_hash"] = None
+            photo = record.get("photo")
+            if photo:
+                src = directory / photo
+                if src.exists():
+                    # 内容のハッシュで決まる場所に置く。同じ写真が既にあれば参照数を増やすだけ
+                    with src.open("rb") as f:
+                        staged = stage_upload(f)
+                    staged_files.append(staged)
+                    photo_hash = hash_photo_file(staged)
+                    dest, created = put_photo(conn, staged, photo_hash, _sanitize_suffix(src.name))
+                    if created:
+                        copied.append((photo_hash, dest))
+                    row["photo_path"] = str(dest)
+                    row["photo_hash"] = photo_hash
+            rows.append((dish_id, row))
+
+        columns = ["id"] + IMPORT_COLUMNS
+        # created_at が無いレコードは既定値と同じく現在時刻にする
+        placeholders = ", ".join(
+            "COALESCE(?, CURRENT_TIMESTAMP)" if c == "created_at" else "?" for c in columns
+        )
+        conn.executemany(
+            f"INSERT INTO dishes ({', '.join(columns)}) VALUES ({placeholders})",
+            [(dish_id, *[row[c] for c in IMPORT_COLUMNS]) for dish_id, row in rows],
+        )
+
+        pairs = [(tag, dish_id) for dish_id, row in rows for tag in _split_tags(row["tags"])]
+        conn.executemany(
+            "INSERT INTO tags (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+            [(tag,) for tag, _ in pairs],
+        )
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO dish_tags (tag_id, dish_id, created_at)
+            SELECT tags.id, dishes.id, dishes.created_at
+            FROM tags, dishes
+            WHERE tags.name = ? AND dishes.id = ?
+            """,
+            pairs,
+        )
+
+        conn.execute(
+            """
+            INSERT INTO import_checkpoints (source, records_done) VALUES (?, ?)
+            ON CONFLICT (source) DO UPDATE
+            SET records_done = excluded.records_done, updated_at = CURRENT_TIMESTAMP
+            """,
+            (source, records_done),
+        )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if copied:
+            _discard_copied_photos(conn, copied)
+        raise
+    finally:
+        # 既にあった写真を参照した分と、rollback した分の一時ファイルを消す
+        for path in staged_files:
+            discard_staged_upload(path)
+
+
+def import_dishes(
+    manager: ConnectionManager,
+    directory: Path,
+    batch_size: int = 500,
+    restart: bool = False,
+) -> int:
+    """`directory` のエクスポートを取り込み、今回取り込んだ件数を返す。"""
+    data_path = _data_file(directory)
+    source = _source_key(data_path)
+
+    with manager.writer() as conn:
+        if restart:
+            conn.execute("DELETE FROM import_checkpoints WHERE source = ?", (source,))
+        row = conn.execute(
+            "SELECT records_done FROM import_checkpoints WHERE source = ?", (source,)
+        ).fetchone()
+    skip = row[0] if row else 0
+    if skip:
+        print(f"resuming {data_path}: skipping {skip} already imported records", file=sys.stderr)
+
+    started = time.perf_counter()
+    done = skip
+    imported = 0
+    batch: list[dict] = []
+
+    def flush() -> None:
+        nonlocal done, imported
+        if not batch:
+            return
+        with manager.writer() as conn:
+            _write_batch(conn, directory, batch, source, done + len(batch))
+        done += len(batch)
+        imported += len(batch)
+        batch.clear()
+        _progress("imported", done, started, imported)
+
+    for index, record in enumerate(_iter_records(data_path)):
+        if index < skip:
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return imported
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="dishes と写真の一括エクスポート / インポート")
+    parser.add_argument("--db", type=Path, default=DB_PATH, help="対象の SQLite ファイル")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="dishes と写真をディレクトリへ書き出す")
+    p_export.add_argument("directory", type=Path)
+    p_export.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    p_export.add_argument("--public-only", action="store_true", help="公開中の料理だけを書き出す")
+
+    p_import = sub.add_parser("import", help="export したディレクトリを取り込む")
+    p_import.add_argument("directory", type=Path)
+    p_import.add_argument("--batch-size", type=int, default=500)
+    p_import.add_argument(
+        "--restart", action="store_true", help="前回の進捗を捨てて最初から取り込む"
+    )
+
+    args = parser.parse_args(list(argv) if argv is not None else None)
+    manager = ConnectionManager(args.db)
+    try:
+        apply_migrations(manager)
+        if args.command == "export":
+            n = export_dishes(manager, args.directory, args.format, args.public_only)
+            print(f"Exported {n} dishes into {args.directory}")
+        else:
+            n = import_dishes(manager, args.directory, max(1, args.batch_size), args.restart)
+            print(f"Imported {n} dishes from {args.directory}")
+    finally:
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,431 @@
+"""料理写真の取り込み（正規化）と、サムネイル（幅違いの縮小版）を作る画像パイプライン。
+
+アップロードされた写真は `PhotoIngester.ingest()` で保存前に正規化する。
+- `PHOTO_MAX_UPLOAD_MB`（既定 20）を超えるファイルは受け付けない
+- EXIF の向きを画素に反映し、長辺を `PHOTO_MAX_EDGE`（既定 2560px）以下に縮小して
+  品質 `PHOTO_JPEG_QUALITY`（既定 85）の JPEG に再圧縮する。EXIF（撮影位置など）は残さない
+- デコード・縮小・エンコードは `PHOTO_INGEST_WORKERS`（既定 2、0 なら呼び出し元のスレッド）の
+  プロセスプールで行い、Streamlit のスレッドで CPU を使い続けない
+
+保存された写真 `data/photos/<2 桁>/<2 桁>/<hash>.jpg`（photo_store.py）の隣に、幅 `VARIANT_WIDTHS`
+ピクセルの縮小版 `<hash>.w320.webp` などを作る。元の写真より大きい幅は作らない。
+移行前の料理ごとの配置（`.../<dish_id>/cover.<ext>`）の写真なら `cover.w320.webp` などになる。
+一覧・ギャラリーのカードは `best_variant()` で表示幅を満たす最小の縮小版を使い、
+まだ作られていなければ元の写真を表示する。
+
+- 生成は `schedule_variants()` でバックグラウンドのスレッドプールに任せる
+  （Pillow の縮小・エンコードは GIL を離すのでスレッドで並列に動く）
+- 出力形式は `IMAGE_VARIANT_FORMAT`（webp / jpeg、既定 webp）。WebP のエンコーダが
+  無い Pillow では JPEG にする
+- Pillow が入っていない環境では何も作らず、カードは元の写真を表示する
+
+既存の写真の縮小版は次のコマンドでまとめて作れる:
+
+    python images.py backfill [--workers 4] [--force]
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+from app_logging import get_logger, log_event
+from db import DB_PATH, ConnectionManager, _env_int
+from storage import _sanitize_suffix, discard_staged_upload, hash_photo_file, new_staged_path, stage_upload
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # pragma: no cover - Pillow は任意
+    Image = None  # type: ignore[assignment]
+
+logger = get_logger("images")
+
+VARIANT_WIDTHS = (320, 640, 1280)
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+
+def variant_format() -> str:
+    fmt = os.environ.get("IMAGE_VARIANT_FORMAT", "webp").lower()
+    if fmt == "webp" and (Image is None or not features.check("webp")):
+        return "jpeg"
+    return "jpeg" if fmt in ("jpg", "jpeg") else "webp"
+
+
+def _suffix(fmt: str) -> str:
+    return ".jpg" if fmt == "jpeg" else ".webp"
+
+
+def variant_path(photo_path: Path, width: int, fmt: Optional[str] = None) -> Path:
+    """`<hash>.jpg` → `<hash>.w640.webp`（同じディレクトリ）。"""
+    fmt = fmt or variant_format()
+    return photo_path.with_name(f"{photo_path.stem}.w{width}{_suffix(fmt)}")
+
+
+def existing_variants(photo_path: Path) -> list[Path]:
+    """作成済みの縮小版（形式を問わない）。写真を消すときに一緒に消す用。"""
+    return sorted(photo_path.parent.glob(f"{photo_path.stem}.w*.*"))
+
+
+def best_variant(photo_path: Path, min_width: int) -> Path:
+    """幅 `min_width` 以上の縮小版のうち最小のものを返す。
+
+    該当する縮小版が無ければ（元の写真が小さい・まだ作られていない）元の写真を返す。
+    """
+    fmt = variant_format()
+    for width in VARIANT_WIDTHS:
+        if width < min_width:
+            continue
+        candidate = variant_path(photo_path, width, fmt)
+        if candidate.exists():
+            return candidate
+    return photo_path
+
+
+def _save_atomic(image, destination: Path, fmt: str) -> None:
+    """一時ファイルに書いてから rename する（表示中のカードに書きかけのファイルを見せない）。"""
+    fd, name = tempfile.mkstemp(dir=destination.parent, prefix=f".{destination.name}.", suffix=".part")
+    tmp = Path(name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if fmt == "jpeg":
+                image.save(f, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            else:
+                image.save(f, "WEBP", quality=WEBP_QUALITY, method=4)
+        os.replace(tmp, destination)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def generate_variants(photo_path: Path, force: bool = False) -> list[Path]:
+    """`photo_path` の縮小版を作り、作成（または既存）の縮小版のパスを返す。"""
+    if Image is None or not photo_path.exists():
+        return []
+    fmt = variant_format()
+    targets = {w: variant_path(photo_path, w, fmt) for w in VARIANT_WIDTHS}
+    if not force and all(p.exists() for p in targets.values()):
+        return list(targets.values())
+
+    created: list[Path] = []
+    with Image.open(photo_path) as original:
+        # スマートフォンの写真は EXIF の向き情報で回転しているので、画素に反映してから縮小する
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        # 大きい順に縮小し、前の結果から次を作る（元画像から毎回縮小するより速い）
+        current = image
+        for width in sorted(VARIANT_WIDTHS, reverse=True):
+            if width >= image.width:
+                continue
+            destination = targets[width]
+            height = max(1, round(current.height * width / current.width))
+            current = current.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+            if force or not destination.exists():
+                _save_atomic(current, destination, fmt)
+            created.append(destination)
+    return sorted(created)
+
+
+class InvalidPhotoError(ValueError):
+    """画像として読み込めないファイルがアップロードされた。"""
+
+
+class PhotoProcessingUnavailableError(RuntimeError):
+    """正規化のワーカープロセスが落ち、作り直したプロセスプールでも処理できなかった。"""
+
+
+@dataclass(frozen=True)
+class IngestSettings:
+    """取り込み時の正規化の設定（ワーカープロセスへ渡せるよう単純な値だけを持つ）。"""
+
+    max_bytes: int = 20 * 1024 * 1024
+    max_edge: int = 2560
+    quality: int = 85
+
+    @classmethod
+    def from_env(cls) -> "IngestSettings":
+        default = cls()
+        return cls(
+            max_bytes=max(1, _env_int("PHOTO_MAX_UPLOAD_MB", default.max_bytes // (1024 * 1024))) * 1024 * 1024,
+            max_edge=max(VARIANT_WIDTHS[-1], _env_int("PHOTO_MAX_EDGE", default.max_edge)),
+            quality=min(95, max(50, _env_int("PHOTO_JPEG_QUALITY", default.quality))),
+        )
+
+
+@dataclass(frozen=True)
+class IngestedPhoto:
+    """正規化済みの写真（一時ファイル）。`suffix` は保存先のファイル名に使う拡張子、
+    `sha256` は内容のハッシュ（写真の保存先を決める。photo_store.py）。"""
+
+    staged: Path
+    suffix: str
+    sha256: str
+    width: int
+    height: int
+    bytes_in: int
+    bytes_out: int
+
+
+def _normalize_photo(source: str, destination: str, settings: IngestSettings) -> tuple[int, int, str]:
+    """`source` を正規化した JPEG を `destination` に書き、(幅, 高さ, SHA-256) を返す（ワーカープロセスで実行）。"""
+    try:
+        with Image.open(source) as original:
+            # JPEG は縮小後の大きさに近い 1/2・1/4・1/8 の解像度で直接デコードさせる
+            # （1200 万画素を全部展開しないので、メモリも時間も大きく減る）
+            original.draft("RGB", (settings.max_edge, settings.max_edge))
+            image = ImageOps.exif_transpose(original)
+            if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+                # JPEG は透過を持てないので白地に合成する
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            elif image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.thumbnail((settings.max_edge, settings.max_edge), Image.LANCZOS, reducing_gap=3.0)
+            icc_profile = original.info.get("icc_profile")
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as exc:
+        raise InvalidPhotoError("画像ファイルとして読み込めませんでした") from exc
+    # exif を渡さないので撮影位置などのメタデータは残らない（色を保つため ICC プロファイルだけ残す）
+    encoded = io.BytesIO()
+    image.save(encoded, "JPEG", quality=settings.quality, optimize=True, progressive=True, icc_profile=icc_profile)
+    data = encoded.getbuffer()
+    with open(destination, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return image.width, image.height, hashlib.sha256(data).hexdigest()
+
+
+class _InlineExecutor(Executor):
+    """`workers=0` 用。呼び出し元のスレッドでそのまま実行する。"""
+
+    def submit(self, fn, /, *args, **kwargs):  # type: ignore[override]
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:  # noqa: BLE001 - 呼び出し元に返す
+            future.set_exception(exc)
+        return future
+
+
+class PhotoIngester:
+    """アップロードされた写真を一時ファイルに受け取り、正規化して返す。
+
+    1. `stage_upload()` でアップロードを少しずつ一時ファイルへ書き出す（上限を超えたらその時点で中止）
+    2. ワーカープロセスが一時ファイルを開いて正規化し、別の一時ファイルに書く
+    3. 元の一時ファイルは消し、正規化済みの一時ファイルを `IngestedPhoto` で返す
+
+    ワーカーにはパスだけを渡すので、写真のバイト列をプロセス間でコピーしない。
+    Pillow が無い環境では正規化せず、受け取った一時ファイルをそのまま返す。
+    """
+
+    def __init__(self, settings: Optional[IngestSettings] = None, workers: int = 2) -> None:
+        self.settings = settings or IngestSettings.from_env()
+        self.workers = max(0, workers)
+        self._executor: Optional[Executor] = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    if self.workers == 0:
+                        self._executor = _InlineExecutor()
+                    else:
+                        # Streamlit のスレッドを抱えたプロセスを fork しないよう spawn で起動する
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                        )
+        return self._executor
+
+    def _discard_executor(self, executor: Executor) -> None:
+        """壊れたプールを捨てる（次の `_get_executor()` で作り直される）。"""
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _normalize(self, staged: Path, normalized: Path) -> tuple[int, int, str]:
+        # ワーカーが落ちる（大きな画像のデコード中の OOM など）とプールは以後ずっと
+        # BrokenProcessPool を返すので、作り直して 1 回だけやり直す（出力先は上書きされる）
+        for attempt in (1, 2):
+            executor = self._get_executor()
+            try:
+                return executor.submit(_normalize_photo, str(staged), str(normalized), self.settings).result()
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                log_event(logger, logging.WARNING, "ingest_pool_broken", attempt=attempt)
+        raise PhotoProcessingUnavailableError("写真の処理に失敗しました。少し待ってからもう一度お試しください")
+
+    def ingest(self, upload, filename: Optional[str] = None) -> IngestedPhoto:
+        """`upload`（UploadedFile などのファイルオブジェクト、またはバイト列）を正規化する。
+
+        上限を超えていれば `storage.UploadTooLargeError`、画像として読めなければ
+        `InvalidPhotoError`、ワーカープロセスが作り直しても使えなければ
+        `PhotoProcessingUnavailableError` を送出する（いずれも一時ファイルは残さない）。
+        """
+        started = time.perf_counter()
+        staged = stage_upload(upload, max_bytes=self.settings.max_bytes)
+        bytes_in = staged.stat().st_size
+        if Image is None:
+            return IngestedPhoto(staged, _sanitize_suffix(filename), hash_photo_file(staged), 0, 0, bytes_in, bytes_in)
+        normalized = new_staged_path()
+        try:
+            width, height, sha256 = self._normalize(staged, normalized)
+        except BaseException:
+            discard_staged_upload(normalized)
+            raise
+        finally:
+            discard_staged_upload(staged)
+        photo = IngestedPhoto(normalized, ".jpg", sha256, width, height, bytes_in, normalized.stat().st_size)
+        log_event(
+            logger,
+            logging.INFO,
+            "photo_ingested",
+            width=width,
+            height=height,
+            bytes_in=photo.bytes_in,
+            bytes_out=photo.bytes_out,
+            elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+        )
+        return photo
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+_ingester: Optional[PhotoIngester] = None
+_ingester_lock = threading.Lock()
+
+
+def get_photo_ingester() -> PhotoIngester:
+    """プロセス共通の `PhotoIngester` を返す（`PHOTO_INGEST_WORKERS`、既定 2）。"""
+    global _ingester
+    if _ingester is None:
+        with _ingester_lock:
+            if _ingester is None:
+                _ingester = PhotoIngester(workers=_env_int("PHOTO_INGEST_WORKERS", 2))
+    return _ingester
+
+
+class VariantPool:
+    """縮小版の生成を引き受けるスレッドプール。同じ写真の依頼が重なったら 1 回にまとめる。"""
+
+    def __init__(self, workers: int = 2) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="image-variants")
+        self._pending: dict[Path, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, photo_path: Path, force: bool = False) -> Future:
+        with self._lock:
+            future = self._pending.get(photo_path)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._run, photo_path, force)
+            self._pending[photo_path] = future
+        return future
+
+    def _run(self, photo_path: Path, force: bool) -> list[Path]:
+        started = time.perf_counter()
+        try:
+            created = generate_variants(photo_path, force)
+            log_event(
+                logger,
+                logging.DEBUG,
+                "variants_created",
+                photo=str(photo_path),
+                count=len(created),
+                elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+            )
+            return created
+        except Exception:
+            # 縮小版が無くても元の写真で表示できるので、記録だけして続ける
+            log_event(logger, logging.WARNING, "variants_failed", photo=str(photo_path), exc_info=True)
+            return []
+        finally:
+            with self._lock:
+                self._pending.pop(photo_path, None)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+_pool: Optional[VariantPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_variant_pool() -> VariantPool:
+    """プロセス共通の `VariantPool` を返す（`IMAGE_WORKERS`、既定 2）。"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = VariantPool(_env_int("IMAGE_WORKERS", 2))
+    return _pool
+
+
+def schedule_variants(photo_path: Path) -> Optional[Future]:
+    """縮小版の生成をバックグラウンドで始める。Pillow が無ければ何もしない。"""
+    if Image is None:
+        return None
+    return get_variant_pool().submit(photo_path)
+
+
+def backfill(manager: ConnectionManager, workers: int, force: bool = False) -> tuple[int, int]:
+    """写真のある料理すべての縮小版を作る。(処理した写真の数, 作った縮小版の数) を返す。"""
+    with manager.reader() as conn:
+        paths = [Path(row[0]) for row in conn.execute("SELECT DISTINCT photo_path FROM dishes WHERE photo_path IS NOT NULL")]
+    pool = VariantPool(workers)
+    photos = variants = 0
+    try:
+        futures = [pool.submit(p, force) for p in paths if p.exists()]
+        for future in as_completed(futures):
+            photos += 1
+            variants += len(future.result())
+    finally:
+        pool.shutdown()
+    return photos, variants
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="料理写真の縮小版を作る")
+    parser.add_argument("--db", type=Path, default=DB_PATH, help="対象の SQLite ファイル")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_backfill = sub.add_parser("backfill", help="既存の写真の縮小版をまとめて作る")
+    p_backfill.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    p_backfill.add_argument("--force", action="store_true", help="作成済みの縮小版も作り直す")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    if Image is None:
+        print("Pillow が見つかりません（pip install Pillow）")
+        return 1
+    if not args.db.exists():
+        print(f"{args.db} がありません")
+        return 1
+    manager = ConnectionManager(args.db)
+    try:
+        started = time.perf_counter()
+        photos, variants = backfill(manager, max(1, args.workers), args.force)
+        print(f"{photos} photos, {variants} variants ({variant_format()}) in {time.perf_counter() - started:.1f}s")
+    finally:
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,214 @@
+"""DB の定期メンテナンス CLI。
+
+Usage:
+  python maintenance.py submission-attempts [--retention-days 30] [--hourly-retention-days 90]
+                                            [--batch-size 1000] [--pause-ms 20] [--vacuum]
+
+submission-attempts:
+  1. 未集計の submission_attempts を id 順に `--batch-size` 件ずつ読み、時間別・日別の
+     集計テーブルへ加算する。集計済みの id は rollup_checkpoints に同じトランザクションで
+     記録するので、途中で止めても二重に数えない。
+  2. 集計済みで `--retention-days` より古い生の行を id の範囲で少しずつ削除する。
+     1 バッチごとに commit して `--pause-ms` 待つので、アプリの書き込みを長く待たせない。
+  3. `--hourly-retention-days` より古い時間別集計を削除する（日別集計は残す）。
+  4. 実行前後のテーブル・インデックスのサイズを表示する。削除で空いたページは
+     SQLite の空きページとして再利用される。ファイル自体を縮めたい場合は `--vacuum`
+     （DB 全体をロックするので利用の少ない時間帯に）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+from db import DB_PATH, ConnectionManager, apply_migrations
+
+ROLLUP_JOB = "submission_attempts"
+
+# サイズを報告するテーブルとインデックス
+SIZE_REPORT_OBJECTS = [
+    "submission_attempts",
+    "idx_submission_attempts_author_created_at",
+    "submission_attempts_hourly",
+    "submission_attempts_daily",
+]
+
+KIND_SQL = "CASE WHEN author_display_name LIKE 'HONEYPOT:%' THEN 'honeypot' ELSE 'post' END"
+# honeypot の記録は入力値そのものなので集計キーにしない
+AUTHOR_SQL = "CASE WHEN author_display_name LIKE 'HONEYPOT:%' THEN '' ELSE COALESCE(author_display_name, '') END"
+
+
+def size_report(conn: sqlite3.Connection) -> dict[str, tuple[int, int]]:
+    """オブジェクト名 -> (バイト数, 行数)。dbstat が使えない SQLite ではバイト数を -1 にする。"""
+    report: dict[str, tuple[int, int]] = {}
+    sizes: dict[str, int] = {}
+    try:
+        placeholders = ", ".join(["?"] * len(SIZE_REPORT_OBJECTS))
+        sizes = dict(
+            conn.execute(
+                f"SELECT name, SUM(pgsize) FROM dbstat WHERE name IN ({placeholders}) GROUP BY name",
+                SIZE_REPORT_OBJECTS,
+            ).fetchall()
+        )
+    except sqlite3.OperationalError:
+        sizes = {}
+    for name in SIZE_REPORT_OBJECTS:
+        rows = -1
+        if not name.startswith("idx_"):
+            rows = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        report[name] = (sizes.get(name, -1), rows)
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    report["(free pages)"] = (freelist * page_size, -1)
+    return report
+
+
+def print_size_report(before: dict[str, tuple[int, int]], after: dict[str, tuple[int, int]]) -> None:
+    print(f"{'object':<44} {'bytes before':>13} {'bytes after':>13} {'rows before':>12} {'rows after':>12}")
+    for name in before:
+        b_bytes, b_rows = before[name]
+        a_bytes, a_rows = after.get(name, (-1, -1))
+        fmt = lambda v: "-" if v < 0 else f"{v:,}"  # noqa: E731
+        print(f"{name:<44} {fmt(b_bytes):>13} {fmt(a_bytes):>13} {fmt(b_rows):>12} {fmt(a_rows):>12}")
+
+
+def rollup_attempts(manager: ConnectionManager, batch_size: int, pause: float) -> int:
+    """未集計の行を集計テーブルへ加算し、集計した行数を返す。"""
+    total = 0
+    while True:
+        with manager.writer() as conn:
+            row = conn.execute("SELECT last_id FROM rollup_checkpoints WHERE job = ?", (ROLLUP_JOB,)).fetchone()
+            low = row[0] if row else 0
+            high, count = conn.execute(
+                "SELECT MAX(id), COUNT(*) FROM"
+                " (SELECT id FROM submission_attempts WHERE id > ? ORDER BY id LIMIT ?)",
+                (low, batch_size),
+            ).fetchone()
+            if not count:
+                return total
+            for table, bucket in (
+                ("submission_attempts_hourly", "strftime('%Y-%m-%d %H:00:00', created_at)"),
+                ("submission_attempts_daily", "date(created_at)"),
+            ):
+                column = "hour" if table.endswith("hourly") else "day"
+                conn.execute(
+                    f"""
+                    INSERT INTO {table} ({column}, kind, author_display_name, attempts)
+                    SELECT {bucket}, {KIND_SQL}, {AUTHOR_SQL}, COUNT(*)
+                    FROM submission_attempts
+                    WHERE id > ? AND id <= ?
+                    GROUP BY 1, 2, 3
+                    ON CONFLICT ({column}, kind, author_display_name)
+                    DO UPDATE SET attempts = attempts + excluded.attempts
+                    """,
+                    (low, high),
+                )
+            conn.execute(
+                """
+                INSERT INTO rollup_checkpoints (job, last_id) VALUES (?, ?)
+                ON CONFLICT (job) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+                """,
+                (ROLLUP_JOB, high),
+            )
+        total += count
+        time.sleep(pause)
+
+
+def purge_attempts(manager: ConnectionManager, retention_days: float, batch_size: int, pause: float) -> int:
+    """集計済みで保持期間を過ぎた生の行を削除し、削除した行数を返す。"""
+    with manager.reader() as conn:
+        row = conn.execute("SELECT last_id FROM rollup_checkpoints WHERE job = ?", (ROLLUP_JOB,)).fetchone()
+        rolled = row[0] if row else 0
+        # id は記録順に増えるので、保持期間内の最初の行より前がすべて削除対象になる
+        first_kept = conn.execute(
+            "SELECT id FROM submission_attempts WHERE created_at >= datetime('now', ?) ORDER BY id LIMIT 1",
+            (f"-{retention_days} days",),
+        ).fetchone()
+    boundary = rolled + 1 if first_kept is None else min(first_kept[0], rolled + 1)
+
+    total = 0
+    while True:
+        with manager.writer() as conn:
+            deleted = conn.execute(
+                "DELETE FROM submission_attempts WHERE id IN"
+                " (SELECT id FROM submission_attempts WHERE id < ? ORDER BY id LIMIT ?)",
+                (boundary, batch_size),
+            ).rowcount
+        total += deleted
+        if deleted < batch_size:
+            return total
+        time.sleep(pause)
+
+
+def purge_hourly(manager: ConnectionManager, retention_days: float) -> int:
+    with manager.writer() as conn:
+        return conn.execute(
+            "DELETE FROM submission_attempts_hourly WHERE hour < strftime('%Y-%m-%d %H:00:00', 'now', ?)",
+            (f"-{retention_days} days",),
+        ).rowcount
+
+
+def maintain_submission_attempts(
+    manager: ConnectionManager,
+    retention_days: float,
+    hourly_retention_days: float,
+    batch_size: int,
+    pause: float,
+    vacuum: bool,
+) -> None:
+    with manager.reader() as conn:
+        before = size_report(conn)
+    started = time.perf_counter()
+    rolled = rollup_attempts(manager, batch_size, pause)
+    purged = purge_attempts(manager, retention_days, batch_size, pause)
+    hourly = purge_hourly(manager, hourly_retention_days)
+    if vacuum:
+        with manager.writer() as conn:
+            conn.execute("VACUUM")
+    with manager.reader() as conn:
+        after = size_report(conn)
+    print(
+        f"rolled up {rolled} attempts, deleted {purged} raw rows and {hourly} hourly rows"
+        f" in {time.perf_counter() - started:.2f}s"
+    )
+    print_size_report(before, after)
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="DB の定期メンテナンス")
+    parser.add_argument("--db", type=Path, default=DB_PATH, help="対象の SQLite ファイル")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_attempts = sub.add_parser(
+        "submission-attempts", help="submission_attempts の集計・古い行の削除・サイズ報告"
+    )
+    p_attempts.add_argument("--retention-days", type=float, default=30.0, help="生の行を残す日数")
+    p_attempts.add_argument(
+        "--hourly-retention-days", type=float, default=90.0, help="時間別集計を残す日数"
+    )
+    p_attempts.add_argument("--batch-size", type=int, default=1000)
+    p_attempts.add_argument("--pause-ms", type=float, default=20.0, help="バッチ間の待ち時間")
+    p_attempts.add_argument("--vacuum", action="store_true", help="最後に VACUUM してファイルを縮める")
+
+    args = parser.parse_args(list(argv) if argv is not None else None)
+    manager = ConnectionManager(args.db)
+    try:
+        apply_migrations(manager)
+        maintain_submission_attempts(
+            manager,
+            args.retention_days,
+            args.hourly_retention_days,
+            max(1, args.batch_size),
+            max(0.0, args.pause_ms) / 1000,
+            args.vacuum,
+        )
+    finally:
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,8 +1,15 @@
--- Add is_public column to dishes table. Create a new table and copy data to avoid ALTER TABLE errors.
-BEGIN TRANSACTION;
+"""Add is_public column to dishes table. Create a new table and copy data to avoid ALTER TABLE errors.
 
--- Create a new table with the extra is_public column
-CREATE TABLE IF NOT EXISTS dishes_new (
+コピーは `db.run_table_rebuild()` がキー順のバッチで行う（アプリ稼働中でも実行できる）。
+"""
+
+from db import TableRebuild
+
+REBUILD = TableRebuild(
+    table="dishes",
+    # Create a new table with the extra is_public column
+    create_sql="""
+CREATE TABLE dishes_new (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL DEFAULT '',
     date TEXT NOT NULL DEFAULT (datetime('now')),
@@ -18,20 +25,14 @@ CREATE TABLE IF NOT EXISTS dishes_new (
     created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
     updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
-
--- Copy existing data if any (map columns)
-INSERT OR IGNORE INTO dishes_new (
-    id, name, date, photo_path, recipe_url, memo_user, ai_summary, ai_tips, ingredients_json, tags, favorite, created_at, updated_at
-)
-SELECT
-    id, name, date, photo_path, recipe_url, memo_user, ai_summary, ai_tips, ingredients_json, tags, favorite, created_at, updated_at
-FROM dishes;
-
--- Replace old table
-DROP TABLE IF EXISTS dishes;
-ALTER TABLE dishes_new RENAME TO dishes;
-
--- Recreate trigger for updated_at
+""",
+    # Copy existing data (is_public takes its default)
+    columns=(
+        "id", "name", "date", "photo_path", "recipe_url", "memo_user", "ai_summary", "ai_tips",
+        "ingredients_json", "tags", "favorite", "created_at", "updated_at",
+    ),
+    # Recreate trigger for updated_at
+    after_sql="""
 CREATE TRIGGER IF NOT EXISTS dishes_set_updated_at
 AFTER UPDATE ON dishes
 FOR EACH ROW
@@ -40,5 +41,5 @@ BEGIN
     SET updated_at = CURRENT_TIMESTAMP
     WHERE id = NEW.id;
 END;
-
-COMMIT;
+""",
+)
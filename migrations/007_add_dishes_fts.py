@@ -0,0 +1,82 @@
+"""v0.7: キーワード検索用の FTS5 インデックス（dishes_fts）を追加する。
+
+- trigram トークナイザを使うので、分かち書きの無い日本語でも部分一致で検索できる
+  （大文字小文字は区別しない。3 文字未満のキーワードはアプリ側で LIKE にフォールバック）。
+- `content='dishes'` の外部コンテンツテーブルにして本文を二重に持たない。
+- 既存行はトリガー作成時点の最大 id までを `BACKFILL_BATCH_SIZE` 件ずつ投入し、
+  バッチごとに commit して書き込みロックを長く握らない。トリガー作成後に追加された行は
+  トリガー側で索引されるため二重登録にならない。
+- 途中で中断された場合は schema_migrations に記録されないので、次回起動時に
+  テーブルを作り直して最初からやり直す。
+"""
+
+from __future__ import annotations
+
+import sqlite3
+
+BACKFILL_BATCH_SIZE = 2000
+
+SCHEMA_SQL = """
+BEGIN IMMEDIATE;
+
+DROP TABLE IF EXISTS dishes_fts;
+
+CREATE VIRTUAL TABLE dishes_fts USING fts5(
+    name,
+    memo_user,
+    tags,
+    recipe_url,
+    content='dishes',
+    content_rowid='id',
+    tokenize='trigram'
+);
+
+DROP TRIGGER IF EXISTS dishes_fts_ai;
+CREATE TRIGGER dishes_fts_ai AFTER INSERT ON dishes BEGIN
+    INSERT INTO dishes_fts (rowid, name, memo_user, tags, recipe_url)
+    VALUES (new.id, new.name, new.memo_user, new.tags, new.recipe_url);
+END;
+
+DROP TRIGGER IF EXISTS dishes_fts_ad;
+CREATE TRIGGER dishes_fts_ad AFTER DELETE ON dishes BEGIN
+    INSERT INTO dishes_fts (dishes_fts, rowid, name, memo_user, tags, recipe_url)
+    VALUES ('delete', old.id, old.name, old.memo_user, old.tags, old.recipe_url);
+END;
+
+DROP TRIGGER IF EXISTS dishes_fts_au;
+CREATE TRIGGER dishes_fts_au AFTER UPDATE OF name, memo_user, tags, recipe_url ON dishes BEGIN
+    INSERT INTO dishes_fts (dishes_fts, rowid, name, memo_user, tags, recipe_url)
+    VALUES ('delete', old.id, old.name, old.memo_user, old.tags, old.recipe_url);
+    INSERT INTO dishes_fts (rowid, name, memo_user, tags, recipe_url)
+    VALUES (new.id, new.name, new.memo_user, new.tags, new.recipe_url);
+END;
+"""
+
+
+def upgrade(conn: sqlite3.Connection) -> None:
+    # テーブル・トリガー作成と最大 id の取得を 1 トランザクションで行う
+    # （SCHEMA_SQL は BEGIN IMMEDIATE で始まり、commit はここで行う）
+    conn.executescript(SCHEMA_SQL)
+    high_water = conn.execute("SELECT COALESCE(MAX(id), 0) FROM dishes").fetchone()[0]
+    conn.commit()
+
+    last_id = 0
+    while last_id < high_water:
+        rows = conn.execute(
+            """
+            SELECT id, name, memo_user, tags, recipe_url
+            FROM dishes
+            WHERE id > ? AND id <= ?
+            ORDER BY id
+            LIMIT ?
+            """,
+            (last_id, high_water, BACKFILL_BATCH_SIZE),
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            "INSERT INTO dishes_fts (rowid, name, memo_user, tags, recipe_url) VALUES (?, ?, ?, ?, ?)",
+            [tuple(r) for r in rows],
+        )
+        conn.commit()
+        last_id = rows[-1][0]
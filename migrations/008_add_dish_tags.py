@@ -0,0 +1,76 @@
+"""v0.8: カンマ区切りの dishes.tags を正規化した tags / dish_tags テーブルを追加する。
+
+- `tags.name` は NOCASE の UNIQUE（最初に登録された表記を保持）。
+- `tags.usage_count` は dish_tags のトリガーで増減させ、タグ一覧を 1 クエリで返せるようにする。
+- dishes.tags（表示・FTS 用の文字列）はそのまま残す。
+- 既存行は `BACKFILL_BATCH_SIZE` 件ずつ取り込む。INSERT OR IGNORE なので途中で中断しても
+  再実行で続きから埋まり、アプリが並行して書き込んだ行とも重複しない。
+"""
+
+from __future__ import annotations
+
+import sqlite3
+
+BACKFILL_BATCH_SIZE = 2000
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL COLLATE NOCASE UNIQUE,
+    usage_count INTEGER NOT NULL DEFAULT 0
+);
+
+-- タグ一覧（使用中のみ・名前順）をインデックスだけで返す
+CREATE INDEX IF NOT EXISTS idx_tags_in_use ON tags (name, usage_count) WHERE usage_count > 0;
+
+-- (tag_id, dish_id) の主キーでタグ → 料理の完全一致検索を行う
+CREATE TABLE IF NOT EXISTS dish_tags (
+    tag_id INTEGER NOT NULL REFERENCES tags (id),
+    dish_id INTEGER NOT NULL REFERENCES dishes (id),
+    PRIMARY KEY (tag_id, dish_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_dish_tags_dish_id ON dish_tags (dish_id, tag_id);
+
+CREATE TRIGGER IF NOT EXISTS dish_tags_usage_ai AFTER INSERT ON dish_tags BEGIN
+    UPDATE tags SET usage_count = usage_count + 1 WHERE id = new.tag_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS dish_tags_usage_ad AFTER DELETE ON dish_tags BEGIN
+    UPDATE tags SET usage_count = usage_count - 1 WHERE id = old.tag_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS dishes_dish_tags_ad AFTER DELETE ON dishes BEGIN
+    DELETE FROM dish_tags WHERE dish_id = old.id;
+END;
+"""
+
+
+def _split_tags(tags_field: str | None) -> list[str]:
+    if not tags_field:
+        return []
+    return [t.strip() for t in tags_field.split(",") if t.strip()]
+
+
+def upgrade(conn: sqlite3.Connection) -> None:
+    conn.executescript(SCHEMA_SQL)
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, tags FROM dishes WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, BACKFILL_BATCH_SIZE),
+        ).fetchall()
+        if not rows:
+            break
+        pairs = [(dish_id, tag) for dish_id, tags in rows for tag in _split_tags(tags)]
+        conn.executemany(
+            "INSERT INTO tags (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+            [(tag,) for _, tag in pairs],
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO dish_tags (tag_id, dish_id) SELECT id, ? FROM tags WHERE name = ?",
+            pairs,
+        )
+        conn.commit()
+        last_id = rows[-1][0]
@@ -0,0 +1,15 @@
+-- v0.9: 一覧・ギャラリーのキーセットページング（created_at, id の降順）用インデックス
+-- id は rowid なので、(created_at) のインデックスは (created_at, id) の順に並ぶ。
+-- 003 で dishes を作り直した際に 002 のインデックスは消えているため作り直す。
+
+CREATE INDEX IF NOT EXISTS idx_dishes_created_at
+    ON dishes (created_at);
+
+-- 公開ギャラリー（is_public = 1）専用の部分インデックス
+CREATE INDEX IF NOT EXISTS idx_dishes_public_created_at
+    ON dishes (created_at)
+    WHERE is_public = 1;
+
+-- 「お気に入りのみ」フィルタ用
+CREATE INDEX IF NOT EXISTS idx_dishes_favorite_created_at
+    ON dishes (favorite, created_at);
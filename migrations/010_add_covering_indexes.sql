@@ -0,0 +1,18 @@
+-- v0.10: 本番クエリがすべてインデックスで解決できるようにするための追加インデックス
+-- scripts/check_query_plans.py で全クエリのプランを検査している。
+
+-- プロフィール（owner_id の新着順 + name）と 24 時間レート制限の COUNT(*) を
+-- どちらもこのインデックスだけで返す。owner_id 単独のインデックスは前方一致で代替できる
+CREATE INDEX IF NOT EXISTS idx_dishes_owner_created_at
+    ON dishes (owner_id, created_at, name);
+DROP INDEX IF EXISTS idx_dishes_owner_id;
+
+-- タグ別の新着順一覧: dish_tags に作成日時を持たせ (tag_id, created_at, dish_id) で範囲検索する
+ALTER TABLE dish_tags ADD COLUMN created_at TEXT;
+UPDATE dish_tags
+SET created_at = (SELECT created_at FROM dishes WHERE dishes.id = dish_tags.dish_id);
+CREATE INDEX IF NOT EXISTS idx_dish_tags_tag_created_at
+    ON dish_tags (tag_id, created_at, dish_id);
+
+-- users.username は UNIQUE 制約の自動インデックスがあるため重複
+DROP INDEX IF EXISTS idx_users_username;
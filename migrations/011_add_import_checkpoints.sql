@@ -0,0 +1,9 @@
+-- v0.11: dish_io.py の一括インポートの進捗（再開用）
+-- バッチの INSERT と同じトランザクションで records_done を更新するので、
+-- 中断しても同じレコードを二重に取り込まない。
+
+CREATE TABLE IF NOT EXISTS import_checkpoints (
+    source TEXT PRIMARY KEY,
+    records_done INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
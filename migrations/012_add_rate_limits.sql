@@ -0,0 +1,15 @@
+-- v0.12: rate_limit.py のスライディングウィンドウ・カウンタの永続化
+-- (action, key) ごとに「現在の窓」と「1 つ前の窓」の件数だけを持つので、
+-- 投稿数や試行回数が増えても 1 行のまま。expires_at を過ぎた行は不要になる。
+
+CREATE TABLE IF NOT EXISTS rate_limits (
+    action TEXT NOT NULL,
+    key TEXT NOT NULL,
+    window_start REAL NOT NULL,
+    current_count INTEGER NOT NULL DEFAULT 0,
+    previous_count INTEGER NOT NULL DEFAULT 0,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (action, key)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_rate_limits_expires_at ON rate_limits(expires_at);
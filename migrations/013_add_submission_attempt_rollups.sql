@@ -0,0 +1,26 @@
+-- v0.13: submission_attempts の集計テーブル（maintenance.py が書き込む）
+-- 生の試行ログは保持期間を過ぎたら削除し、件数だけを時間別・日別に残す。
+-- kind は 'honeypot'（HONEYPOT: で始まる記録）か 'post'。表示名が無い記録は '' にまとめる。
+
+CREATE TABLE IF NOT EXISTS submission_attempts_hourly (
+    hour TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    author_display_name TEXT NOT NULL DEFAULT '',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, kind, author_display_name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS submission_attempts_daily (
+    day TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    author_display_name TEXT NOT NULL DEFAULT '',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, kind, author_display_name)
+) WITHOUT ROWID;
+
+-- 集計済みの submission_attempts.id の上限（ジョブ名ごと）。中断しても二重に数えない
+CREATE TABLE IF NOT EXISTS rollup_checkpoints (
+    job TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,13 @@
+-- v0.14: rate_limit.LoginThrottle の連続失敗カウンタの永続化
+-- キー（name:<ユーザー名> / ip:<IP>）ごとに 1 行。last_failure_at から reset_after 秒
+-- 失敗が無ければ不要になる（expires_at を過ぎた行は flush 時に削除）。
+
+CREATE TABLE IF NOT EXISTS login_failures (
+    key TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL DEFAULT 0,
+    blocked_until REAL NOT NULL DEFAULT 0,
+    last_failure_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_login_failures_expires_at ON login_failures(expires_at);
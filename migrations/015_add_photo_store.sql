@@ -0,0 +1,16 @@
+-- v0.15: 写真のコンテンツアドレス保存（photo_store.py）
+-- 写真は内容の SHA-256 で決まる data/photos/<2 桁>/<2 桁>/<hash>.<ext> に 1 つだけ置き、
+-- dishes.photo_hash で参照する。photo_blobs.refcount はその写真を参照している料理の数。
+-- 既存の写真は `python photo_store.py migrate` で移すまで photo_hash が NULL のまま。
+
+ALTER TABLE dishes ADD COLUMN photo_hash TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_dishes_photo_hash ON dishes(photo_hash);
+
+CREATE TABLE IF NOT EXISTS photo_blobs (
+    hash TEXT PRIMARY KEY,
+    suffix TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
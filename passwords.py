@@ -0,0 +1,508 @@
+"""パスワードのハッシュ化・検証をプロセスプールで行うサービス。
+
+argon2 はメモリを大量に使う（既定 64 MiB / 回）ため、ログインや登録が集中すると
+Streamlit のスクリプトスレッドが塞がり、メモリも「同時実行数 × memory_cost」まで膨らむ。
+`PasswordHasher` はハッシュ計算を少数のワーカープロセスに任せ、同時に計算する数を
+`PASSWORD_HASH_WORKERS` に制限する。空きを `PASSWORD_HASH_QUEUE_TIMEOUT` 秒待っても
+順番が来なければ `HashingBusyError` を送出するので、呼び出し側は「混雑中」と表示できる。
+ワーカープロセスが落ちたときはプールを作り直して 1 回だけやり直し、それでも計算できなければ
+その派生の `HashingUnavailableError` を送出する。
+
+argon2 のパラメータは `ARGON2_MEMORY_COST`（KiB）/ `ARGON2_TIME_COST` /
+`ARGON2_PARALLELISM` で変更できる。配備先のマシンで
+
+    python passwords.py calibrate --target-ms 250 --memory-budget-mib 256
+
+を実行すると、目標の所要時間とメモリ予算（ワーカー数 × memory_cost）に収まる値を測って表示する。
+パラメータを変えても既存のハッシュはそのまま検証でき、次回ログイン時に新しい値で作り直される。
+
+作り直しはログインの応答を待たせないよう `RehashQueue` のバックグラウンドスレッドで行い、
+結果はまとめて 1 トランザクションで `users` に書き戻す。`PASSWORD_UPGRADE_PBKDF2=1` にすると
+古い pbkdf2_sha256 のハッシュも作り直しの対象になり、各ユーザーの次回ログイン時に順次
+argon2 へ移行する（平文が無いと作り直せないため、ログインを待つ必要がある）。進み具合は
+
+    python passwords.py upgrade-status
+
+で確認できる。
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Optional, TypeVar
+
+from passlib.context import CryptContext
+
+from app_logging import get_logger, log_event
+from db import DB_PATH, ConnectionManager, _env_float, _env_int, run_write
+
+logger = get_logger("passwords")
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class HashSettings:
+    """argon2 / pbkdf2 のパラメータ（ワーカープロセスへ渡せるよう単純な値だけを持つ）。"""
+
+    memory_cost: int = 65536  # KiB
+    time_cost: int = 2
+    parallelism: int = 4
+    pbkdf2_rounds: int = 29000
+    # True なら pbkdf2_sha256 を非推奨にし、ログイン時に argon2 へ作り直す
+    upgrade_pbkdf2: bool = False
+
+    @classmethod
+    def from_env(cls) -> "HashSettings":
+        default = cls()
+        return cls(
+            memory_cost=max(8, _env_int("ARGON2_MEMORY_COST", default.memory_cost)),
+            time_cost=max(1, _env_int("ARGON2_TIME_COST", default.time_cost)),
+            parallelism=max(1, _env_int("ARGON2_PARALLELISM", default.parallelism)),
+            upgrade_pbkdf2=_env_int("PASSWORD_UPGRADE_PBKDF2", 0) != 0,
+        )
+
+    def build_context(self) -> CryptContext:
+        # Password hashing context: prefer argon2, keep pbkdf2_sha256 for existing hashes
+        return CryptContext(
+            schemes=["argon2", "pbkdf2_sha256"],
+            default="argon2",
+            deprecated=["pbkdf2_sha256"] if self.upgrade_pbkdf2 else [],
+            pbkdf2_sha256__rounds=self.pbkdf2_rounds,
+            argon2__memory_cost=self.memory_cost,
+            argon2__time_cost=self.time_cost,
+            argon2__parallelism=self.parallelism,
+        )
+
+
+class HashingBusyError(RuntimeError):
+    """ハッシュ計算の空きを待つ時間が queue_timeout を超えた。"""
+
+
+class HashingUnavailableError(HashingBusyError):
+    """ワーカープロセスが落ち、作り直したプロセスプールでも計算できなかった。
+
+    `HashingBusyError` の一種なので、呼び出し側は「混雑中」と同じように扱える
+    （パスワードの不一致として扱ってはいけない）。
+    """
+
+
+# ワーカープロセス側の CryptContext（initializer で 1 回だけ作る）
+_worker_ctx: Optional[CryptContext] = None
+
+
+def _init_worker(settings: HashSettings) -> None:
+    global _worker_ctx
+    _worker_ctx = settings.build_context()
+
+
+def _worker_hash(password: str) -> str:
+    return _worker_ctx.hash(password)
+
+
+def _worker_verify(password: str, hashed: str) -> bool:
+    try:
+        return _worker_ctx.verify(password, hashed)
+    except (ValueError, TypeError):
+        # 壊れたハッシュや未知の形式は「不一致」として扱う
+        return False
+
+
+class _InlineExecutor(Executor):
+    """`workers=0` 用。呼び出し元のスレッドでそのまま実行する（テストや 1 CPU 環境向け）。"""
+
+    def __init__(self, settings: HashSettings) -> None:
+        _init_worker(settings)
+
+    def submit(self, fn, /, *args, **kwargs):  # type: ignore[override]
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:  # noqa: BLE001 - 呼び出し元に返す
+            future.set_exception(exc)
+        return future
+
+
+class PasswordHasher:
+    """同時実行数を制限したパスワードハッシュ・サービス。
+
+    - `workers`: 同時に計算するプロセス数（= 同時に使う argon2 メモリの上限の係数）。
+      0 なら呼び出し元スレッドで計算する（同時実行数は 1 に制限される）。
+    - `queue_timeout`: 空きを待つ最大秒数。超えたら `HashingBusyError`。
+    """
+
+    def __init__(
+        self,
+        settings: Optional[HashSettings] = None,
+        workers: int = 2,
+        queue_timeout: float = 5.0,
+    ) -> None:
+        self.settings = settings or HashSettings.from_env()
+        self.workers = max(0, workers)
+        self.queue_timeout = queue_timeout
+        # needs_update / identify はハッシュ計算をしないので呼び出し元で判定する
+        self.context = self.settings.build_context()
+        self._slots = threading.BoundedSemaphore(max(1, self.workers))
+        self._executor: Optional[Executor] = None
+        self._executor_lock = threading.Lock()
+        # 空きを待ちきれずに断った回数
+        self.rejected = 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    if self.workers == 0:
+                        self._executor = _InlineExecutor(self.settings)
+                    else:
+                        # Streamlit のスレッドを抱えたプロセスを fork しないよう spawn で起動する
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.workers,
+                            mp_context=multiprocessing.get_context("spawn"),
+                            initializer=_init_worker,
+                            initargs=(self.settings,),
+                        )
+        return self._executor
+
+    def _run(self, fn: Callable[..., T], *args, timeout: Optional[float] = None) -> T:
+        if not self._slots.acquire(timeout=self.queue_timeout if timeout is None else timeout):
+            with self._executor_lock:
+                self.rejected += 1
+            raise HashingBusyError("password hashing is saturated")
+        try:
+            # ワーカーが落ちる（OOM など）とプールは以後ずっと BrokenProcessPool を返すので、
+            # 作り直して 1 回だけやり直す（ハッシュも検証も同じ入力なら何度実行しても同じ結果）
+            for attempt in (1, 2):
+                executor = self._get_executor()
+                try:
+                    return executor.submit(fn, *args).result()
+                except BrokenProcessPool:
+                    self._discard_executor(executor)
+                    log_event(logger, logging.WARNING, "hash_pool_broken", attempt=attempt)
+            raise HashingUnavailableError("password hashing worker pool is unavailable")
+        finally:
+            self._slots.release()
+
+    def _discard_executor(self, executor: Executor) -> None:
+        """壊れたプールを捨てる（次の `_get_executor()` で作り直される）。"""
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password: str) -> str:
+        return self._run(_worker_hash, password)
+
+    def try_hash(self, password: str) -> Optional[str]:
+        """空きがあるときだけハッシュする（バックグラウンド処理用）。空きが無ければ None。
+
+        プールが作り直しても使えない場合の `HashingUnavailableError` はそのまま送出する
+        （待っても空かないので、None にすると呼び出し側が待ち続ける）。
+        """
+        try:
+            return self._run(_worker_hash, password, timeout=0)
+        except HashingUnavailableError:
+            raise
+        except HashingBusyError:
+            return None
+
+    def verify(self, password: str, hashed: str) -> bool:
+        return self._run(_worker_verify, password, hashed)
+
+    def needs_update(self, hashed: str) -> bool:
+        try:
+            return self.context.needs_update(hashed)
+        except (ValueError, TypeError):
+            return False
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+_hasher: Optional[PasswordHasher] = None
+_hasher_lock = threading.Lock()
+
+
+def get_password_hasher() -> PasswordHasher:
+    """プロセス共通の `PasswordHasher` を返す（初回呼び出しで生成）。
+
+    `PASSWORD_HASH_WORKERS`（既定 2）と `PASSWORD_HASH_QUEUE_TIMEOUT`（秒、既定 5）で調整できる。
+    """
+    global _hasher
+    if _hasher is None:
+        with _hasher_lock:
+            if _hasher is None:
+                _hasher = PasswordHasher(
+                    workers=_env_int("PASSWORD_HASH_WORKERS", 2),
+                    queue_timeout=_env_float("PASSWORD_HASH_QUEUE_TIMEOUT", 5.0),
+                )
+    return _hasher
+
+
+# (user_id, 平文, 作り直す前のハッシュ)
+RehashItem = tuple[int, str, str]
+
+
+def store_rehashed(updates: list[tuple[int, str, str]]) -> int:
+    """(user_id, 新しいハッシュ, 古いハッシュ) をまとめて書き戻し、更新した行数を返す。
+
+    その間にパスワードが変わっていた行は古いハッシュが一致しないので上書きしない。
+    """
+
+    def _write(conn: sqlite3.Connection) -> int:
+        updated = 0
+        for uid, new_hash, old_hash in updates:
+            updated += conn.execute(
+                "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                (new_hash, uid, old_hash),
+            ).rowcount
+        return updated
+
+    return run_write(_write)
+
+
+class RehashQueue:
+    """ログイン成功時のハッシュ作り直しを引き受けるバックグラウンドキュー。
+
+    `enqueue()` はすぐに戻る。スレッドは溜まった依頼を最大 `batch_size` 件取り出し、
+    `PasswordHasher.try_hash()` でハッシュ計算の空きがあるときだけ計算する（空きが無ければ
+    `retry_delay` 秒待って最大 `max_retries` 回やり直し、それでも空かなければ捨てる）ので、
+    対話的なログインの検証を待たせない。
+    計算し終えた分は `store` でまとめて書き戻す。キューが満杯のときは依頼を捨てる
+    （次回ログイン時にまた依頼される）。平文はキューにある間だけメモリに残る。
+    """
+
+    def __init__(
+        self,
+        hasher: PasswordHasher,
+        store: Callable[[list[tuple[int, str, str]]], int] = store_rehashed,
+        maxsize: int = 1000,
+        batch_size: int = 50,
+        retry_delay: float = 0.2,
+        max_retries: int = 50,
+    ) -> None:
+        self.hasher = hasher
+        self.store = store
+        self.batch_size = max(1, batch_size)
+        self.retry_delay = retry_delay
+        self.max_retries = max(0, max_retries)
+        self._queue: "queue.Queue[Optional[RehashItem]]" = queue.Queue(maxsize=max(1, maxsize))
+        self._pending: set[int] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # 件数の記録（管理画面やベンチマーク用）
+        self.rehashed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def enqueue(self, user_id: int, password: str, old_hash: str) -> bool:
+        """作り直しを依頼する。受け付けなかった（重複・満杯）場合は False。"""
+        with self._lock:
+            if user_id in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((user_id, password, old_hash))
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._pending.add(user_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="password-rehash", daemon=True)
+                self._thread.start()
+        return True
+
+    def _next_batch(self) -> Optional[list[RehashItem]]:
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                nxt = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is None:
+                self._queue.put(None)
+                break
+            batch.append(nxt)
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            updates = []
+            for uid, password, old_hash in batch:
+                try:
+                    new_hash = self.hasher.try_hash(password)
+                    retries = 0
+                    while new_hash is None and retries < self.max_retries:
+                        time.sleep(self.retry_delay)
+                        retries += 1
+                        new_hash = self.hasher.try_hash(password)
+                    if new_hash is None:
+                        # 混雑が続いている。次回ログイン時にまた依頼される
+                        self.dropped += 1
+                        log_event(logger, logging.INFO, "rehash_dropped", uid=uid, retries=retries)
+                        continue
+                    updates.append((uid, new_hash, old_hash))
+                except Exception:  # noqa: BLE001 - ログインには影響させない
+                    self.failed += 1
+                    log_event(logger, logging.WARNING, "rehash_failed", uid=uid, exc_info=True)
+            try:
+                if updates:
+                    self.rehashed += self.store(updates)
+            except Exception:  # noqa: BLE001 - 次回ログイン時にまた依頼される
+                self.failed += len(updates)
+                log_event(logger, logging.WARNING, "rehash_store_failed", users=len(updates), exc_info=True)
+            finally:
+                with self._lock:
+                    self._pending.difference_update(uid for uid, _, _ in batch)
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        """溜まっている依頼を処理し終えるまで待ち、スレッドを止める。"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+
+_rehash_queue: Optional[RehashQueue] = None
+
+
+def get_rehash_queue() -> RehashQueue:
+    """プロセス共通の `RehashQueue` を返す（`PASSWORD_REHASH_QUEUE_SIZE` / `PASSWORD_REHASH_BATCH_SIZE` /
+    `PASSWORD_REHASH_MAX_RETRIES`）。"""
+    global _rehash_queue
+    if _rehash_queue is None:
+        hasher = get_password_hasher()
+        with _hasher_lock:
+            if _rehash_queue is None:
+                _rehash_queue = RehashQueue(
+                    hasher,
+                    maxsize=_env_int("PASSWORD_REHASH_QUEUE_SIZE", 1000),
+                    batch_size=_env_int("PASSWORD_REHASH_BATCH_SIZE", 50),
+                    max_retries=_env_int("PASSWORD_REHASH_MAX_RETRIES", 50),
+                )
+    return _rehash_queue
+
+
+def upgrade_status(manager: ConnectionManager, settings: HashSettings) -> dict[str, int]:
+    """ハッシュ形式ごとのユーザー数と、作り直しが必要な数（"needs_update"）を数える。"""
+    ctx = settings.build_context()
+    counts: dict[str, int] = {"needs_update": 0}
+    with manager.reader() as conn:
+        for (hashed,) in conn.execute("SELECT password_hash FROM users WHERE password_hash IS NOT NULL"):
+            try:
+                scheme = ctx.identify(hashed) or "unknown"
+                stale = ctx.needs_update(hashed)
+            except (ValueError, TypeError):
+                scheme, stale = "unknown", False
+            counts[scheme] = counts.get(scheme, 0) + 1
+            counts["needs_update"] += int(stale)
+    return counts
+
+
+def _time_hash(settings: HashSettings, repeat: int) -> float:
+    """`settings` で 1 回ハッシュするのにかかる秒数（repeat 回の中央値）。"""
+    ctx = settings.build_context()
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        ctx.hash("calibration-password")
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def calibrate(
+    target_ms: float,
+    memory_budget_mib: int,
+    workers: int,
+    parallelism: int,
+    repeat: int = 3,
+    max_time_cost: int = 10,
+) -> tuple[HashSettings, float]:
+    """メモリ予算に収まる最大の memory_cost を選び、目標時間に届く最小の time_cost を探す。
+
+    memory_cost は 2 のべき（MiB 単位）で `memory_budget_mib / workers` 以下。
+    time_cost=1 でも目標を超える場合は memory_cost を半分ずつ下げる（下限 8 MiB）。
+    戻り値は (選んだ設定, 実測ミリ秒)。
+    """
+    per_worker_mib = max(8, memory_budget_mib // max(1, workers))
+    memory_mib = 1 << (per_worker_mib.bit_length() - 1)
+    while True:
+        best: Optional[tuple[HashSettings, float]] = None
+        for time_cost in range(1, max_time_cost + 1):
+            settings = HashSettings(memory_cost=memory_mib * 1024, time_cost=time_cost, parallelism=parallelism)
+            elapsed_ms = _time_hash(settings, repeat) * 1000
+            print(f"  m={memory_mib:>4} MiB t={time_cost:<2} p={parallelism} -> {elapsed_ms:8.1f} ms")
+            best = (settings, elapsed_ms)
+            if elapsed_ms >= target_ms:
+                break
+        assert best is not None
+        # time_cost=1 でも大きく超える場合だけメモリを下げてやり直す
+        if best[0].time_cost > 1 or best[1] <= target_ms * 1.25 or memory_mib <= 8:
+            return best
+        memory_mib //= 2
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="パスワードハッシュの設定ツール")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_cal = sub.add_parser("calibrate", help="目標時間とメモリ予算に合う argon2 パラメータを探す")
+    p_cal.add_argument("--target-ms", type=float, default=250.0, help="1 回のハッシュにかけたい時間")
+    p_cal.add_argument(
+        "--memory-budget-mib", type=int, default=256, help="ハッシュ計算に使ってよいメモリの合計"
+    )
+    p_cal.add_argument(
+        "--workers", type=int, default=_env_int("PASSWORD_HASH_WORKERS", 2), help="同時に計算するプロセス数"
+    )
+    p_cal.add_argument("--parallelism", type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    p_cal.add_argument("--repeat", type=int, default=3)
+    p_status = sub.add_parser("upgrade-status", help="ハッシュ形式ごとのユーザー数と作り直し待ちの数を表示する")
+    p_status.add_argument("--db", type=Path, default=DB_PATH, help="対象の SQLite ファイル")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    if args.command == "upgrade-status":
+        manager = ConnectionManager(args.db)
+        try:
+            counts = upgrade_status(manager, HashSettings.from_env())
+        finally:
+            manager.close()
+        for scheme, count in counts.items():
+            print(f"{scheme:<16} {count:>8}")
+        return 0
+
+    workers = max(1, args.workers)
+    print(f"calibrating for target={args.target_ms:.0f}ms budget={args.memory_budget_mib}MiB workers={workers}")
+    settings, elapsed_ms = calibrate(
+        args.target_ms, args.memory_budget_mib, workers, max(1, args.parallelism), max(1, args.repeat)
+    )
+    peak_mib = settings.memory_cost // 1024 * workers
+    print(f"\nselected: {elapsed_ms:.1f} ms/hash, peak memory ~{peak_mib} MiB with {workers} workers")
+    print(f"ARGON2_MEMORY_COST={settings.memory_cost}")
+    print(f"ARGON2_TIME_COST={settings.time_cost}")
+    print(f"ARGON2_PARALLELISM={settings.parallelism}")
+    print(f"PASSWORD_HASH_WORKERS={workers}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,266 @@
+"""料理写真のコンテンツアドレス保存（同じ写真は 1 つだけ置き、参照数を数える）。
+
+写真の本体は内容の SHA-256 で決まる `data/photos/<2 桁>/<2 桁>/<hash>.jpg`
+（`storage.content_photo_path()`）に置き、縮小版（images.py）も同じディレクトリの
+`<hash>.w640.webp` などになる。同じ写真を何度アップロードしても保存されるのは 1 つだけ。
+
+- `dishes.photo_hash` が参照先のハッシュ、`dishes.photo_path` は保存先のパス
+  （表示側は従来どおり `photo_path` を読む）
+- `photo_blobs` にハッシュごとの拡張子・バイト数・参照している料理の数（refcount）を持つ
+- 参照の追加 `put_photo()` は、料理の行を書き換える書き込みトランザクションの中で呼ぶ
+  （参照数と料理の行が食い違わない）
+
+料理ごとのディレクトリ（`data/dishes/<id>/cover.jpg` など）に置かれた既存の写真は、
+次のコマンドでこの配置へ移し、重複を取り除ける:
+
+    python photo_store.py migrate [--dry-run]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import sqlite3
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+from db import DB_PATH, ConnectionManager, apply_migrations
+from images import existing_variants
+from storage import (
+    PHOTO_STORE_ROOT,
+    _sanitize_suffix,
+    commit_staged_upload,
+    content_photo_path,
+    hash_photo_file,
+)
+
+
+def put_photo(conn: sqlite3.Connection, staged: Path, photo_hash: str, suffix: str) -> tuple[Path, bool]:
+    """一時ファイルの写真への参照を 1 つ増やし、(保存先, 新しく置いたか) を返す。
+
+    同じ内容の写真が既に保存されていれば参照数を増やすだけで、`staged` はそのまま残る
+    （呼び出し元が消す）。初めての写真なら `staged` を保存先へ rename する。
+    書き込みトランザクションの中で呼ぶこと。
+    """
+    row = conn.execute("SELECT suffix FROM photo_blobs WHERE hash = ?", (photo_hash,)).fetchone()
+    if row is not None:
+        existing = content_photo_path(photo_hash, row[0])
+        if existing.exists():
+            conn.execute("UPDATE photo_blobs SET refcount = refcount + 1 WHERE hash = ?", (photo_hash,))
+            return existing, False
+    # 行だけ残ってファイルが無い場合も、ここで置き直す
+    destination = content_photo_path(photo_hash, suffix)
+    conn.execute(
+        """
+        INSERT INTO photo_blobs (hash, suffix, size, refcount) VALUES (?, ?, ?, 1)
+        ON CONFLICT (hash) DO UPDATE
+        SET suffix = excluded.suffix, size = excluded.size, refcount = refcount + 1
+        """,
+        (photo_hash, suffix, staged.stat().st_size),
+    )
+    # rename はメタデータの更新だけなので、トランザクション内で行っても他の書き込みを待たせない
+    commit_staged_upload(staged, destination)
+    return destination, True
+
+
+def _remove_photo_files(photo_path: Path) -> int:
+    """写真と縮小版を消し、消したバイト数を返す。空になったシャードのディレクトリも消す。"""
+    removed = 0
+    for path in [photo_path, *existing_variants(photo_path)]:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            removed += size
+        except FileNotFoundError:
+            continue
+    # 料理ごとのディレクトリ、またはシャードの 2 段を、空なら消す
+    directory = photo_path.parent
+    while directory != PHOTO_STORE_ROOT:
+        try:
+            directory.rmdir()
+        except OSError:
+            break
+        if PHOTO_STORE_ROOT not in directory.parents:
+            break
+        directory = directory.parent
+    return removed
+
+
+def discard_unreferenced_photo(conn: sqlite3.Connection, photo_hash: str, photo_path: Path) -> bool:
+    """`put_photo()` で置いた写真を、書き込みが失敗した後に片付ける。消したら True。
+
+    失敗した書き込みが rollback された後も、別の書き込み（同じバッチの別のリクエストや
+    別プロセス）が同じ写真を置き直して参照していることがあるので、`photo_blobs` に行が
+    無い場合だけ消す。
+    書き込みロックを持った状態（`run_write()` の中や `BEGIN IMMEDIATE` の後）で呼ぶこと。
+    """
+    if conn.execute("SELECT 1 FROM photo_blobs WHERE hash = ?", (photo_hash,)).fetchone() is not None:
+        return False
+    photo_path.unlink(missing_ok=True)
+    return True
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    """同じファイルシステムならハードリンク（コピー無し）、だめならコピーして置く。"""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        # 前回の移行が commit 前に中断した残り。内容はハッシュで決まるので同じもの
+        pass
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+@dataclass
+class MigrationReport:
+    dishes: int = 0  # 新しい配置に移した料理
+    stored: int = 0  # そのうち、初めての内容として置いた写真
+    deduplicated: int = 0  # そのうち、既に同じ内容が置かれていた写真
+    missing: int = 0  # photo_path のファイルが見つからなかった料理
+    bytes_reclaimed: int = 0  # 重複として消した写真・縮小版のバイト数
+
+    def summary(self) -> str:
+        return (
+            f"{self.dishes} dishes migrated: {self.stored} stored, {self.deduplicated} deduplicated, "
+            f"{self.missing} missing; reclaimed {self.bytes_reclaimed:,} bytes "
+            f"({self.bytes_reclaimed / 1024 / 1024:.1f} MiB)"
+        )
+
+
+def _rebuild_refcounts(conn: sqlite3.Connection) -> None:
+    """参照数を dishes から数え直す（移行の最後に、途中で中断した場合のずれも直す）。"""
+    conn.execute(
+        "UPDATE photo_blobs SET refcount = (SELECT COUNT(*) FROM dishes WHERE dishes.photo_hash = photo_blobs.hash)"
+    )
+
+
+def migrate(manager: ConnectionManager, dry_run: bool = False) -> MigrationReport:
+    """`photo_hash` の無い料理の写真を新しい配置へ移し、同じ内容の写真を 1 つにまとめる。
+
+    料理 1 件ずつ、新しい配置にハードリンク（またはコピー）を作ってから `dishes` と
+    `photo_blobs` を更新して commit し、その後で古いファイルを消す。途中で中断しても
+    古い写真を参照したままの料理は無く、再実行すれば続きから移す。
+    `dry_run` なら何も変更せず、移した場合の結果だけを数える。
+    """
+    report = MigrationReport()
+    with manager.reader() as conn:
+        rows = conn.execute(
+            "SELECT id, photo_path FROM dishes WHERE photo_path IS NOT NULL AND photo_hash IS NULL ORDER BY id"
+        ).fetchall()
+        known = {row[0] for row in conn.execute("SELECT hash FROM photo_blobs")}
+    # 同じファイルを複数の料理が指している場合は、最後の料理を移すまで消さない
+    remaining = Counter(raw_path for _, raw_path in rows)
+
+    for dish_id, raw_path in rows:
+        remaining[raw_path] -= 1
+        source = Path(raw_path)
+        if not source.is_file():
+            report.missing += 1
+            continue
+        photo_hash = hash_photo_file(source)
+        suffix = _sanitize_suffix(source.name)
+        variants = existing_variants(source)
+        duplicate = photo_hash in known
+        report.dishes += 1
+        if dry_run:
+            if duplicate:
+                report.deduplicated += 1
+                report.bytes_reclaimed += sum(p.stat().st_size for p in [source, *variants])
+            else:
+                report.stored += 1
+                known.add(photo_hash)
+            continue
+
+        with manager.writer() as conn:
+            row = conn.execute("SELECT suffix FROM photo_blobs WHERE hash = ?", (photo_hash,)).fetchone()
+            if row is not None and content_photo_path(photo_hash, row[0]).exists():
+                destination = content_photo_path(photo_hash, row[0])
+                conn.execute("UPDATE photo_blobs SET refcount = refcount + 1 WHERE hash = ?", (photo_hash,))
+                duplicate = True
+            else:
+                destination = content_photo_path(photo_hash, suffix)
+                _link_or_copy(source, destination)
+                # 縮小版も新しいファイル名（<hash>.w640.webp など）で引き継ぐ
+                for variant in variants:
+                    _link_or_copy(variant, destination.with_name(photo_hash + variant.name[len(source.stem):]))
+                conn.execute(
+                    """
+                    INSERT INTO photo_blobs (hash, suffix, size, refcount) VALUES (?, ?, ?, 1)
+                    ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1
+                    """,
+                    (photo_hash, suffix, destination.stat().st_size),
+                )
+                duplicate = False
+            conn.execute(
+                "UPDATE dishes SET photo_hash = ?, photo_path = ? WHERE id = ?",
+                (photo_hash, str(destination), dish_id),
+            )
+        known.add(photo_hash)
+
+        # commit 済みなので古いファイルはもう参照されていない
+        removed = 0
+        if not remaining[raw_path] and source.resolve() != destination.resolve():
+            # ハードリンクで移した写真を消しても、ディスクの空きは増えない
+            linked = os.path.samefile(source, destination)
+            removed = _remove_photo_files(source)
+            if linked:
+                removed = 0
+        if duplicate:
+            report.deduplicated += 1
+            report.bytes_reclaimed += removed
+        else:
+            report.stored += 1
+
+    if not dry_run:
+        with manager.writer() as conn:
+            _rebuild_refcounts(conn)
+    return report
+
+
+def usage(manager: ConnectionManager) -> dict[str, int]:
+    """保存している写真の数・バイト数と、料理からの参照数を返す。"""
+    with manager.reader() as conn:
+        blobs, size, refs = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0) FROM photo_blobs"
+        ).fetchone()
+        legacy = conn.execute(
+            "SELECT COUNT(*) FROM dishes WHERE photo_path IS NOT NULL AND photo_hash IS NULL"
+        ).fetchone()[0]
+    return {"blobs": blobs, "bytes": size, "references": refs, "legacy_dishes": legacy}
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="料理写真のコンテンツアドレス保存")
+    parser.add_argument("--db", type=Path, default=DB_PATH, help="対象の SQLite ファイル")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_migrate = sub.add_parser("migrate", help=f"既存の写真を {PHOTO_STORE_ROOT} へ移して重複をまとめる")
+    p_migrate.add_argument("--dry-run", action="store_true", help="変更せずに結果だけを表示する")
+    sub.add_parser("usage", help="保存している写真の数とバイト数を表示する")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    if not args.db.exists():
+        print(f"{args.db} がありません")
+        return 1
+    manager = ConnectionManager(args.db)
+    try:
+        apply_migrations(manager)
+        if args.command == "usage":
+            for key, value in usage(manager).items():
+                print(f"{key:<14} {value:>12,}")
+            return 0
+        started = time.perf_counter()
+        report = migrate(manager, dry_run=args.dry_run)
+        prefix = "[dry-run] " if args.dry_run else ""
+        print(f"{prefix}{report.summary()} in {time.perf_counter() - started:.1f}s")
+    finally:
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
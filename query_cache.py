@@ -0,0 +1,105 @@
+"""プロセス内で共有する読み取り結果キャッシュ（LRU + TTL）。
+
+Streamlit はセッション（ブラウザ）ごとにスクリプトを実行し直すが、このモジュールの
+インスタンスはプロセス全体で 1 つなので、別の訪問者が同じ条件で一覧を開いたときにも
+DB へ問い合わせずに結果を返せる。
+
+各エントリは作成時の「世代」（`ConnectionManager.data_version()` の値）を持ち、
+取得時の世代と異なれば DB が更新されたとみなして破棄する。
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from db import _env_float, _env_int
+
+
+class QueryCache:
+    """スレッドセーフな LRU + TTL キャッシュ。"""
+
+    def __init__(self, maxsize: int = 256, ttl_seconds: float = 30.0) -> None:
+        self.maxsize = max(1, maxsize)
+        self.ttl_seconds = ttl_seconds
+        # key -> (generation, 作成時刻, 値)
+        self._entries: "OrderedDict[Hashable, tuple[Hashable, float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_or_compute(self, key: Hashable, generation: Hashable, compute: Callable[[], Any]) -> Any:
+        """キャッシュ済みの値を返す。無い・期限切れ・世代違いなら `compute()` で作り直す。
+
+        `compute()` はロックの外で実行する（同時に同じキーを計算することはあり得るが、
+        DB 問い合わせ中に他のキーの取得を止めないことを優先する）。
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, created_at, value = entry
+                if entry_generation != generation:
+                    self.invalidations += 1
+                    del self._entries[key]
+                elif now - created_at > self.ttl_seconds:
+                    self.expirations += 1
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+
+        value = compute()
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """ヒット / ミス / 追い出しなどのカウンタを返す。"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+_shared: "QueryCache | None" = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache() -> QueryCache:
+    """プロセス共通の `QueryCache` を返す（初回呼び出しで生成）。
+
+    Streamlit はメインスクリプトを rerun のたびに実行し直すため、スクリプト側の
+    モジュール変数に置くと毎回作り直されてしまう。インポートされるこのモジュールに持たせる。
+    サイズと TTL は `QUERY_CACHE_MAXSIZE` / `QUERY_CACHE_TTL_SECONDS` で調整できる。
+    """
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = QueryCache(
+                    maxsize=_env_int("QUERY_CACHE_MAXSIZE", 256),
+                    ttl_seconds=_env_float("QUERY_CACHE_TTL_SECONDS", 30.0),
+                )
+    return _shared
@@ -0,0 +1,445 @@
+"""操作ごとのレート制限（スライディングウィンドウ・カウンタ）。
+
+投稿・ログイン・登録・Claim などの操作（action）ごとに「窓の長さ」と「上限回数」を決め、
+ユーザー id・表示名・IP アドレスなどのキーごとに回数を数える。
+
+各キーは「現在の固定窓の件数」と「1 つ前の固定窓の件数」だけを持ち、前の窓の件数を
+経過時間に応じて按分して直近 1 窓ぶんの件数を見積もる。判定は投稿数などに関係なく O(1) で、
+`dishes` を COUNT(*) する必要はない。
+
+カウンタはプロセス内のメモリに持ち、`rate_limits` テーブル（migrations/012）へ
+`RATE_LIMIT_FLUSH_SECONDS` ごとにまとめて書き出す。再起動後は初回参照時に
+テーブルから読み戻すので、セッションやプロセスが変わっても制限は引き継がれる。
+
+上限は `RATE_LIMIT_<ACTION>=回数/秒数`（例: `RATE_LIMIT_POST=20/86400`）で変更できる。
+
+`LoginThrottle` はログイン失敗専用で、ユーザー名・IP ごとの連続失敗回数に応じて
+指数的に長くなる待ち時間を課す。パスワード検証（argon2）の前に判定するので、
+リスト型攻撃を受けてもハッシュ計算の CPU とメモリを使わずに断れる。
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from db import ConnectionManager, _env_float, _env_int, get_manager
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """`window_seconds` 秒あたり `limit` 回まで。"""
+
+    limit: int
+    window_seconds: float
+
+    @classmethod
+    def parse(cls, value: str) -> "RateLimit":
+        """`"20/86400"` 形式の文字列を読む。"""
+        limit, _, window = value.partition("/")
+        return cls(limit=max(0, int(limit)), window_seconds=max(1.0, float(window)))
+
+
+DEFAULT_LIMITS: dict[str, RateLimit] = {
+    # 従来の「24 時間に 20 件まで」を引き継ぐ
+    "post": RateLimit(20, 24 * 3600),
+    "login": RateLimit(10, 5 * 60),
+    "register": RateLimit(5, 3600),
+    "claim": RateLimit(10, 3600),
+}
+
+
+def limits_from_env(defaults: Optional[dict[str, RateLimit]] = None) -> dict[str, RateLimit]:
+    """`RATE_LIMIT_<ACTION>` 環境変数で上書きした上限の一覧を返す。"""
+    limits = dict(DEFAULT_LIMITS if defaults is None else defaults)
+    for action in list(limits):
+        raw = os.environ.get(f"RATE_LIMIT_{action.upper()}")
+        if raw:
+            try:
+                limits[action] = RateLimit.parse(raw)
+            except ValueError:
+                pass
+    return limits
+
+
+@dataclass(frozen=True)
+class RateDecision:
+    """判定結果。拒否された場合は `key` に引っかかったキー、`retry_after` に待ち秒数が入る。"""
+
+    allowed: bool
+    retry_after: float = 0.0
+    key: Optional[str] = None
+
+
+class _Counter:
+    __slots__ = ("window_start", "current", "previous", "dirty")
+
+    def __init__(self, window_start: float, current: int = 0, previous: int = 0) -> None:
+        self.window_start = window_start
+        self.current = current
+        self.previous = previous
+        self.dirty = False
+
+    def roll(self, window_start: float, window: float) -> None:
+        """`window_start` の窓まで進める。"""
+        if window_start == self.window_start:
+            return
+        if window_start - self.window_start == window:
+            self.previous = self.current
+        else:
+            self.previous = 0
+        self.current = 0
+        self.window_start = window_start
+        self.dirty = True
+
+    def estimate(self, now: float, window: float) -> float:
+        weight = 1.0 - (now - self.window_start) / window
+        return self.previous * weight + self.current
+
+    def retry_after(self, now: float, window: float, limit: int) -> float:
+        """あと 1 回許可されるまでの秒数。"""
+        if self.current + 1 > limit or self.previous == 0:
+            return max(0.0, self.window_start + window - now)
+        # previous * (1 - (t - start) / window) + current + 1 <= limit を t について解く
+        t = self.window_start + window * (1.0 - (limit - self.current - 1) / self.previous)
+        return max(0.0, t - now)
+
+
+def client_keys(
+    user_id: Optional[int] = None,
+    display_name: Optional[str] = None,
+    ip: Optional[str] = None,
+) -> list[str]:
+    """制限に使うキーの一覧を作る（値のないものは含めない）。"""
+    keys = []
+    if user_id is not None:
+        keys.append(f"user:{user_id}")
+    if display_name:
+        keys.append(f"name:{display_name.strip().lower()}")
+    if ip:
+        keys.append(f"ip:{ip}")
+    return keys
+
+
+class RateLimiter:
+    """スレッドセーフなレート制限器。
+
+    `hit()` は指定したすべてのキーが上限内なら 1 回分を記録して許可し、どれか 1 つでも
+    上限に達していれば何も記録せずに拒否する。`check()` は記録せずに判定だけを行う。
+    """
+
+    def __init__(
+        self,
+        limits: Optional[dict[str, RateLimit]] = None,
+        manager: Optional[ConnectionManager] = None,
+        flush_interval: float = 5.0,
+        clock=time.time,
+    ) -> None:
+        self.limits = limits_from_env() if limits is None else dict(limits)
+        self._manager = manager
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._counters: dict[tuple[str, str], _Counter] = {}
+        self._lock = threading.Lock()
+        self._last_flush = clock()
+
+    @property
+    def manager(self) -> ConnectionManager:
+        return self._manager or get_manager()
+
+    def check(self, action: str, keys: Iterable[str]) -> RateDecision:
+        return self._decide(action, list(keys), consume=False)
+
+    def hit(self, action: str, keys: Iterable[str]) -> RateDecision:
+        decision = self._decide(action, list(keys), consume=True)
+        if self._clock() - self._last_flush >= self.flush_interval:
+            self.flush(wait=False)
+        return decision
+
+    def _decide(self, action: str, keys: list[str], consume: bool) -> RateDecision:
+        rule = self.limits.get(action)
+        if rule is None or not keys:
+            return RateDecision(True)
+        window = rule.window_seconds
+        # DB からの読み戻しはロックの外で済ませる
+        missing = [k for k in keys if (action, k) not in self._counters]
+        loaded = self._load(action, missing) if missing else {}
+
+        with self._lock:
+            now = self._clock()
+            window_start = math.floor(now / window) * window
+            counters = []
+            for key in keys:
+                counter = self._counters.get((action, key))
+                if counter is None:
+                    counter = loaded.get(key) or _Counter(window_start)
+                    self._counters[(action, key)] = counter
+                counter.roll(window_start, window)
+                if counter.estimate(now, window) + 1 > rule.limit:
+                    return RateDecision(False, counter.retry_after(now, window, rule.limit), key)
+                counters.append(counter)
+            if consume:
+                for counter in counters:
+                    counter.current += 1
+                    counter.dirty = True
+        return RateDecision(True)
+
+    def _load(self, action: str, keys: list[str]) -> dict[str, _Counter]:
+        placeholders = ", ".join(["?"] * len(keys))
+        try:
+            with self.manager.reader() as conn:
+                rows = conn.execute(
+                    "SELECT key, window_start, current_count, previous_count FROM rate_limits"
+                    f" WHERE action = ? AND key IN ({placeholders})",
+                    (action, *keys),
+                ).fetchall()
+        except sqlite3.OperationalError:
+            # マイグレーション未適用ならメモリ上だけで数える
+            return {}
+        return {row[0]: _Counter(row[1], row[2], row[3]) for row in rows}
+
+    def flush(self, wait: bool = True) -> int:
+        """変更のあったカウンタをテーブルに書き出し、期限切れの行とエントリを捨てる。
+
+        書き込みは書き込みスレッドに渡す。`wait=False` なら commit を待たずに戻る。
+        戻り値は書き出した行数。
+        """
+        with self._lock:
+            now = self._clock()
+            self._last_flush = now
+            rows = []
+            for (action, key), counter in list(self._counters.items()):
+                rule = self.limits.get(action)
+                window = rule.window_seconds if rule else 0.0
+                expires_at = counter.window_start + 2 * window
+                if counter.dirty:
+                    rows.append((action, key, counter.window_start, counter.current, counter.previous, expires_at))
+                    counter.dirty = False
+                if expires_at <= now:
+                    # 2 窓以上前のカウンタは判定に影響しない
+                    del self._counters[(action, key)]
+        if not rows:
+            return 0
+
+        def _write(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                """
+                INSERT INTO rate_limits (action, key, window_start, current_count, previous_count, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (action, key) DO UPDATE SET
+                    window_start = excluded.window_start,
+                    current_count = excluded.current_count,
+                    previous_count = excluded.previous_count,
+                    expires_at = excluded.expires_at
+                """,
+                rows,
+            )
+            conn.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+
+        future = self.manager.submit(_write)
+        if wait:
+            future.result()
+        return len(rows)
+
+
+class _FailureState:
+    __slots__ = ("failures", "blocked_until", "last_failure_at", "dirty")
+
+    def __init__(self, failures: int = 0, blocked_until: float = 0.0, last_failure_at: float = 0.0) -> None:
+        self.failures = failures
+        self.blocked_until = blocked_until
+        self.last_failure_at = last_failure_at
+        self.dirty = False
+
+
+class LoginThrottle:
+    """ログイン失敗に対する指数バックオフ。
+
+    キーごとに連続失敗回数を数え、`free_failures` 回を超えた失敗からは
+    `base_delay * 2 ** (超過回数 - 1)` 秒（最大 `max_delay` 秒）そのキーでのログインを断る。
+    最後の失敗から `reset_after` 秒経つか、ログインに成功すると回数は 0 に戻る。
+    状態は `RateLimiter` と同じくメモリに持ち、`login_failures` テーブル（migrations/014）へ
+    定期的に書き出す。
+    """
+
+    def __init__(
+        self,
+        free_failures: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 900.0,
+        reset_after: float = 3600.0,
+        manager: Optional[ConnectionManager] = None,
+        flush_interval: float = 5.0,
+        clock=time.time,
+    ) -> None:
+        self.free_failures = free_failures
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self._manager = manager
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._states: dict[str, _FailureState] = {}
+        self._lock = threading.Lock()
+        self._last_flush = clock()
+        self.rejected = 0
+
+    @property
+    def manager(self) -> ConnectionManager:
+        return self._manager or get_manager()
+
+    def _state(self, key: str, now: float, loaded: dict[str, _FailureState]) -> _FailureState:
+        state = self._states.get(key)
+        if state is None:
+            state = loaded.get(key) or _FailureState()
+            self._states[key] = state
+        if state.failures and now - state.last_failure_at >= self.reset_after:
+            state.failures = 0
+            state.blocked_until = 0.0
+            state.dirty = True
+        return state
+
+    def check(self, keys: Iterable[str]) -> RateDecision:
+        """いずれかのキーが待ち時間中なら拒否する。ハッシュ計算の前に呼ぶ。"""
+        keys = list(keys)
+        missing = [k for k in keys if k not in self._states]
+        loaded = self._load(missing) if missing else {}
+        with self._lock:
+            now = self._clock()
+            for key in keys:
+                state = self._state(key, now, loaded)
+                if state.blocked_until > now:
+                    self.rejected += 1
+                    return RateDecision(False, state.blocked_until - now, key)
+        return RateDecision(True)
+
+    def record_failure(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        missing = [k for k in keys if k not in self._states]
+        loaded = self._load(missing) if missing else {}
+        with self._lock:
+            now = self._clock()
+            for key in keys:
+                state = self._state(key, now, loaded)
+                state.failures += 1
+                state.last_failure_at = now
+                over = state.failures - self.free_failures
+                if over > 0:
+                    delay = min(self.max_delay, self.base_delay * (2 ** min(over - 1, 32)))
+                    state.blocked_until = max(state.blocked_until, now + delay)
+                state.dirty = True
+        self._maybe_flush()
+
+    def record_success(self, keys: Iterable[str]) -> None:
+        """ログイン成功。指定したキー（通常はユーザー名）の失敗回数を消す。"""
+        with self._lock:
+            for key in keys:
+                state = self._states.get(key)
+                if state is not None and state.failures:
+                    state.failures = 0
+                    state.blocked_until = 0.0
+                    state.dirty = True
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if self._clock() - self._last_flush >= self.flush_interval:
+            self.flush(wait=False)
+
+    def _load(self, keys: list[str]) -> dict[str, _FailureState]:
+        placeholders = ", ".join(["?"] * len(keys))
+        try:
+            with self.manager.reader() as conn:
+                rows = conn.execute(
+                    "SELECT key, failures, blocked_until, last_failure_at FROM login_failures"
+                    f" WHERE key IN ({placeholders})",
+                    keys,
+                ).fetchall()
+        except sqlite3.OperationalError:
+            return {}
+        return {row[0]: _FailureState(row[1], row[2], row[3]) for row in rows}
+
+    def flush(self, wait: bool = True) -> int:
+        """変更のあった状態を書き出し、失効したエントリをメモリとテーブルから消す。"""
+        with self._lock:
+            now = self._clock()
+            self._last_flush = now
+            upserts = []
+            deletes = []
+            for key, state in list(self._states.items()):
+                expires_at = max(state.last_failure_at + self.reset_after, state.blocked_until)
+                if state.dirty:
+                    if state.failures:
+                        upserts.append((key, state.failures, state.blocked_until, state.last_failure_at, expires_at))
+                    else:
+                        deletes.append((key,))
+                    state.dirty = False
+                if not state.failures or expires_at <= now:
+                    del self._states[key]
+        if not upserts and not deletes:
+            return 0
+
+        def _write(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                """
+                INSERT INTO login_failures (key, failures, blocked_until, last_failure_at, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    failures = excluded.failures,
+                    blocked_until = excluded.blocked_until,
+                    last_failure_at = excluded.last_failure_at,
+                    expires_at = excluded.expires_at
+                """,
+                upserts,
+            )
+            conn.executemany("DELETE FROM login_failures WHERE key = ?", deletes)
+            conn.execute("DELETE FROM login_failures WHERE expires_at <= ?", (now,))
+
+        future = self.manager.submit(_write)
+        if wait:
+            future.result()
+        return len(upserts) + len(deletes)
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """プロセス共通の `RateLimiter` を返す（初回呼び出しで生成）。"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(
+                    flush_interval=_env_float("RATE_LIMIT_FLUSH_SECONDS", 5.0),
+                )
+    return _limiter
+
+
+_throttle: Optional[LoginThrottle] = None
+_throttle_lock = threading.Lock()
+
+
+def get_login_throttle() -> LoginThrottle:
+    """プロセス共通の `LoginThrottle` を返す（初回呼び出しで生成）。
+
+    `LOGIN_FREE_FAILURES` / `LOGIN_BACKOFF_BASE_SECONDS` / `LOGIN_BACKOFF_MAX_SECONDS` /
+    `LOGIN_FAILURE_RESET_SECONDS` で調整できる。
+    """
+    global _throttle
+    if _throttle is None:
+        with _throttle_lock:
+            if _throttle is None:
+                _throttle = LoginThrottle(
+                    free_failures=_env_int("LOGIN_FREE_FAILURES", 3),
+                    base_delay=_env_float("LOGIN_BACKOFF_BASE_SECONDS", 1.0),
+                    max_delay=_env_float("LOGIN_BACKOFF_MAX_SECONDS", 900.0),
+                    reset_after=_env_float("LOGIN_FAILURE_RESET_SECONDS", 3600.0),
+                    flush_interval=_env_float("RATE_LIMIT_FLUSH_SECONDS", 5.0),
+                )
+    return _throttle
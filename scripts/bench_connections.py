@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""接続方式のベンチマーク: 毎回 connect/close する従来方式と ConnectionManager を比較する。
+
+Usage:
+  python scripts/bench_connections.py [--rows 2000] [--iterations 2000] [--threads 1,4,8]
+
+一時ディレクトリに DB を作って計測するので、receipts.db には触れない。
+"""
+import argparse
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from db import ConnectionManager, apply_migrations  # noqa: E402
+
+READ_SQL = "SELECT * FROM dishes WHERE is_public = 1 ORDER BY created_at DESC LIMIT 50"
+WRITE_SQL = "UPDATE dishes SET favorite = 1 - favorite WHERE id = ?"
+
+
+def seed(manager: ConnectionManager, rows: int) -> None:
+    with manager.writer() as conn:
+        conn.executemany(
+            "INSERT INTO dishes (name, memo_user, tags, favorite, is_public) VALUES (?, ?, ?, ?, ?)",
+            ((f"料理{i}", f"メモ{i}", "和食,10分", i % 2, i % 3 == 0) for i in range(rows)),
+        )
+
+
+def legacy_read(db_path: Path) -> None:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute(READ_SQL).fetchall()
+    finally:
+        conn.close()
+
+
+def legacy_write(db_path: Path, dish_id: int) -> None:
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(WRITE_SQL, (dish_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def pooled_read(manager: ConnectionManager) -> None:
+    with manager.reader() as conn:
+        conn.execute(READ_SQL).fetchall()
+
+
+def pooled_write(manager: ConnectionManager, dish_id: int) -> None:
+    with manager.writer() as conn:
+        conn.execute(WRITE_SQL, (dish_id,))
+
+
+def run(label: str, fn, iterations: int, threads: int) -> None:
+    """`fn(i)` を threads 本のスレッドで合計 iterations 回実行してレイテンシを集計する。"""
+    latencies: list[float] = []
+    lock = threading.Lock()
+    per_thread = max(1, iterations // threads)
+
+    def worker(offset: int) -> None:
+        local: list[float] = []
+        for i in range(per_thread):
+            t0 = time.perf_counter()
+            fn(offset + i)
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    ts = [threading.Thread(target=worker, args=(n * per_thread,)) for n in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print(
+        f"{label:<28} threads={threads:<3} ops/s={len(latencies) / elapsed:>9.0f} "
+        f"p50={p50:.3f}ms p99={p99:.3f}ms"
+    )
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=2000)
+    p.add_argument("--iterations", type=int, default=2000)
+    p.add_argument("--threads", default="1,4,8")
+    args = p.parse_args()
+    thread_counts = [int(t) for t in args.threads.split(",") if t.strip()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench.db"
+        manager = ConnectionManager(db_path)
+        apply_migrations(manager)
+        seed(manager, args.rows)
+        print(f"db={db_path} rows={args.rows} tuning={manager.tuning}")
+
+        for threads in thread_counts:
+            run("legacy connect/close read", lambda i: legacy_read(db_path), args.iterations, threads)
+            run("pooled read", lambda i: pooled_read(manager), args.iterations, threads)
+            run("legacy connect/close write", lambda i: legacy_write(db_path, i % args.rows + 1), args.iterations, threads)
+            run("pooled write", lambda i: pooled_write(manager, i % args.rows + 1), args.iterations, threads)
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
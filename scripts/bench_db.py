@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""データアクセス関数のベンチマーク: 件数ごとの p50/p95/p99 と rows/sec を測る。
+
+Usage:
+  python scripts/bench_db.py [--scales 10000,100000] [--iterations 200] [--seed 42]
+                             [--output bench_results.json] [--compare previous.json]
+
+件数ごとに一時 DB を作り、scripts/synth_data.py の合成データ（seed 固定）を投入してから
+`streamlit_app.py` の関数をそのまま呼んで計測する。一覧系は共有キャッシュを毎回空にして
+DB まで問い合わせた時間を測り、キャッシュに当たった場合は `fetch_dishes (cached)` として別に出す。
+
+`--output` には次の形の JSON を書く（コミット間で比較するため）:
+
+    {"meta": {"commit": ..., "sqlite": ..., "seed": ..., "created_at": ...},
+     "results": [{"scale": 10000, "name": "fetch_dishes keyword", "iterations": 200,
+                  "p50_ms": ..., "p95_ms": ..., "p99_ms": ..., "mean_ms": ...,
+                  "ops_per_sec": ..., "rows_per_sec": ...}, ...]}
+
+`--compare` に以前の JSON を渡すと、同じ (scale, name) の p95 の変化率を表示する。
+1M 件（`--scales 1000000`）は投入に数分かかる。
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import db  # noqa: E402
+from db import ConnectionManager, apply_migrations  # noqa: E402
+from query_cache import get_shared_cache  # noqa: E402
+from rate_limit import RateLimit, RateLimiter, client_keys  # noqa: E402
+from synth_data import INGREDIENTS, METHODS, TAGS, populate  # noqa: E402
+
+import streamlit_app as app  # noqa: E402
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct))]
+
+
+def measure(name: str, scale: int, iterations: int, fn: Callable[[int], int]) -> dict:
+    """`fn(i)` を iterations 回呼ぶ。fn は返した行数を返す。"""
+    latencies: list[float] = []
+    rows = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        rows += fn(i)
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    result = {
+        "scale": scale,
+        "name": name,
+        "iterations": iterations,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": elapsed / iterations * 1000,
+        "ops_per_sec": iterations / elapsed,
+        "rows_per_sec": rows / elapsed,
+    }
+    print(
+        f"{scale:>8} {name:<32} p50={result['p50_ms']:8.3f}ms p95={result['p95_ms']:8.3f}ms "
+        f"p99={result['p99_ms']:8.3f}ms ops/s={result['ops_per_sec']:9.1f} rows/s={result['rows_per_sec']:11.0f}"
+    )
+    return result
+
+
+def page(keyword: str = "", tags: Optional[list[str]] = None, favorite_only: bool = False, public_only: bool = False) -> int:
+    """一覧の 1 ページ分（アプリと同じく次ページ判定用に +1 件）を取得して件数を返す。"""
+    return len(app.fetch_dishes(keyword, tags or [], favorite_only, public_only, limit=app.LIST_PAGE_SIZE + 1))
+
+
+def uncached(fn: Callable[[int], int]) -> Callable[[int], int]:
+    cache = get_shared_cache()
+
+    def run(i: int) -> int:
+        cache.clear()
+        return fn(i)
+
+    return run
+
+
+def bench_scale(scale: int, users: int, iterations: int, seed: int) -> list[dict]:
+    rng = random.Random(f"bench:{seed}")
+    keywords = [f"{i}の{m}" for i in INGREDIENTS for m in METHODS]
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = ConnectionManager(Path(tmp) / "bench.db")
+        apply_migrations(manager)
+        t0 = time.perf_counter()
+        populate(manager, scale, users, seed)
+        print(f"{scale:>8} seeded in {time.perf_counter() - t0:.1f}s")
+        # streamlit_app の関数はプロセス共通のマネージャを使うので、一時 DB に差し替える
+        previous = db._manager
+        db._manager = manager
+        limiter = RateLimiter({"post": RateLimit(10**9, 86400)}, manager=manager, flush_interval=1.0)
+        try:
+            results = [
+                measure("fetch_dishes", scale, iterations, uncached(lambda i: page())),
+                measure("fetch_dishes (cached)", scale, iterations, lambda i: page()),
+                measure(
+                    "fetch_dishes keyword",
+                    scale,
+                    iterations,
+                    uncached(lambda i: page(rng.choice(keywords))),
+                ),
+                measure(
+                    "fetch_dishes short keyword",
+                    scale,
+                    iterations,
+                    uncached(lambda i: page(rng.choice(INGREDIENTS)[:2])),
+                ),
+                measure(
+                    "fetch_dishes 1 tag",
+                    scale,
+                    iterations,
+                    uncached(lambda i: page(tags=[rng.choice(TAGS)])),
+                ),
+                measure(
+                    "fetch_dishes 2 tags",
+                    scale,
+                    iterations,
+                    uncached(lambda i: page(tags=rng.sample(TAGS[:10], 2))),
+                ),
+                measure("fetch_dishes favorite", scale, iterations, uncached(lambda i: page(favorite_only=True))),
+                measure("fetch_dishes public", scale, iterations, uncached(lambda i: page(public_only=True))),
+                measure("fetch_all_tags", scale, iterations, uncached(lambda i: len(app.fetch_all_tags()))),
+                measure(
+                    "fetch_profile",
+                    scale,
+                    iterations,
+                    lambda i: len((app.fetch_profile(f"user{rng.randrange(users):06d}") or (0, []))[1]),
+                ),
+                measure(
+                    "rate_limit hit",
+                    scale,
+                    iterations,
+                    lambda i: int(limiter.hit("post", client_keys(user_id=rng.randrange(users) + 1, ip="10.0.0.1")).allowed),
+                ),
+                measure(
+                    "update_favorite_flag",
+                    scale,
+                    iterations,
+                    lambda i: app.update_favorite_flag(rng.randrange(scale) + 1, bool(i % 2)) or 1,
+                ),
+                measure(
+                    "insert_dish",
+                    scale,
+                    iterations,
+                    lambda i: app.insert_dish(
+                        f"ベンチ{rng.choice(INGREDIENTS)}の{rng.choice(METHODS)}",
+                        None,
+                        "ベンチマーク",
+                        ",".join(rng.sample(TAGS, 2)),
+                        False,
+                        None,
+                        owner_id=rng.randrange(users) + 1,
+                    )
+                    and 1,
+                ),
+            ]
+        finally:
+            db._manager = previous
+            manager.close()
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous_path: Path, results: list[dict]) -> None:
+    previous = json.loads(previous_path.read_text(encoding="utf-8"))
+    old = {(r["scale"], r["name"]): r for r in previous["results"]}
+    print(f"\np95 vs {previous_path} (commit {previous['meta'].get('commit')}):")
+    for r in results:
+        before = old.get((r["scale"], r["name"]))
+        if before is None or not before["p95_ms"]:
+            continue
+        change = (r["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+        print(f"{r['scale']:>8} {r['name']:<32} {before['p95_ms']:8.3f}ms -> {r['p95_ms']:8.3f}ms ({change:+.1f}%)")
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--scales", default="10000,100000")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--iterations", type=int, default=200)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--output", type=Path, help="結果を JSON で書き出す")
+    p.add_argument("--compare", type=Path, help="以前の --output と p95 を比較する")
+    args = p.parse_args()
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+
+    results: list[dict] = []
+    for scale in scales:
+        results += bench_scale(scale, max(1, args.users), max(1, args.iterations), args.seed)
+
+    if args.output:
+        payload = {
+            "meta": {
+                "commit": git_commit(),
+                "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "seed": args.seed,
+                "users": args.users,
+                "iterations": args.iterations,
+            },
+            "results": results,
+        }
+        args.output.write_text(json.dumps(payload, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"wrote {args.output}")
+    if args.compare:
+        compare(args.compare, results)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""公開ギャラリー 1 ページ分の画像の転送量と描画時間を、縮小版の有無で比べる。
+
+Usage:
+  python scripts/bench_gallery.py [--photos 24] [--size 4032x3024] [--runs 5]
+
+一時ディレクトリにスマートフォン相当（既定 4032x3024）の JPEG を `--photos` 枚作り、
+公開の料理として一時 DB に登録する。そのうえで
+1. 縮小版なし（元の写真をそのまま表示）
+2. `images.backfill()` で縮小版を作った後
+のそれぞれで、streamlit.testing の AppTest でアプリを `--runs` 回描画した時間の中央値と、
+ギャラリー 1 ページのカードが参照する画像ファイルの合計バイト数を表示する。
+"""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from PIL import Image  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+import db  # noqa: E402
+import images  # noqa: E402
+from db import ConnectionManager, apply_migrations  # noqa: E402
+from query_cache import get_shared_cache  # noqa: E402
+
+import streamlit_app as app  # noqa: E402
+
+
+def make_photo(path: Path, size: tuple[int, int], seed: int) -> None:
+    """グラデーションにノイズを重ねた写真らしい画像（圧縮が効きすぎないように）。"""
+    w, h = size
+    base = Image.linear_gradient("L").resize((w, h)).convert("RGB")
+    noise = Image.effect_noise((w, h), 40 + seed % 20).convert("RGB")
+    Image.blend(base, noise, 0.35).save(path, "JPEG", quality=90)
+
+
+def page_weight() -> tuple[int, int]:
+    """ギャラリー 1 ページ目のカードが表示する画像の (合計バイト数, 枚数)。"""
+    rows = app.fetch_dishes(public_only=True, limit=app.GALLERY_PAGE_SIZE)
+    paths = [images.best_variant(Path(r["photo_path"]), app.CARD_IMAGE_WIDTH) for r in rows if r["photo_path"]]
+    return sum(p.stat().st_size for p in paths), len(paths)
+
+
+def render_times(runs: int) -> list[float]:
+    times = []
+    for _ in range(runs):
+        get_shared_cache().clear()
+        at = AppTest.from_file(str(ROOT / "streamlit_app.py"), default_timeout=300)
+        t0 = time.perf_counter()
+        at.run()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--photos", type=int, default=24)
+    p.add_argument("--size", default="4032x3024", help="元の写真の大きさ（幅x高さ）")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--workers", type=int, default=4, help="縮小版を作るスレッド数")
+    args = p.parse_args()
+    size = tuple(int(v) for v in args.size.lower().split("x"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        manager = ConnectionManager(tmp_dir / "bench.db")
+        apply_migrations(manager)
+        t0 = time.perf_counter()
+        rows = []
+        for i in range(max(1, args.photos)):
+            photo = tmp_dir / "dishes" / str(i + 1) / "cover.jpg"
+            photo.parent.mkdir(parents=True)
+            make_photo(photo, size, i)
+            rows.append((i + 1, f"ベンチ料理{i + 1}", str(photo)))
+        with manager.writer() as conn:
+            conn.executemany("INSERT INTO dishes (id, name, photo_path, is_public) VALUES (?, ?, ?, 1)", rows)
+        print(f"created {len(rows)} photos of {size[0]}x{size[1]} in {time.perf_counter() - t0:.1f}s")
+
+        previous = db._manager
+        db._manager = manager
+        try:
+            before_bytes, count = page_weight()
+            before = render_times(max(1, args.runs))
+
+            t0 = time.perf_counter()
+            photos, variants = images.backfill(manager, max(1, args.workers))
+            backfill_s = time.perf_counter() - t0
+
+            after_bytes, _ = page_weight()
+            after = render_times(max(1, args.runs))
+        finally:
+            db._manager = previous
+            manager.close()
+
+    print(f"backfill: {photos} photos -> {variants} variants ({images.variant_format()}) in {backfill_s:.2f}s "
+          f"({backfill_s / max(1, photos) * 1000:.0f} ms/photo with {args.workers} workers)")
+    print(f"{'':<10} {'page bytes':>14} {'images':>7} {'render p50':>11} {'render min':>11}")
+    for label, weight, times in (("original", before_bytes, before), ("variants", after_bytes, after)):
+        print(f"{label:<10} {weight:>14,} {count:>7} {statistics.median(times) * 1000:>9.0f}ms {min(times) * 1000:>9.0f}ms")
+    if before_bytes:
+        print(f"page weight: -{(1 - after_bytes / before_bytes) * 100:.1f}%")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""リスト型攻撃を模したログイン試行で、LoginThrottle の有無による CPU 消費を比べる。
+
+Usage:
+  python scripts/bench_login_throttle.py [--attempts 300] [--usernames 20] [--ips 5]
+                                         [--rate 50] [--memory-cost 65536] [--time-cost 2]
+
+攻撃側は `--usernames` 個のユーザー名に対し、`--ips` 個の IP から誤ったパスワードを
+秒間 `--rate` 回のペースで送る（時計は模擬なので実際には待たない）。
+- throttle なし: すべての試行で argon2 の検証を行う（現在の rate_limit の login 上限も外す）
+- throttle あり: アプリと同じく `LoginThrottle.check()` が通った試行だけ検証する
+
+パスワード検証は `PasswordHasher(workers=0)` で呼び出し元スレッドで行うので、
+プロセスの CPU 時間（time.process_time）にハッシュ計算がそのまま現れる。
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from db import ConnectionManager, apply_migrations  # noqa: E402
+from passwords import HashSettings, PasswordHasher  # noqa: E402
+from rate_limit import LoginThrottle, client_keys  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1_700_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run(
+    hasher: PasswordHasher,
+    stored_hash: str,
+    throttle: LoginThrottle | None,
+    clock: FakeClock,
+    attempts: int,
+    usernames: int,
+    ips: int,
+    rate: float,
+    seed: int,
+) -> dict:
+    rng = random.Random(seed)
+    verified = rejected = 0
+    cpu0 = time.process_time()
+    wall0 = time.perf_counter()
+    for i in range(attempts):
+        clock.now += 1.0 / rate
+        keys = client_keys(display_name=f"victim{rng.randrange(usernames)}", ip=f"203.0.113.{rng.randrange(ips)}")
+        if throttle is not None and not throttle.check(keys).allowed:
+            rejected += 1
+            continue
+        hasher.verify(f"guess-{i}", stored_hash)
+        verified += 1
+        if throttle is not None:
+            throttle.record_failure(keys)
+    if throttle is not None:
+        throttle.flush()
+    return {
+        "cpu": time.process_time() - cpu0,
+        "wall": time.perf_counter() - wall0,
+        "verified": verified,
+        "rejected": rejected,
+    }
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--attempts", type=int, default=300)
+    p.add_argument("--usernames", type=int, default=20)
+    p.add_argument("--ips", type=int, default=5)
+    p.add_argument("--rate", type=float, default=50.0, help="模擬時計での 1 秒あたりの試行数")
+    p.add_argument("--memory-cost", type=int, default=HashSettings().memory_cost, help="argon2 の memory_cost（KiB）")
+    p.add_argument("--time-cost", type=int, default=HashSettings().time_cost)
+    p.add_argument("--seed", type=int, default=42)
+    args = p.parse_args()
+
+    settings = HashSettings(memory_cost=max(8, args.memory_cost), time_cost=max(1, args.time_cost))
+    hasher = PasswordHasher(settings, workers=0)
+    stored_hash = hasher.hash("correct horse battery staple")
+    attempts = max(1, args.attempts)
+    common = (max(1, args.usernames), max(1, args.ips), max(0.001, args.rate), args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = ConnectionManager(Path(tmp) / "bench.db")
+        try:
+            apply_migrations(manager)
+            clock = FakeClock()
+            without = run(hasher, stored_hash, None, clock, attempts, *common)
+            clock = FakeClock()
+            throttle = LoginThrottle(manager=manager, clock=clock)
+            with_throttle = run(hasher, stored_hash, throttle, clock, attempts, *common)
+            with manager.reader() as conn:
+                persisted = conn.execute("SELECT COUNT(*) FROM login_failures").fetchone()[0]
+        finally:
+            manager.close()
+
+    print(
+        f"{attempts} attempts over {attempts / args.rate:.1f}s simulated, "
+        f"{args.usernames} usernames x {args.ips} ips, argon2 m={settings.memory_cost}KiB t={settings.time_cost}"
+    )
+    for label, r in (("without throttle", without), ("with throttle", with_throttle)):
+        print(
+            f"{label:<17} cpu={r['cpu']:7.2f}s wall={r['wall']:7.2f}s "
+            f"verified={r['verified']:>5} rejected_before_hash={r['rejected']:>5}"
+        )
+    if without["cpu"] > 0:
+        print(f"cpu saved: {(1 - with_throttle['cpu'] / without['cpu']) * 100:.1f}%")
+    print(f"login_failures rows persisted: {persisted}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
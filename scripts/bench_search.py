@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""キーワード検索のベンチマーク: 従来の LIKE 全件走査と FTS5（dishes_fts）を比較する。
+
+Usage:
+  python scripts/bench_search.py [--rows 100000] [--repeat 20]
+
+一時ディレクトリに DB を作り、全マイグレーション適用後に合成データを投入する。
+あわせて 007 マイグレーションのバッチ backfill（作り直し）の所要時間も計測する。
+"""
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from db import MIGRATIONS_DIR, ConnectionManager, _run_python_migration, apply_migrations  # noqa: E402
+
+INGREDIENTS = ["鶏むね肉", "豚バラ", "鮭", "トマト", "玉ねぎ", "じゃがいも", "豆腐", "キャベツ", "なす", "卵"]
+DISHES = ["照り焼き", "味噌煮", "パスタ", "カレー", "炒め", "スープ", "サラダ", "煮物", "唐揚げ", "グラタン"]
+TAGS = ["和食", "洋食", "中華", "10分", "作り置き", "鶏肉", "豚肉", "魚", "野菜", "お弁当"]
+MEMOS = ["甘辛いタレがよく合う", "冷めても美味しい", "子どもに好評", "次は塩を控えめに", "圧力鍋で時短"]
+
+LIKE_SQL = """
+    SELECT * FROM dishes
+    WHERE (LOWER(name) LIKE ? OR LOWER(memo_user) LIKE ? OR LOWER(recipe_url) LIKE ?)
+    ORDER BY created_at DESC LIMIT 50
+"""
+FTS_SQL = """
+    SELECT dishes.* FROM dishes_fts JOIN dishes ON dishes.id = dishes_fts.rowid
+    WHERE dishes_fts MATCH ?
+    ORDER BY dishes_fts.rank, dishes.created_at DESC LIMIT 50
+"""
+
+
+def seed(manager: ConnectionManager, rows: int) -> None:
+    rnd = random.Random(42)
+
+    def gen():
+        for i in range(rows):
+            name = f"{rnd.choice(INGREDIENTS)}の{rnd.choice(DISHES)}"
+            tags = ",".join(rnd.sample(TAGS, 2))
+            yield (name, rnd.choice(MEMOS), tags, f"https://example.com/r/{i}")
+
+    with manager.writer() as conn:
+        conn.executemany(
+            "INSERT INTO dishes (name, memo_user, tags, recipe_url) VALUES (?, ?, ?, ?)", gen()
+        )
+
+
+def timed(fn, repeat: int) -> tuple[float, float, int]:
+    samples = []
+    n = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        n = len(fn())
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples) * 1000, max(samples) * 1000, n
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=100_000)
+    p.add_argument("--repeat", type=int, default=20)
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = ConnectionManager(Path(tmp) / "bench.db")
+        apply_migrations(manager)
+        t0 = time.perf_counter()
+        seed(manager, args.rows)
+        print(f"seeded {args.rows} rows (with FTS triggers) in {time.perf_counter() - t0:.1f}s")
+
+        t0 = time.perf_counter()
+        with manager.writer() as conn:
+            _run_python_migration(conn, MIGRATIONS_DIR / "007_add_dishes_fts.py")
+        print(f"batched FTS backfill of {args.rows} rows in {time.perf_counter() - t0:.1f}s")
+
+        for kw in ["照り焼き", "鶏むね肉", "冷めても", "作り置き", "example.com/r/999"]:
+            like = f"%{kw.lower()}%"
+            with manager.reader() as conn:
+                like_med, like_max, like_n = timed(
+                    lambda: conn.execute(LIKE_SQL, (like, like, like)).fetchall(), args.repeat
+                )
+                fts_med, fts_max, fts_n = timed(
+                    lambda: conn.execute(FTS_SQL, ('"' + kw + '"',)).fetchall(), args.repeat
+                )
+            print(
+                f"{kw:<20} LIKE p50={like_med:8.2f}ms max={like_max:8.2f}ms hits={like_n:<3} | "
+                f"FTS p50={fts_med:8.2f}ms max={fts_max:8.2f}ms hits={fts_n}"
+            )
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""token_store の負荷試験: store → peek → retrieve を並行して繰り返し、requests/sec と p99 を出す。
+
+Usage:
+  python scripts/bench_token_store.py [--clients 32] [--seconds 10] [--url http://127.0.0.1:8765]
+
+`--url` を省略すると scripts/token_store.py のサーバーをこのプロセス内（別スレッド）で
+起動して測る（ログは出さない）。各クライアントは keep-alive の接続を 1 本使い回す。
+最後にサーバーの `/metrics` も表示する。
+"""
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "scripts"))
+
+from token_store import TokenStore, TokenStoreServer, start_log_listener  # noqa: E402
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, body: dict | None = None) -> tuple[int, dict]:
+    payload = json.dumps(body).encode() if body is not None else None
+    headers = {"Content-Type": "application/json"} if payload else {}
+    conn.request(method, path, body=payload, headers=headers)
+    resp = conn.getresponse()
+    return resp.status, json.loads(resp.read() or b"{}")
+
+
+def client_loop(host: str, port: int, deadline: float, latencies: dict[str, list[float]], errors: list[int]) -> None:
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    token = "0." + "x" * 400  # 実際の Turnstile トークンと同程度の長さ
+    while time.perf_counter() < deadline:
+        try:
+            t0 = time.perf_counter()
+            status, data = request(conn, "POST", "/store", {"token": token})
+            latencies["store"].append(time.perf_counter() - t0)
+            id_ = data.get("id")
+            for name, path in (("peek", f"/peek?id={id_}"), ("retrieve", f"/retrieve?id={id_}")):
+                t0 = time.perf_counter()
+                status, _ = request(conn, "GET", path)
+                latencies[name].append(time.perf_counter() - t0)
+                if status != 200:
+                    errors[0] += 1
+        except (OSError, http.client.HTTPException, ValueError):
+            errors[0] += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+    conn.close()
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--clients", type=int, default=32)
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.add_argument("--url", help="既に起動している token_store の URL")
+    args = p.parse_args()
+
+    server = listener = None
+    if args.url:
+        parsed = urlparse(args.url)
+        host, port = parsed.hostname or "127.0.0.1", parsed.port or 80
+    else:
+        listener = start_log_listener(quiet=True)
+        server = TokenStoreServer(("127.0.0.1", 0), TokenStore())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = "127.0.0.1", server.server_address[1]
+
+    clients = max(1, args.clients)
+    per_client = [{"store": [], "peek": [], "retrieve": []} for _ in range(clients)]
+    per_errors = [[0] for _ in range(clients)]
+    deadline = time.perf_counter() + max(0.1, args.seconds)
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=client_loop, args=(host, port, deadline, per_client[i], per_errors[i]))
+        for i in range(clients)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    merged: dict[str, list[float]] = {"store": [], "peek": [], "retrieve": []}
+    for lat in per_client:
+        for name, values in lat.items():
+            merged[name].extend(values)
+    everything = sorted(v for values in merged.values() for v in values)
+    pct = lambda vals, q: vals[min(len(vals) - 1, int(len(vals) * q))] * 1000 if vals else 0.0  # noqa: E731
+    print(f"{clients} clients, {elapsed:.1f}s, errors={sum(e[0] for e in per_errors)}")
+    for name, values in merged.items():
+        values.sort()
+        print(f"  {name:<8} n={len(values):>7} p50={pct(values, 0.5):7.2f}ms p99={pct(values, 0.99):7.2f}ms")
+    print(f"  {'total':<8} n={len(everything):>7} req/s={len(everything) / elapsed:9.1f} p99={pct(everything, 0.99):7.2f}ms")
+
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    _, metrics = request(conn, "GET", "/metrics")
+    conn.close()
+    print("server /metrics:", json.dumps(metrics, indent=2))
+    if server is not None:
+        server.shutdown()
+    if listener is not None:
+        listener.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
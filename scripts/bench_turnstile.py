@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Turnstile 検証のレイテンシを、ローカルの siteverify 代替サーバーに対して測る。
+
+Usage:
+  python scripts/bench_turnstile.py [--sessions 20] [--submits 5] [--latency-ms 80] [--url URL]
+
+`--sessions` 人が並行して、それぞれ 1 つのトークンでフォーム送信を `--submits` 回行う。
+次の 2 つを比べる:
+- naive: 送信ごとに `requests.post` する従来の方法（接続の再利用なし）
+- client: turnstile.TurnstileClient（keep-alive + 失敗のキャッシュ + 同一トークンの合流）。
+  アプリと同じく、成功したらセッションに覚えて以後の送信では検証しない
+
+`--url` を省略すると scripts/fake_siteverify.py のサーバーをこのプロセス内で起動する。
+naive では同じトークンの 2 回目以降が timeout-or-duplicate で失敗する点にも注意。
+"""
+import argparse
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable
+
+import requests
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+from fake_siteverify import start_in_thread  # noqa: E402
+from turnstile import TurnstileClient  # noqa: E402
+
+SECRET = "bench-secret"
+
+
+def naive_verify(url: str) -> Callable[[str], bool]:
+    def verify(token: str) -> bool:
+        try:
+            resp = requests.post(url, data={"secret": SECRET, "response": token}, timeout=5)
+            resp.raise_for_status()
+            return bool(resp.json().get("success"))
+        except Exception:
+            return False
+
+    return verify
+
+
+def run(name: str, verify: Callable[[str], bool], sessions: int, submits: int, remember: bool = False) -> None:
+    latencies: list[float] = []
+    successes = 0
+    lock = threading.Lock()
+    barrier = threading.Barrier(sessions)
+
+    def session() -> None:
+        nonlocal successes
+        token = f"0.{uuid.uuid4().hex}"
+        verified = False
+        barrier.wait()
+        for _ in range(submits):
+            t0 = time.perf_counter()
+            # remember: st.session_state["turnstile_verified_at"] に相当
+            ok = verified or verify(token)
+            verified = remember and ok
+            elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed)
+                successes += int(ok)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    latencies.sort()
+    pct = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000  # noqa: E731
+    print(
+        f"{name:<7} calls={len(latencies):>5} ok={successes:>5} p50={pct(0.50):7.1f}ms "
+        f"p95={pct(0.95):7.1f}ms p99={pct(0.99):7.1f}ms wall={wall:6.2f}s"
+    )
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--sessions", type=int, default=20)
+    p.add_argument("--submits", type=int, default=5, help="1 トークンあたりの検証回数")
+    p.add_argument("--latency-ms", type=float, default=80.0, help="代替サーバーの人工的な遅延")
+    p.add_argument("--url", help="既に起動している siteverify（代替サーバー）の URL")
+    args = p.parse_args()
+    sessions, submits = max(1, args.sessions), max(1, args.submits)
+
+    server = None
+    url = args.url
+    if not url:
+        server = start_in_thread(latency=max(0.0, args.latency_ms) / 1000)
+        url = f"http://127.0.0.1:{server.server_address[1]}/turnstile/v0/siteverify"
+
+    def report(label: str, before: tuple[int, int]) -> None:
+        if server is not None:
+            print(
+                f"{'':<7} server requests={server.requests - before[0]} "
+                f"new connections={server.connections - before[1]}  ({label})"
+            )
+
+    snapshot = lambda: (server.requests, server.connections) if server else (0, 0)  # noqa: E731
+    before = snapshot()
+    run("naive", naive_verify(url), sessions, submits)
+    report("naive", before)
+
+    client = TurnstileClient(SECRET, url=url, pool_maxsize=sessions)
+    before = snapshot()
+    run("client", client.verify, sessions, submits, remember=True)
+    report("client", before)
+    print(f"{'':<7} client stats: {client.stats()}")
+    client.close()
+    if server is not None:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""本番クエリのプラン回帰チェック。
+
+streamlit_app.py が実行するすべての SQL に `EXPLAIN QUERY PLAN` をかけ、
+全件走査（インデックスを使わない `SCAN <table>`）や一時 B-tree による並べ替え
+（`USE TEMP B-TREE`）が出たら失敗にする。
+
+対象:
+  - streamlit_app.py 内で `.execute()` / `.executemany()` / `cached_query()` に直接渡している
+    SQL 文字列
+  - `build_dish_query()` が組み立てる一覧 / 検索クエリ（全フィルタの組み合わせ）
+
+Usage:
+  python scripts/check_query_plans.py [-v]
+
+問題が無ければ 0、劣化したクエリがあれば 1 を返す（CI 向け）。
+"""
+import argparse
+import ast
+import itertools
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import db  # noqa: E402
+import streamlit_app as app  # noqa: E402
+
+APP_SOURCE = ROOT / "streamlit_app.py"
+
+# 意図的に許容しているプラン（理由を必ず書く）。(SQL に含まれる文字列, プラン詳細の正規表現)
+ALLOWED = [
+    # bm25 の関連度順はヒットした行を並べ替えるしかない（ヒット件数分のソートで、全件ではない）
+    ("dishes_fts MATCH", r"^USE TEMP B-TREE FOR ORDER BY$"),
+]
+
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+TEMP_BTREE = re.compile(r"USE TEMP B-TREE")
+
+
+def literal_statements() -> list[tuple[str, str]]:
+    """streamlit_app.py から `.execute("...")` などに渡されている SQL リテラルを集める。"""
+    tree = ast.parse(APP_SOURCE.read_text(encoding="utf-8"))
+    found: list[tuple[str, str]] = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not node.args:
+            continue
+        func = node.func
+        name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+        if name not in ("execute", "executemany", "cached_query"):
+            continue
+        arg = node.args[0]
+        if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+            sql = arg.value.strip()
+            if sql.upper().startswith("PRAGMA"):
+                continue
+            found.append((f"streamlit_app.py:{node.lineno}", sql))
+    return found
+
+
+def dish_query_statements() -> list[tuple[str, str, list]]:
+    """`build_dish_query()` の全フィルタ組み合わせを返す。"""
+    keywords = ["", "鶏", "鶏むね肉"]  # なし / LIKE フォールバック / FTS
+    tag_sets = [[], ["和食"], ["和食", "10分"]]
+    found = []
+    for keyword, tags, fav, pub, cursor in itertools.product(
+        keywords, tag_sets, [False, True], [False, True], [None, ("2024-01-01 00:00:00", 1)]
+    ):
+        sql, params = app.build_dish_query(keyword, list(tags), fav, pub, 20, cursor)
+        label = (
+            f"build_dish_query(keyword={keyword!r}, tags={tags}, favorite_only={fav}, "
+            f"public_only={pub}, cursor={'yes' if cursor else 'no'})"
+        )
+        found.append((label, sql, params))
+    return found
+
+
+def problems_for(sql: str, plan: list[str]) -> list[str]:
+    problems = []
+    for detail in plan:
+        if not (FULL_SCAN.match(detail) or TEMP_BTREE.search(detail)):
+            continue
+        if any(marker in sql and re.search(pattern, detail) for marker, pattern in ALLOWED):
+            continue
+        problems.append(detail)
+    return problems
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("-v", "--verbose", action="store_true", help="すべてのプランを表示する")
+    args = p.parse_args()
+
+    statements = [(label, sql, [None] * sql.count("?")) for label, sql in literal_statements()]
+    statements += dish_query_statements()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = db.ConnectionManager(Path(tmp) / "plans.db")
+        db.apply_migrations(manager)
+        with manager.reader() as conn:
+            for label, sql, params in statements:
+                plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+                problems = problems_for(sql, plan)
+                if problems:
+                    failures += 1
+                    print(f"FAIL {label}")
+                    print("     " + " ".join(sql.split()))
+                    for detail in plan:
+                        print(f"     - {detail}")
+                elif args.verbose:
+                    print(f"ok   {label}: {' / '.join(plan) or '(no plan)'}")
+        manager.close()
+
+    print(f"checked {len(statements)} statements, {failures} degraded")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Turnstile siteverify のローカル代替サーバー（オフラインの負荷試験用）。
+
+Usage:
+  python scripts/fake_siteverify.py [--host 127.0.0.1] [--port 8766] [--latency-ms 80]
+
+  TURNSTILE_SECRET=dummy TURNSTILE_SITEVERIFY_URL=http://127.0.0.1:8766/turnstile/v0/siteverify \
+    streamlit run streamlit_app.py
+
+POST /turnstile/v0/siteverify（form: secret, response[, remoteip]）に Cloudflare と同じ形の
+JSON を返す。本物と同じくトークンは 1 回しか成功しない（2 回目以降は timeout-or-duplicate）。
+`fail` で始まるトークンは invalid-input-response になる。`--latency-ms` で応答を遅らせ、
+実際の siteverify までの往復時間を模擬できる。
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeSiteverifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 既定の 5 だと同時接続の負荷試験で SYN の再送（1 秒）待ちが起きる
+    request_queue_size = 128
+
+    def __init__(self, address: tuple[str, int], latency: float = 0.0) -> None:
+        super().__init__(address, SiteverifyHandler)
+        self.latency = latency
+        self.used: set[str] = set()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+
+class SiteverifyHandler(BaseHTTPRequestHandler):
+    # keep-alive を有効にする（クライアントの接続再利用を試せるように）
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: FakeSiteverifyServer
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args) -> None:  # noqa: A002 - 親クラスの引数名
+        pass
+
+    def _send_json(self, status: int, body: dict) -> None:
+        raw = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", "0"))
+        form = parse_qs(self.rfile.read(length).decode("utf-8")) if length else {}
+        if self.path != "/turnstile/v0/siteverify":
+            self._send_json(404, {"error": "not found"})
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        secret = form.get("secret", [""])[0]
+        token = form.get("response", [""])[0]
+        with self.server.lock:
+            self.server.requests += 1
+            duplicate = token in self.server.used
+            self.server.used.add(token)
+        errors = []
+        if not secret:
+            errors.append("missing-input-secret")
+        if not token:
+            errors.append("missing-input-response")
+        elif token.startswith("fail"):
+            errors.append("invalid-input-response")
+        elif duplicate:
+            errors.append("timeout-or-duplicate")
+        body = {"success": not errors, "error-codes": errors}
+        if not errors:
+            body["challenge_ts"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            body["hostname"] = "localhost"
+        self._send_json(200, body)
+
+
+def start_in_thread(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0) -> FakeSiteverifyServer:
+    """別スレッドで起動してサーバーを返す（`port=0` なら空いているポート）。"""
+    server = FakeSiteverifyServer((host, port), latency)
+    threading.Thread(target=server.serve_forever, name="fake-siteverify", daemon=True).start()
+    return server
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8766)
+    p.add_argument("--latency-ms", type=float, default=80.0, help="応答までの人工的な遅延")
+    args = p.parse_args()
+    server = FakeSiteverifyServer((args.host, args.port), max(0.0, args.latency_ms) / 1000)
+    print(f"fake siteverify on http://{args.host}:{args.port}/turnstile/v0/siteverify")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""書き込みの同時実行ストレステスト: セッション数を増やしたときの throughput / p99 を比較する。
+
+Usage:
+  python scripts/stress_writes.py [--sessions 1,2,4,8,16,32,64] [--writes 50] [--legacy-timeout 5]
+
+各セッション（スレッド）は「投稿ログ INSERT + お気に入り UPDATE」を 1 回の書き込みとして
+--writes 回繰り返す。比較する方式:
+
+- legacy: 書き込みごとに sqlite3.connect して commit する従来方式
+- locked: ConnectionManager.writer() をロックで直列化して 1 書き込み 1 commit
+- queue:  ConnectionManager.run_write() で書き込みスレッドにまとめて commit させる
+
+一時ディレクトリに DB を作って計測するので、receipts.db には触れない。
+"""
+import argparse
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from db import ConnectionManager, apply_migrations  # noqa: E402
+
+SEED_ROWS = 500
+
+
+def write_ops(conn: sqlite3.Connection, session: int, i: int) -> None:
+    conn.execute(
+        "INSERT INTO submission_attempts (author_display_name) VALUES (?)",
+        (f"session{session}",),
+    )
+    conn.execute(
+        "UPDATE dishes SET favorite = 1 - favorite WHERE id = ?",
+        ((session * 7919 + i) % SEED_ROWS + 1,),
+    )
+
+
+def legacy_write(db_path: Path, timeout: float, session: int, i: int) -> None:
+    conn = sqlite3.connect(db_path, timeout=timeout)
+    try:
+        write_ops(conn, session, i)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def locked_write(manager: ConnectionManager, session: int, i: int) -> None:
+    with manager.writer() as conn:
+        write_ops(conn, session, i)
+
+
+def queued_write(manager: ConnectionManager, session: int, i: int) -> None:
+    manager.run_write(lambda conn: write_ops(conn, session, i))
+
+
+def run(label: str, fn, sessions: int, writes: int) -> None:
+    """sessions 本のスレッドがそれぞれ `fn(session, i)` を writes 回呼んだ結果を集計する。"""
+    latencies: list[float] = []
+    errors: dict[str, int] = {}
+    lock = threading.Lock()
+    start_gate = threading.Barrier(sessions)
+
+    def worker(session: int) -> None:
+        local: list[float] = []
+        local_errors: dict[str, int] = {}
+        start_gate.wait()
+        for i in range(writes):
+            t0 = time.perf_counter()
+            try:
+                fn(session, i)
+            except sqlite3.OperationalError as exc:
+                local_errors[str(exc)] = local_errors.get(str(exc), 0) + 1
+                continue
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+            for msg, n in local_errors.items():
+                errors[msg] = errors.get(msg, 0) + n
+
+    started = time.perf_counter()
+    ts = [threading.Thread(target=worker, args=(n,)) for n in range(sessions)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    if latencies:
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    else:
+        p50 = p99 = float("nan")
+    failed = sum(errors.values())
+    print(
+        f"{label:<7} sessions={sessions:<3} writes/s={len(latencies) / elapsed:>8.0f} "
+        f"p50={p50:>8.2f}ms p99={p99:>8.2f}ms errors={failed}"
+    )
+    for msg, n in sorted(errors.items()):
+        print(f"        {n} x {msg}")
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--sessions", default="1,2,4,8,16,32,64")
+    p.add_argument("--writes", type=int, default=50, help="1 セッションあたりの書き込み回数")
+    p.add_argument("--legacy-timeout", type=float, default=5.0, help="legacy 方式の sqlite3.connect timeout（秒）")
+    p.add_argument("--modes", default="legacy,locked,queue")
+    args = p.parse_args()
+    session_counts = [int(s) for s in args.sessions.split(",") if s.strip()]
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "stress.db"
+        manager = ConnectionManager(db_path)
+        apply_migrations(manager)
+        with manager.writer() as conn:
+            conn.executemany(
+                "INSERT INTO dishes (name, memo_user, tags) VALUES (?, ?, ?)",
+                ((f"料理{i}", f"メモ{i}", "和食") for i in range(SEED_ROWS)),
+            )
+        print(f"db={db_path} writes/session={args.writes} tuning={manager.tuning}")
+
+        for sessions in session_counts:
+            if "legacy" in modes:
+                run("legacy", lambda s, i: legacy_write(db_path, args.legacy_timeout, s, i), sessions, args.writes)
+            if "locked" in modes:
+                run("locked", lambda s, i: locked_write(manager, s, i), sessions, args.writes)
+            if "queue" in modes:
+                run("queue", lambda s, i: queued_write(manager, s, i), sessions, args.writes)
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
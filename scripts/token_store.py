@@ -3,127 +3,287 @@
 Simple local token store for Turnstile PoC.
 
 Usage:
-  python3 scripts/token_store.py --port 8765
+  python3 scripts/token_store.py --port 8765 [--ttl 300] [--max-size 10000]
 
 Endpoints:
   POST /store  - body: JSON {"token": "..."} -> returns {"id": "..."}
-  GET  /retrieve?id=<id> -> returns {"token": "..."} or 404
+  POST /sign   - body: JSON {"token": "..."} -> returns {"id": "v1...."} (stateless signed envelope;
+                 only when TURNSTILE_HANDOFF_KEY is set, see turnstile.sign_handoff)
+  GET  /retrieve?id=<id> -> returns {"token": "..."} or 404 (one-time consume)
+  GET  /peek?id=<id>     -> returns {"found": true} or 404 (does not consume)
+  GET  /metrics          -> returns size, hit/miss/eviction counters and latency percentiles
 
 This is intentionally tiny and for local development only. It stores tokens in memory
 and is NOT secure. Bind to localhost only and run in your dev environment.
+
+Requests are handled on a thread per connection (ThreadingHTTPServer, keep-alive).
+Entries live in an OrderedDict in insertion order; since every entry has the same TTL
+this is also expiry order, so expired entries are dropped from the front in O(1) each
+instead of scanning the whole store. When `--max-size` is reached the oldest entry is
+evicted. Access logs go through a QueueHandler so request threads never block on stdout.
+
+With TURNSTILE_HANDOFF_KEY set, pages can POST to /sign instead of /store. The returned
+envelope is verified by the app locally, so the app does not need to call back here.
 """
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 import json
 import argparse
+import logging
+import queue
+import threading
 import uuid
 import time
+from pathlib import Path
 from urllib.parse import urlparse, parse_qs
+import os
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from turnstile import sign_handoff  # noqa: E402
 
-STORE: dict[str, tuple[float, str]] = {}
 TTL_SECONDS = 300.0  # tokens expire after 5 minutes
+MAX_SIZE = 10000
+LATENCY_SAMPLES = 2048
+
+logger = logging.getLogger("token_store")
+
+
+class TokenStore:
+    """Thread-safe TTL store. Insertion order == expiry order (fixed TTL)."""
+
+    def __init__(self, ttl: float = TTL_SECONDS, max_size: int = MAX_SIZE, clock=time.monotonic) -> None:
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._clock = clock
+        # id -> (expires_at, token)
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stores = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def _expire(self, now: float) -> None:
+        # caller holds the lock
+        while self._entries:
+            id_, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[id_]
+            self.expirations += 1
+
+    def put(self, token: str) -> str:
+        id_ = uuid.uuid4().hex
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[id_] = (now + self.ttl, token)
+            self.stores += 1
+        return id_
+
+    def get(self, id_: str, consume: bool = True) -> Optional[str]:
+        with self._lock:
+            self._expire(self._clock())
+            entry = self._entries.pop(id_, None) if consume else self._entries.get(id_)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(self._clock())
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "stores": self.stores,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
+
+
+class LatencyRecorder:
+    """Keeps the last LATENCY_SAMPLES request durations per endpoint."""
+
+    def __init__(self) -> None:
+        self._samples: dict[str, deque] = {}
+        self._counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(endpoint, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            snapshot = {k: sorted(v) for k, v in self._samples.items()}
+            counts = dict(self._counts)
+        out = {}
+        for endpoint, values in snapshot.items():
+            pct = lambda q: values[min(len(values) - 1, int(len(values) * q))] * 1000  # noqa: E731
+            out[endpoint] = {
+                "requests": counts[endpoint],
+                "p50_ms": round(pct(0.50), 3),
+                "p99_ms": round(pct(0.99), 3),
+                "max_ms": round(values[-1] * 1000, 3),
+            }
+        return out
+
+
+class TokenStoreServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, store: TokenStore, handoff_key: Optional[bytes] = None) -> None:
+        super().__init__(address, TokenStoreHandler)
+        self.store = store
+        self.handoff_key = handoff_key
+        self.latency = LatencyRecorder()
 
 
 class TokenStoreHandler(BaseHTTPRequestHandler):
-    def _set_cors_headers(self, status=200):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; without TCP_NODELAY keep-alive clients
+    # wait for the delayed ACK (~40ms) on every response
+    disable_nagle_algorithm = True
+    server: TokenStoreServer
+
+    def log_message(self, format, *args):  # noqa: A002 - signature of the base class
+        # the default access log writes to stderr synchronously; we log per action instead
+        pass
+
+    def _send_json(self, status: int, body: dict) -> None:
+        raw = json.dumps(body).encode()
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
         # Allow local pages (served from a different port) to POST
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
         self.end_headers()
+        if raw:
+            self.wfile.write(raw)
+
+    def _timed(self, endpoint: str, started: float) -> None:
+        self.server.latency.record(endpoint, time.perf_counter() - started)
 
     def do_OPTIONS(self):
-        self._set_cors_headers(200)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.end_headers()
 
     def do_POST(self):
-        if self.path != "/store":
-            self._set_cors_headers(404)
-            self.wfile.write(json.dumps({"error": "not found"}).encode())
-            return
+        started = time.perf_counter()
         length = int(self.headers.get("content-length", "0"))
         raw = self.rfile.read(length) if length else b""
+        if self.path not in ("/store", "/sign") or (self.path == "/sign" and not self.server.handoff_key):
+            self._send_json(404, {"error": "not found"})
+            return
         try:
             payload = json.loads(raw.decode("utf-8"))
             token = payload.get("token")
             if not token:
                 raise ValueError("missing token")
         except Exception as e:
-            self._set_cors_headers(400)
-            self.wfile.write(json.dumps({"error": "invalid payload", "detail": str(e)}).encode())
+            self._send_json(400, {"error": "invalid payload", "detail": str(e)})
             return
 
-        # cleanup expired entries
-        now = time.time()
-        to_delete = [k for k, (ts, _) in STORE.items() if now - ts > TTL_SECONDS]
-        for k in to_delete:
-            del STORE[k]
-
-        id_ = uuid.uuid4().hex
-        STORE[id_] = (time.time(), token)
-        # log the store action for debugging (include User-Agent)
         ua = self.headers.get("User-Agent", "<no-ua>")
-        print(f"[token_store] STORE id={id_} from={self.client_address[0]} ua={ua}")
-        self._set_cors_headers(200)
-        self.wfile.write(json.dumps({"id": id_}).encode())
+        if self.path == "/sign":
+            # nothing is stored; the envelope itself carries the token until it expires
+            envelope = sign_handoff(token, self.server.handoff_key, self.server.store.ttl)
+            logger.info("SIGN token_len=%d from=%s ua=%s", len(token), self.client_address[0], ua)
+            self._send_json(200, {"id": envelope})
+            self._timed("/sign", started)
+            return
+        id_ = self.server.store.put(token)
+        # log the store action for debugging (include User-Agent)
+        logger.info("STORE id=%s from=%s ua=%s", id_, self.client_address[0], ua)
+        self._send_json(200, {"id": id_})
+        self._timed("/store", started)
 
     def do_GET(self):
+        started = time.perf_counter()
         parsed = urlparse(self.path)
+        if parsed.path == "/metrics":
+            self._send_json(200, {**self.server.store.stats(), "latency": self.server.latency.summary()})
+            return
         # Support two GET endpoints:
         #  - /retrieve?id=...  (one-time consume)
         #  - /peek?id=...      (check existence without consuming)
         if parsed.path not in ("/retrieve", "/peek"):
-            self._set_cors_headers(404)
-            self.wfile.write(json.dumps({"error": "not found"}).encode())
+            self._send_json(404, {"error": "not found"})
             return
         qs = parse_qs(parsed.query)
         id_ = qs.get("id", [None])[0]
         if not id_:
-            self._set_cors_headers(400)
-            self.wfile.write(json.dumps({"error": "missing id"}).encode())
-            return
-        entry = STORE.get(id_)
-        if not entry:
-            # log not found
-            ua = self.headers.get('User-Agent', '<no-ua>')
-            print(f"[token_store] RETRIEVE id={id_} not_found from={self.client_address[0]} ua={ua}")
-            self._set_cors_headers(404)
-            self.wfile.write(json.dumps({"error": "not found"}).encode())
+            self._send_json(400, {"error": "missing id"})
             return
-        ts, token = entry
-        # If this is a peek, do not remove the entry
-        if parsed.path == "/peek":
-            ua = self.headers.get("User-Agent", "<no-ua>")
-            print(f"[token_store] PEEK id={id_} present from={self.client_address[0]} ua={ua}")
-            self._set_cors_headers(200)
-            self.wfile.write(json.dumps({"found": True}).encode())
-            return
-
-        # Otherwise this is /retrieve: remove after retrieval to make it one-time
-        try:
-            del STORE[id_]
-        except KeyError:
-            pass
-        # log successful retrieve (include User-Agent)
+        peek = parsed.path == "/peek"
+        token = self.server.store.get(id_, consume=not peek)
         ua = self.headers.get("User-Agent", "<no-ua>")
-        print(f"[token_store] RETRIEVE id={id_} token_len={len(token)} from={self.client_address[0]} ua={ua}")
-        self._set_cors_headers(200)
-        self.wfile.write(json.dumps({"token": token}).encode())
+        if token is None:
+            logger.info("%s id=%s not_found from=%s ua=%s", "PEEK" if peek else "RETRIEVE", id_, self.client_address[0], ua)
+            self._send_json(404, {"error": "not found"})
+        elif peek:
+            logger.info("PEEK id=%s present from=%s ua=%s", id_, self.client_address[0], ua)
+            self._send_json(200, {"found": True})
+        else:
+            logger.info("RETRIEVE id=%s token_len=%d from=%s ua=%s", id_, len(token), self.client_address[0], ua)
+            self._send_json(200, {"token": token})
+        self._timed(parsed.path, started)
+
+
+def start_log_listener(quiet: bool = False) -> QueueListener:
+    """Route `token_store` logs through a queue; the listener thread does the actual I/O."""
+    logger.propagate = False
+    logger.setLevel(logging.WARNING if quiet else logging.INFO)
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    logger.handlers[:] = [QueueHandler(log_queue)]
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("[token_store] %(message)s"))
+    listener = QueueListener(log_queue, stream)
+    listener.start()
+    return listener
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("--host", default="127.0.0.1")
     p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--ttl", type=float, default=TTL_SECONDS, help="seconds before a token expires")
+    p.add_argument("--max-size", type=int, default=MAX_SIZE, help="oldest tokens are evicted beyond this")
+    p.add_argument("--quiet", action="store_true", help="do not log each request")
     args = p.parse_args()
+    listener = start_log_listener(args.quiet)
     server_address = (args.host, args.port)
-    httpd = HTTPServer(server_address, TokenStoreHandler)
-    print(f"Token store listening on http://{args.host}:{args.port} (TTL={TTL_SECONDS}s)")
+    key = os.environ.get("TURNSTILE_HANDOFF_KEY")
+    httpd = TokenStoreServer(server_address, TokenStore(args.ttl, args.max_size), key.encode("utf-8") if key else None)
+    print(f"Token store listening on http://{args.host}:{args.port} (TTL={args.ttl}s, max_size={args.max_size})", flush=True)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("Shutting down")
         httpd.server_close()
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
@@ -2,7 +2,11 @@
 
 from __future__ import annotations
 
+import hashlib
+import os
 import re
+import tempfile
+import time
 from pathlib import Path
 from typing import Optional
 
@@ -10,7 +14,24 @@ from typing import Optional
 BASE_DIR = Path(__file__).resolve().parent
 MEDIA_ROOT = BASE_DIR / "data"
 DISH_PHOTO_ROOT = MEDIA_ROOT / "dishes"
+# 写真の本体は内容の SHA-256 で置き場所を決める（同じ写真は 1 つだけ保存する。photo_store.py）
+PHOTO_STORE_ROOT = MEDIA_ROOT / "photos"
 USER_MEDIA_ROOT = MEDIA_ROOT / "users"
+# 書き込み途中のアップロードを置く場所。本番の保存先と同じファイルシステムに置き、
+# rename だけで確定できるようにする
+STAGING_ROOT = MEDIA_ROOT / ".staging"
+STAGED_SUFFIX = ".part"
+# アップロードを一時ファイルへ書き出すときの 1 回の読み書きの大きさ
+STAGE_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLargeError(ValueError):
+    """アップロードされたファイルが上限のバイト数を超えている。"""
+
+    def __init__(self, size: int, limit: int) -> None:
+        super().__init__(f"ファイルが大きすぎます（上限 {limit / 1024 / 1024:.0f} MB）")
+        self.size = size
+        self.limit = limit
 
 
 def ensure_storage_dirs() -> None:
@@ -21,6 +42,8 @@ def ensure_storage_dirs() -> None:
     """
     DISH_PHOTO_ROOT.mkdir(parents=True, exist_ok=True)
     USER_MEDIA_ROOT.mkdir(parents=True, exist_ok=True)
+    STAGING_ROOT.mkdir(parents=True, exist_ok=True)
+    PHOTO_STORE_ROOT.mkdir(parents=True, exist_ok=True)
 
 
 def _sanitize_suffix(filename: Optional[str]) -> str:
@@ -40,6 +63,9 @@ def build_dish_photo_path(
 ) -> Path:
     """写真の保存パスを返す。
 
+    料理ごとに写真を置く従来の配置です。新しい写真は `content_photo_path()` の
+    配置に保存され、従来の配置の写真は `python photo_store.py migrate` で移せます。
+
     既存の呼び出しとの互換性を保つため、`user_id` が指定されない場合は従来の
     `data/dishes/<dish_id>/cover.<ext>` を返します。`user_id` を指定すると
     `data/users/<user_id>/dishes/<dish_id>/cover.<ext>` に保存されます。
@@ -56,15 +82,145 @@ def build_dish_photo_path(
     return dish_dir / f"cover{suffix}"
 
 
-def public_url_for_photo(photo_path: Path) -> str:
+def hash_photo_file(path: Path) -> str:
+    """ファイルの内容の SHA-256（16 進）を `STAGE_CHUNK_SIZE` ずつ読んで計算する。"""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(STAGE_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_photo_path(photo_hash: str, suffix: str = ".jpg") -> Path:
+    """内容のハッシュから決まる写真の保存先 `data/photos/<2 桁>/<2 桁>/<hash><ext>` を返す。
+
+    1 つのディレクトリにファイルが集中しないよう、ハッシュの先頭 4 文字で 2 段に分ける。
+    """
+    return PHOTO_STORE_ROOT / photo_hash[:2] / photo_hash[2:4] / f"{photo_hash}{suffix}"
+
+
+def _fsync_dir(directory: Path) -> None:
+    """ディレクトリエントリ（作成・rename）をディスクに反映する。対応しない OS では何もしない。"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def stage_upload(data, max_bytes: Optional[int] = None) -> Path:
+    """アップロードされた写真を一時ファイルに書き出して fsync し、そのパスを返す。
+
+    DB の書き込みトランザクションを開く前に呼ぶことで、大きな写真の書き込み中に
+    他の書き込みを待たせないようにする。確定は `commit_staged_upload()`、破棄は
+    `discard_staged_upload()` で行う。
+
+    `data` はバイト列か、`read()` できるファイルオブジェクト（Streamlit の UploadedFile など）。
+    ファイルオブジェクトは `STAGE_CHUNK_SIZE` ずつ読んで書き出すので、全体をもう 1 つ
+    メモリ上に複製しない。`max_bytes` を超えたら書きかけのファイルを消して
+    `UploadTooLargeError` を送出する。
+    """
+    ensure_storage_dirs()
+    fd, name = tempfile.mkstemp(dir=STAGING_ROOT, suffix=STAGED_SUFFIX)
+    staged = Path(name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if hasattr(data, "read"):
+                if hasattr(data, "seek"):
+                    data.seek(0)
+                written = 0
+                while chunk := data.read(STAGE_CHUNK_SIZE):
+                    written += len(chunk)
+                    if max_bytes is not None and written > max_bytes:
+                        raise UploadTooLargeError(written, max_bytes)
+                    f.write(chunk)
+            else:
+                if max_bytes is not None and len(data) > max_bytes:
+                    raise UploadTooLargeError(len(data), max_bytes)
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        staged.unlink(missing_ok=True)
+        raise
+    return staged
+
+
+def new_staged_path() -> Path:
+    """中身を後から書き込む一時ファイルを作ってパスを返す（写真の正規化の出力先など）。"""
+    ensure_storage_dirs()
+    fd, name = tempfile.mkstemp(dir=STAGING_ROOT, suffix=STAGED_SUFFIX)
+    os.close(fd)
+    return Path(name)
+
+
+def commit_staged_upload(staged: Path, destination: Path) -> None:
+    """一時ファイルを最終的な保存先へ rename する（同じファイルシステム内なのでアトミック）。"""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(staged, destination)
+    _fsync_dir(destination.parent)
+
+
+def discard_staged_upload(staged: Optional[Path]) -> None:
+    """確定しなかった一時ファイルを消す。"""
+    if staged is not None:
+        staged.unlink(missing_ok=True)
+
+
+_last_cleanup = 0.0
+
+
+def cleanup_staged_uploads(max_age_seconds: float = 3600.0, min_interval_seconds: float = 600.0) -> int:
+    """プロセスが途中で落ちて残った一時ファイルのうち、古いものを削除して件数を返す。
+
+    書き込み中のファイルを消さないよう、更新から `max_age_seconds` 以上経ったものだけを対象にする。
+    rerun のたびに呼ばれても走査は `min_interval_seconds` に 1 回だけ行う。
+    """
+    global _last_cleanup
+    now = time.time()
+    if now - _last_cleanup < min_interval_seconds:
+        return 0
+    _last_cleanup = now
+    if not STAGING_ROOT.exists():
+        return 0
+    cutoff = now - max_age_seconds
+    removed = 0
+    for path in STAGING_ROOT.glob(f"*{STAGED_SUFFIX}"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def public_url_for_photo(photo_path: Optional[Path], photo_hash: Optional[str] = None) -> str:
     """公開用の URL / パスを返すヘルパ。
 
-    現在はローカルファイルパスをそのまま返します。将来的に GCS/S3 を使う場合は
-    環境変数で切り替えられるようにここを集約してください。
+    `photo_hash` があれば内容のハッシュから保存先（`content_photo_path()`）を引く。
+    `photo_path` に縮小版（`<hash>.w640.webp` など）を渡せば、同じディレクトリのそのファイルになる。
+    `PHOTO_PUBLIC_BASE_URL` が設定されていれば、その下の `<2 桁>/<2 桁>/<ファイル名>` を返す
+    （内容が変わると URL も変わるので、CDN などで無期限にキャッシュできる）。
+    ハッシュの無い従来の配置の写真はローカルファイルパスをそのまま返します。
     """
+    if photo_hash:
+        name = photo_path.name if photo_path is not None else ""
+        if name.startswith(photo_hash):
+            path = content_photo_path(photo_hash, name[len(photo_hash):])
+        else:
+            path = content_photo_path(photo_hash, _sanitize_suffix(name) if name else ".jpg")
+        base_url = os.environ.get("PHOTO_PUBLIC_BASE_URL", "").strip().rstrip("/")
+        if base_url:
+            return f"{base_url}/{path.relative_to(PHOTO_STORE_ROOT).as_posix()}"
+        return str(path)
     # NOTE: Streamlit の `st.image()` はローカルパスや URL を受け取れるため
     # ここではシンプルに文字列化して返します。
-    try:
-        return str(photo_path)
-    except Exception:
+    if photo_path is None:
         return ""
+    return str(photo_path)
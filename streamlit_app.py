@@ -1,63 +1,75 @@
 from __future__ import annotations
 
+import logging
 import re
 import sqlite3
+import time
 from pathlib import Path
 from typing import Iterable, Optional
 
 import streamlit as st
 
-from db import DB_PATH, apply_migrations
-from storage import build_dish_photo_path, ensure_storage_dirs
+from db import apply_migrations, get_manager, read_connection, run_write
+from query_cache import get_shared_cache
+from rate_limit import RateDecision, client_keys, get_login_throttle, get_rate_limiter
+from turnstile import get_handoff_resolver, get_turnstile_client
+from photo_store import discard_unreferenced_photo, put_photo
+from storage import (
+    cleanup_staged_uploads,
+    discard_staged_upload,
+    ensure_storage_dirs,
+    public_url_for_photo,
+    UploadTooLargeError,
+)
 import uuid
 from datetime import datetime
 import os
-import requests
-from passlib.context import CryptContext
-
-# Password hashing context: prefer argon2, keep pbkdf2_sha256 for existing hashes
-pwd_ctx = CryptContext(
-    schemes=["argon2", "pbkdf2_sha256"],
-    default="argon2",
-    pbkdf2_sha256__rounds=29000,
-    argon2__memory_cost=65536,
-    argon2__time_cost=2,
-    argon2__parallelism=4,
+from passwords import HashingBusyError, get_password_hasher, get_rehash_queue
+from app_logging import get_logger, log_event, setup_logging
+from images import (
+    InvalidPhotoError,
+    PhotoProcessingUnavailableError,
+    best_variant,
+    get_photo_ingester,
+    schedule_variants,
 )
 
+# ログはキュー経由で別スレッドが書き出す（app_logging.py）。起動時に 1 回だけ "startup" を記録する
+setup_logging()
+logger = get_logger("app")
+
+# Password hashing: argon2 preferred, pbkdf2_sha256 kept for existing hashes.
+# 計算は passwords.py のワーカープロセスで行い、同時実行数を制限する
+pwd_hasher = get_password_hasher()
+HASHING_BUSY_MESSAGE = "ただいま混み合っています。少し待ってからもう一度お試しください。"
+# ログイン失敗が続いたユーザー名・IP は待ち時間を指数的に延ばす（rate_limit.LoginThrottle）
+login_throttle = get_login_throttle()
+
+# 一覧・ギャラリー・タグ一覧の読み取り結果をセッションをまたいで共有するキャッシュ。
+# DB が更新される（data_version が変わる）と該当エントリは自動的に捨てられる
+read_cache = get_shared_cache()
+
+
+def cached_query(sql: str, params: Iterable[object] = ()) -> list[sqlite3.Row]:
+    """読み取りクエリを `read_cache` 経由で実行する。キーは SQL とパラメータ。"""
+    params = tuple(params)
 
-def get_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    def _run() -> list[sqlite3.Row]:
+        with read_connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    rows = read_cache.get_or_compute((sql, params), get_manager().data_version(), _run)
+    # 呼び出し側がリストを書き換えてもキャッシュに影響しないようコピーを返す
+    return list(rows)
 
 
 def verify_turnstile_token(token: str, timeout: float = 5.0) -> bool:
     """Verify a Turnstile token with Cloudflare, or succeed in test mode.
 
     Returns True if verification is considered successful.
+    接続の再利用・結果のキャッシュ・同一トークンの合流は turnstile.TurnstileClient が行う。
     """
-    # CI / E2E test mode: treat as success without calling external API
-    test_mode = os.environ.get("TURNSTILE_TEST_MODE")
-    if test_mode and test_mode.lower() in ("1", "true", "yes"):
-        return True
-
-    secret = os.environ.get("TURNSTILE_SECRET")
-    if not secret:
-        # No secret configured: do not attempt real verification here.
-        return False
-
-    try:
-        resp = requests.post(
-            "https://challenges.cloudflare.com/turnstile/v0/siteverify",
-            data={"secret": secret, "response": token},
-            timeout=timeout,
-        )
-        resp.raise_for_status()
-        j = resp.json()
-        return bool(j.get("success"))
-    except Exception:
-        return False
+    return get_turnstile_client().verify(token, timeout=timeout, remoteip=client_ip())
 
 
 def parse_tags_input(raw: str) -> list[str]:
@@ -88,11 +100,49 @@ def split_tags_field(tags_field: str | None) -> list[str]:
     return [t.strip() for t in tags_field.split(",") if t.strip()]
 
 
+def replace_dish_tags(conn: sqlite3.Connection, dish_id: int, tags: Iterable[str]) -> None:
+    """dish_tags を指定のタグ一覧で置き換える（tags 側の usage_count はトリガーで更新）。
+
+    呼び出し側のトランザクション内で実行する。
+    """
+    names = [t.strip() for t in tags if t.strip()]
+    conn.execute("DELETE FROM dish_tags WHERE dish_id = ?", (dish_id,))
+    if not names:
+        return
+    conn.executemany(
+        "INSERT INTO tags (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+        [(name,) for name in names],
+    )
+    # created_at は dishes から写して、タグ別の新着順インデックスに使う
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO dish_tags (tag_id, dish_id, created_at)
+        SELECT tags.id, dishes.id, dishes.created_at
+        FROM tags, dishes
+        WHERE tags.name = ? AND dishes.id = ?
+        """,
+        [(name, dish_id) for name in names],
+    )
+
+
 def is_valid_recipe_url(url: str) -> bool:
     lower = url.lower()
     return lower.startswith("http://") or lower.startswith("https://")
 
 
+def client_ip() -> str | None:
+    """接続元の IP アドレス（取得できない環境では None）。"""
+    try:
+        return st.context.ip_address
+    except Exception:
+        return None
+
+
+def rate_limited_message(decision: RateDecision) -> str:
+    minutes = max(1, int(decision.retry_after // 60) + 1)
+    return f"試行回数が多すぎます。約 {minutes} 分後にもう一度お試しください。"
+
+
 def insert_dish(
     name: str,
     recipe_url: str | None,
@@ -103,12 +153,28 @@ def insert_dish(
     is_public: bool = False,
     owner_id: int | None = None,
 ) -> int:
-    tags_text = tags_to_text(parse_tags_input(tags_raw))
+    """料理を 1 件登録して id を返す。
+
+    写真は書き込みトランザクションの外で一時ファイルに受け取り、正規化（向きの反映・縮小・
+    再圧縮・EXIF 除去、images.py）して fsync しておき、トランザクション内では
+    `photo_path` / `photo_hash` を含む INSERT 1 回と rename だけを行う。
+    写真は内容のハッシュで決まる場所に保存し、同じ写真が既にあれば参照数を増やすだけにする
+    （photo_store.py）。上限を超える写真は `UploadTooLargeError`、画像でないファイルは
+    `InvalidPhotoError`、正規化のプロセスが使えなければ `PhotoProcessingUnavailableError`。途中で失敗した場合は一時ファイルと、新しく置いた写真（他から参照されて
+    いなければ）を削除する。
+    新しく置いた写真は、縮小版の生成をバックグラウンドで始める。
+    """
+    tag_list = parse_tags_input(tags_raw)
+    tags_text = tags_to_text(tag_list)
+    ingested = None
     photo_path: Path | None = None
+    created_photo = False
+    if photo_file is not None:
+        # UploadedFile を少しずつ読み出すので、写真の複製をメモリ上に作らない
+        ingested = get_photo_ingester().ingest(photo_file, photo_file.name)
 
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
+    def _insert(conn: sqlite3.Connection) -> int:
+        nonlocal photo_path, created_photo
         # 柔軟に owner_id に対応する: テーブルに owner_id カラムが存在する場合のみ挿入する
         def _has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
             cur = conn.execute(f"PRAGMA table_info({table})")
@@ -121,125 +187,218 @@ def insert_dish(
             columns.append("owner_id")
             params.append(owner_id)
 
+        if ingested is not None:
+            # 保存先は内容のハッシュで決まるので、料理の id を先に採番する必要は無い
+            photo_path, created_photo = put_photo(conn, ingested.staged, ingested.sha256, ingested.suffix)
+            columns[:0] = ["photo_path", "photo_hash"]
+            params[:0] = [str(photo_path), ingested.sha256]
+
         placeholders = ", ".join(["?"] * len(columns))
         sql = f"INSERT INTO dishes ({', '.join(columns)}) VALUES ({placeholders})"
-        cur.execute(sql, params)
-        dish_id = cur.lastrowid
+        dish_id = conn.execute(sql, params).lastrowid
+        replace_dish_tags(conn, dish_id, tag_list)
+        return dish_id
 
-        if photo_file is not None:
-            sanitized_filename = Path(photo_file.name).name.lower()
-            # user_id が指定されていれば保存先をユーザースコープにする
+    try:
+        dish_id = run_write(_insert)
+    except Exception:
+        # 書き込みスレッド側で rollback 済み（参照数も戻っている）。
+        # 一時ファイルと、このリクエストで新しく置いた写真を片付ける
+        if ingested is not None:
+            discard_staged_upload(ingested.staged)
+        if created_photo and photo_path is not None:
+            # 同じ写真をその後に別のリクエストが参照しているかもしれないので、書き込みスレッドで確かめてから消す
             try:
-                photo_path = build_dish_photo_path(dish_id, sanitized_filename, user_id=owner_id)
-            except TypeError:
-                # 互換性: 古い storage.build_dish_photo_path シグネチャの場合は従来の呼び出しにフォールバック
-                photo_path = build_dish_photo_path(dish_id, sanitized_filename)
-            with photo_path.open("wb") as f:
-                f.write(photo_file.getbuffer())
-            cur.execute(
-                "UPDATE dishes SET photo_path = ? WHERE id = ?",
-                (str(photo_path), dish_id),
-            )
+                run_write(lambda conn: discard_unreferenced_photo(conn, ingested.sha256, photo_path))
+            except Exception:
+                # 消せなくても参照されていないファイルが残るだけ
+                log_event(logger, logging.WARNING, "photo_cleanup_failed", exc_info=True)
+        raise
+    if ingested is not None:
+        # 既にあった写真を参照した場合は、使われなかった一時ファイルが残っている
+        discard_staged_upload(ingested.staged)
+        if created_photo:
+            # 一覧・ギャラリー用の縮小版は保存後にバックグラウンドで作る（images.py）
+            schedule_variants(photo_path)
+    return dish_id
 
-        # ensure is_public persisted for photo uploads as well
-        if is_public:
-            cur.execute("UPDATE dishes SET is_public = ? WHERE id = ?", (1, dish_id))
 
-        conn.commit()
-        return dish_id
-    except Exception:
-        conn.rollback()
-        if photo_path and photo_path.exists():
-            photo_path.unlink(missing_ok=True)
-        raise
-    finally:
-        conn.close()
+def fetch_tag_counts() -> list[tuple[str, int]]:
+    """使用中のタグと使用件数を名前順（大文字小文字は区別しない）で返す。"""
+    rows = cached_query("SELECT name, usage_count FROM tags WHERE usage_count > 0 ORDER BY name")
+    return [(row["name"], row["usage_count"]) for row in rows]
 
 
 def fetch_all_tags() -> list[str]:
-    conn = get_connection()
-    try:
-        rows = conn.execute("SELECT tags FROM dishes WHERE tags <> ''").fetchall()
-    finally:
-        conn.close()
+    return [name for name, _ in fetch_tag_counts()]
 
-    tag_set: set[str] = set()
-    for row in rows:
-        tag_set.update(split_tags_field(row["tags"]))
-    return sorted(tag_set, key=str.lower)
 
+# 一覧タブ / 公開ギャラリーの 1 ページあたりの表示件数
+LIST_PAGE_SIZE = 20
+GALLERY_PAGE_SIZE = 24
+# カードの写真列（wide レイアウトで幅 約 400px）を高解像度の画面でも粗く見せない幅
+CARD_IMAGE_WIDTH = 640
 
-def fetch_dishes(
+# trigram トークナイザは 3 文字未満の語を索引できないため、それより短い
+# キーワードは LIKE による部分一致にフォールバックする
+FTS_MIN_KEYWORD_LENGTH = 3
+
+
+def fts_phrase(keyword: str) -> str:
+    """キーワードを FTS5 の MATCH 用フレーズ（ダブルクォートで囲んだ文字列）に変換する。"""
+    return '"' + keyword.replace('"', '""') + '"'
+
+
+def build_dish_query(
     keyword: str = "",
     tags: list[str] | None = None,
     favorite_only: bool = False,
     public_only: bool = False,
     limit: int = 50,
-) -> list[sqlite3.Row]:
-    tags = tags or []
-    conn = get_connection()
-    try:
-        where = ["1=1"]
-        params: list[str | int] = []
+    cursor: tuple | None = None,
+) -> tuple[str, list[str | int | float]]:
+    """`fetch_dishes()` が実行する SQL とパラメータを組み立てる。
 
-        if keyword:
-            like = f"%{keyword.lower()}%"
+    scripts/check_query_plans.py からも呼び出し、全フィルタの組み合わせで
+    クエリプランを検査する。
+    """
+    tags = list(tags or [])
+    columns = "dishes.*"
+    source = "dishes"
+    where = ["1=1"]
+    params: list[str | int | float] = []
+    order_by = "dishes.created_at DESC, dishes.id DESC"
+    cursor_columns = "(dishes.created_at, dishes.id)"
+    use_fts = bool(keyword) and len(keyword) >= FTS_MIN_KEYWORD_LENGTH
+
+    if tags and not use_fts:
+        # 先頭のタグは dish_tags の (tag_id, created_at, dish_id) インデックスを新しい順に
+        # たどる。CROSS JOIN で dish_tags を外側に固定し、並べ替えを発生させない
+        source = "dish_tags AS t0 CROSS JOIN dishes ON dishes.id = t0.dish_id"
+        where.append("t0.tag_id = (SELECT id FROM tags WHERE name = ?)")
+        params.append(tags.pop(0))
+        order_by = "t0.created_at DESC, t0.dish_id DESC"
+        cursor_columns = "(t0.created_at, t0.dish_id)"
+
+    if use_fts:
+        columns = "dishes.*, dishes_fts.rank AS search_rank"
+        source = "dishes_fts JOIN dishes ON dishes.id = dishes_fts.rowid"
+        where.append("dishes_fts MATCH ?")
+        params.append(fts_phrase(keyword))
+        # rank は既定で bm25()。値が小さいほど関連度が高い
+        order_by = "dishes_fts.rank, dishes.id DESC"
+        if cursor is not None:
             where.append(
-                "(LOWER(name) LIKE ? OR LOWER(memo_user) LIKE ? OR LOWER(recipe_url) LIKE ?)"
+                "(dishes_fts.rank > ? OR (dishes_fts.rank = ? AND dishes.id < ?))"
             )
-            params.extend([like, like, like])
+            params.extend([cursor[0], cursor[0], cursor[1]])
+    elif keyword:
+        like = f"%{keyword.lower()}%"
+        where.append(
+            "(LOWER(dishes.name) LIKE ? OR LOWER(dishes.memo_user) LIKE ?"
+            " OR LOWER(dishes.tags) LIKE ? OR LOWER(dishes.recipe_url) LIKE ?)"
+        )
+        params.extend([like, like, like, like])
 
-        for tag in tags:
-            where.append("LOWER(tags) LIKE ?")
-            params.append(f"%{tag.lower()}%")
+    # 残りのタグは完全一致の AND 条件。dish_tags の主キー (tag_id, dish_id) で存在確認する
+    for tag in tags:
+        where.append(
+            "EXISTS (SELECT 1 FROM dish_tags WHERE dish_tags.dish_id = dishes.id"
+            " AND dish_tags.tag_id = (SELECT id FROM tags WHERE name = ?))"
+        )
+        params.append(tag)
 
-        if favorite_only:
-            where.append("favorite = 1")
+    if favorite_only:
+        where.append("dishes.favorite = 1")
 
-        if public_only:
-            where.append("is_public = 1")
+    if public_only:
+        where.append("dishes.is_public = 1")
 
-        sql = f"""
-            SELECT *
-            FROM dishes
-            WHERE {' AND '.join(where)}
-            ORDER BY created_at DESC
-            LIMIT ?
-        """
-        params.append(limit)
-        cur = conn.execute(sql, params)
-        return cur.fetchall()
-    finally:
-        conn.close()
+    if cursor is not None and not use_fts:
+        where.append(f"{cursor_columns} < (?, ?)")
+        params.extend([cursor[0], cursor[1]])
+
+    sql = f"""
+        SELECT {columns}
+        FROM {source}
+        WHERE {' AND '.join(where)}
+        ORDER BY {order_by}
+        LIMIT ?
+    """
+    params.append(limit)
+    return sql, params
+
+
+def fetch_dishes(
+    keyword: str = "",
+    tags: list[str] | None = None,
+    favorite_only: bool = False,
+    public_only: bool = False,
+    limit: int = 50,
+    cursor: tuple | None = None,
+) -> list[sqlite3.Row]:
+    """条件に合う料理を返す。
+
+    キーワードは料理名 / メモ / タグ / URL を対象に FTS5（dishes_fts）で検索し、
+    bm25 の関連度順に並べる。キーワードが無い場合は新しい順（created_at, id の降順）。
+
+    `cursor` には前ページ最終行の `dish_cursor(row)` を渡す（キーセットページング）。
+    OFFSET を使わないので、何ページ目でもインデックスの範囲検索 1 回で済む。
+    """
+    # キャッシュのキーを揃えるため、同じ意味の条件は同じ引数に正規化する
+    keyword = keyword.strip()
+    tags = sorted({t.strip() for t in tags or [] if t.strip()}, key=str.lower)
+    sql, params = build_dish_query(keyword, tags, favorite_only, public_only, limit, cursor)
+    return cached_query(sql, params)
+
+
+def dish_cursor(row: sqlite3.Row) -> tuple:
+    """`fetch_dishes(cursor=...)` に渡す、この行の並び順上の位置を返す。"""
+    if "search_rank" in row.keys():
+        return (row["search_rank"], row["id"])
+    return (row["created_at"], row["id"])
+
+
+def fetch_profile(username: str) -> tuple[int, list[sqlite3.Row]] | None:
+    """ユーザーの投稿数と最近の投稿（最大 100 件）を返す。ユーザーがいなければ None。"""
+    with read_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE username = ?", (username,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        uid = row[0]
+        cur.execute("SELECT COUNT(*) FROM dishes WHERE owner_id = ?", (uid,))
+        cnt = cur.fetchone()[0]
+        cur.execute("SELECT id, name, created_at FROM dishes WHERE owner_id = ? ORDER BY created_at DESC LIMIT 100", (uid,))
+        return cnt, cur.fetchall()
 
 
 def update_favorite_flag(dish_id: int, favorite: bool) -> None:
-    conn = get_connection()
-    try:
-        conn.execute(
+    run_write(
+        lambda conn: conn.execute(
             "UPDATE dishes SET favorite = ? WHERE id = ?",
             (1 if favorite else 0, dish_id),
         )
-        conn.commit()
-    finally:
-        conn.close()
+    )
 
 
-def render_tag_buttons(tags: list[str], dish_id: int) -> None:
+def render_tag_buttons(tags: list[str], dish_id: int, key_prefix: str = "") -> None:
     if not tags:
         return
 
     cols = st.columns(min(4, len(tags)))
     for idx, tag in enumerate(tags):
         col = cols[idx % len(cols)]
-        if col.button(f"#{tag}", key=f"tagpill-{dish_id}-{idx}"):
+        if col.button(f"#{tag}", key=f"{key_prefix}tagpill-{dish_id}-{idx}"):
             current = st.session_state.get("tag_filter", [])
             if tag not in current:
                 st.session_state["tag_filter"] = current + [tag]
             st.experimental_rerun()
 
 
-def render_dish_card(row: sqlite3.Row) -> None:
+def render_dish_card(row: sqlite3.Row, key_prefix: str = "") -> None:
+    # 同じ料理が一覧とギャラリーの両方に出るため、ボタンの key はタブごとに分ける
     tags = split_tags_field(row["tags"])
     favorite = bool(row["favorite"])
     photo_path = Path(row["photo_path"]) if row["photo_path"] else None
@@ -249,7 +408,12 @@ def render_dish_card(row: sqlite3.Row) -> None:
     if has_photo:
         photo_col, body_col = container.columns([1, 2])
         with photo_col:
-            st.image(str(photo_path), use_column_width=True)
+            # 元の写真ではなく、カードの表示幅を満たす最小の縮小版を使う。
+            # PHOTO_PUBLIC_BASE_URL があれば、ローカルのパスではなくその下の URL で表示する
+            st.image(
+                public_url_for_photo(best_variant(photo_path, CARD_IMAGE_WIDTH), row["photo_hash"]),
+                use_column_width=True,
+            )
     else:
         body_col = container
 
@@ -263,104 +427,159 @@ def render_dish_card(row: sqlite3.Row) -> None:
         if row["recipe_url"]:
             st.markdown(f"[参考レシピを開く]({row['recipe_url']})", help="ブラウザで開く")
 
-        render_tag_buttons(tags, row["id"])
+        render_tag_buttons(tags, row["id"], key_prefix)
 
         fav_label = "★ お気に入りを解除" if favorite else "☆ お気に入りにする"
-        if st.button(fav_label, key=f"favorite-toggle-{row['id']}"):
+        if st.button(fav_label, key=f"{key_prefix}favorite-toggle-{row['id']}"):
             update_favorite_flag(row["id"], not favorite)
             st.experimental_rerun()
 
 
-def main() -> None:
-    st.set_page_config(page_title="Recipe Log", page_icon="🍳", layout="wide")
-    apply_migrations()
-    ensure_storage_dirs()
-
-    # Temporary debug: write a startup line so we can confirm the active Streamlit
-    # process is executing the current code and can write to the workspace path.
-    try:
-        debug_log = Path("/workspaces/CoCock_app") / "turnstile_debug.log"
-        with debug_log.open("a", encoding="utf-8") as df:
-            df.write(f"{datetime.utcnow().isoformat()} STARTUP pid={os.getpid()}\n")
-    except Exception:
-        pass
+def render_paged_dishes(state_key: str, page_size: int, empty_message: str, **filters) -> None:
+    """料理カードをページ単位で表示し、前へ / 次へで移動できるようにする。
 
-    if "last_saved_id" not in st.session_state:
-        st.session_state["last_saved_id"] = None
-    if "tag_filter" not in st.session_state:
-        st.session_state["tag_filter"] = []
-    if "submissions_in_session" not in st.session_state:
-        # ブラウザごとの簡易制限（セッション単位）
-        st.session_state["submissions_in_session"] = 0
+    各ページ先頭のカーソルを session_state にスタックとして持つ。フィルタ条件が
+    変わったら 1 ページ目に戻す。
+    """
+    signature = repr(sorted(filters.items()))
+    state = st.session_state.get(state_key)
+    if not state or state.get("signature") != signature:
+        state = {"signature": signature, "cursors": [None]}
+        st.session_state[state_key] = state
+
+    # 1 件多く取得して次ページの有無を判定する
+    rows = fetch_dishes(**filters, limit=page_size + 1, cursor=state["cursors"][-1])
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    page_no = len(state["cursors"])
+
+    if not rows:
+        st.info(empty_message)
+        return
 
-    # Turnstile token をクエリパラメータから受け取れるようにしておく（turnstile_test.html から自動遷移）
+    start = (page_no - 1) * page_size + 1
+    st.caption(f"{start}〜{start + len(rows) - 1} 件目を表示（{page_no} ページ目）")
+    for row in rows:
+        render_dish_card(row, key_prefix=f"{state_key}-")
+
+    def _prev() -> None:
+        if len(state["cursors"]) > 1:
+            state["cursors"].pop()
+
+    def _next() -> None:
+        state["cursors"].append(dish_cursor(rows[-1]))
+
+    prev_col, next_col = st.columns(2)
+    prev_col.button("← 前へ", key=f"{state_key}-prev", on_click=_prev, disabled=page_no == 1)
+    next_col.button("次へ →", key=f"{state_key}-next", on_click=_next, disabled=not has_next)
+
+
+def _looks_like_turnstile_token(value: str) -> bool:
+    return value.startswith("0.") and len(value) > 20
+
+
+def _store_turnstile_candidate(candidate: str | None, source: str, started: float) -> None:
+    state = st.session_state["turnstile_resolution"]
+    state["status"] = "done"
+    state["source"] = source if candidate else "none"
+    state["resolve_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    if candidate:
+        # 直接フォーム入力欄を書き換えて即時レンダリング競合を起こすと
+        # Streamlit フロントエンドで removeChild の NotFoundError が発生することがあるため
+        # 安全のため「候補」として保存し、ユーザーが明示的に適用するか確認するUIを出す。
+        st.session_state["turnstile_token_candidate"] = candidate
+    log_event(
+        logger,
+        logging.DEBUG,
+        "turnstile_candidate_resolved",
+        source=state["source"],
+        token_len=len(candidate) if candidate else 0,
+        resolve_ms=state["resolve_ms"],
+    )
+
+
+def resolve_turnstile_from_query() -> None:
+    """クエリパラメータから Turnstile token の候補を取り出す（セッションごとに 1 回）。
+
+    結果は `st.session_state["turnstile_resolution"]` に記録し、クエリが変わらない限り
+    以降の rerun では何もしない。token_store への問い合わせはバックグラウンドで行い、
+    終わったら `_poll_turnstile_resolution` が再描画する（最初の描画を待たせない）。
+    `last_rerun_ms` はこの rerun でかかった時間、`resolve_ms` は候補が反映されるまでの時間。
+    """
+    rerun_started = time.perf_counter()
     try:
-        # st.experimental_get_query_params は非推奨のため st.query_params を使用する
         params = st.query_params
-        candidate = None
-        if "turnstile_token" in params and params["turnstile_token"]:
-            # query_params の値はリストで返されるため最初の要素を使う
-            candidate = params["turnstile_token"][0]
-        # If a short id was provided, try to fetch the full token from a local token store
-        elif "turnstile_token_id" in params and params["turnstile_token_id"]:
-            short_id = params["turnstile_token_id"][0]
-            try:
-                # Debug: note that server is about to attempt retrieval from token_store
+        fingerprint = hash(tuple(sorted((k, tuple(params.get_all(k))) for k in params)))
+        state = st.session_state.get("turnstile_resolution")
+        if state is not None and state["fingerprint"] == fingerprint:
+            future = st.session_state.get("turnstile_resolution_future")
+            if state["status"] == "pending" and future is not None and future.done():
+                st.session_state.pop("turnstile_resolution_future", None)
                 try:
-                    debug_log = Path("/workspaces/CoCock_app") / "turnstile_debug.log"
-                    with debug_log.open("a", encoding="utf-8") as df:
-                        df.write(f"{datetime.utcnow().isoformat()} ATTEMPT_RETRIEVE id={short_id}\n")
+                    tok, backend = future.result()
                 except Exception:
-                    pass
-                # token_store をローカルで動かしている場合にのみ試みる (開発用)
-                resp = requests.get(f"http://127.0.0.1:8765/retrieve?id={short_id}", timeout=1)
-                if resp.status_code == 200:
-                    j = resp.json()
-                    tok = j.get("token")
-                    if tok:
-                        candidate = tok
-                        print("DEBUG: retrieved turnstile token from local token_store")
-                        try:
-                            with debug_log.open("a", encoding="utf-8") as df:
-                                df.write(f"{datetime.utcnow().isoformat()} SERVER_RETRIEVED id={short_id} len={len(tok)}\n")
-                        except Exception:
-                            pass
-            except Exception:
-                # 無理に失敗を伝えず、後続のスキャン処理にフォールバックする
-                pass
+                    tok, backend = None, "token_store"
+                _store_turnstile_candidate(tok, backend, state["started"])
+            state["last_rerun_ms"] = round((time.perf_counter() - rerun_started) * 1000, 3)
+            return
+
+        started = time.perf_counter()
+        state = {"fingerprint": fingerprint, "status": "pending", "started": started, "source": None}
+        st.session_state["turnstile_resolution"] = state
+        if "turnstile_token" in params:
+            # st.query_params[key] は最後の値の文字列を返すので、get_all で最初の値を取り出す
+            _store_turnstile_candidate(params.get_all("turnstile_token")[0], "query", started)
+        elif "turnstile_token_id" in params:
+            # If a short id was provided, resolve it to the full token.
+            # 署名付き封筒ならその場で検証し、token_store への問い合わせは別スレッドで行う
+            short_id = params.get_all("turnstile_token_id")[0]
+            resolver = get_handoff_resolver()
+            if resolver.needs_network(short_id):
+                st.session_state["turnstile_resolution_future"] = resolver.resolve_async(short_id)
+            else:
+                tok, backend = resolver.resolve(short_id)
+                _store_turnstile_candidate(tok, backend, started)
         else:
             # turnstile_token というキーがなければ、受け取った全てのクエリ値をスキャンして
             # Turnstile のトークンっぽい値 (先頭が 0. で長い) を探す
-            for k, v in params.items():
-                if not v:
-                    continue
-                # v はリスト
-                for item in v:
-                    if isinstance(item, str) and (item.startswith("0.") and len(item) > 20):
-                        candidate = item
-                        break
-                if candidate:
-                    break
-        if candidate:
-            # デバッグ出力（ログに出るのでトラブルシュート時に使える）
-            print(f"DEBUG: resolved turnstile token candidate from query params (key may vary)")
-            # 追加デバッグ: ファイルにも追記して外部から確認しやすくする
-            try:
-                # Streamlit may execute the script from a temp path; write debug log to workspace path
-                debug_log = Path("/workspaces/CoCock_app") / "turnstile_debug.log"
-                with debug_log.open("a", encoding="utf-8") as df:
-                    df.write(f"{datetime.utcnow().isoformat()} DEBUG resolved_candidate len={len(candidate)} source=query\n")
-            except Exception:
-                # ログ失敗は無視して続行
-                pass
-            # 直接フォーム入力欄を書き換えて即時レンダリング競合を起こすと
-            # Streamlit フロントエンドで removeChild の NotFoundError が発生することがあるため
-            # 安全のため「候補」として保存し、ユーザーが明示的に適用するか確認するUIを出す。
-            st.session_state["turnstile_token_candidate"] = candidate
+            candidate = next(
+                (v for k in params for v in params.get_all(k) if _looks_like_turnstile_token(v)), None
+            )
+            _store_turnstile_candidate(candidate, "query_scan", started)
+        state["last_rerun_ms"] = round((time.perf_counter() - rerun_started) * 1000, 3)
     except Exception:
         # 古い Streamlit や想定外のエラーが発生しても壊さない
         pass
 
+
+def _poll_turnstile_resolution() -> None:
+    """バックグラウンドの解決が終わったらアプリ全体を rerun して候補を反映する。"""
+    future = st.session_state.get("turnstile_resolution_future")
+    if future is not None and future.done():
+        st.rerun()
+
+
+if hasattr(st, "fragment"):
+    # 古い Streamlit では次の操作（rerun）のときに反映される
+    _poll_turnstile_resolution = st.fragment(run_every=0.5)(_poll_turnstile_resolution)
+
+
+def main() -> None:
+    st.set_page_config(page_title="Recipe Log", page_icon="🍳", layout="wide")
+    apply_migrations()
+    ensure_storage_dirs()
+    cleanup_staged_uploads()
+
+    if "last_saved_id" not in st.session_state:
+        st.session_state["last_saved_id"] = None
+    if "tag_filter" not in st.session_state:
+        st.session_state["tag_filter"] = []
+
+    # Turnstile token をクエリパラメータから受け取れるようにしておく（turnstile_test.html から自動遷移）
+    resolve_turnstile_from_query()
+    if st.session_state.get("turnstile_resolution_future") is not None:
+        _poll_turnstile_resolution()
+
     st.title("🍳 レシピログ v0.2")
     st.caption("写真・メモ・タグを 1 分で記録して、すぐに検索できる実験用アプリ")
 
@@ -371,6 +590,8 @@ def main() -> None:
         except Exception:
             st.write("query_params: <unavailable>")
         st.write("session turnstile_token:", st.session_state.get("turnstile_token"))
+        st.write("turnstile resolution:", st.session_state.get("turnstile_resolution"))
+        st.write("query cache:", read_cache.stats())
 
     # サイドバー：匿名投稿の紐付け（Claim）と簡易プロフィール閲覧
     st.sidebar.header("匿名投稿の紐付け / プロフィール")
@@ -387,27 +608,31 @@ def main() -> None:
                 except ValueError:
                     st.error("投稿ID は整数で入力してください。")
                 else:
-                    conn = get_connection()
-                    try:
+                    def _claim(conn: sqlite3.Connection) -> bool:
                         cur = conn.cursor()
                         cur.execute("SELECT id FROM dishes WHERE id = ? AND edit_token = ?", (cid, claim_token))
-                        row = cur.fetchone()
-                        if not row:
-                            st.error("投稿が見つからないか、編集トークンが一致しません。")
+                        if not cur.fetchone():
+                            return False
+                        # ensure user exists
+                        cur.execute("SELECT id FROM users WHERE username = ?", (claim_username,))
+                        u = cur.fetchone()
+                        if u:
+                            user_id = u[0]
                         else:
-                            # ensure user exists
-                            cur.execute("SELECT id FROM users WHERE username = ?", (claim_username,))
-                            u = cur.fetchone()
-                            if u:
-                                user_id = u[0]
-                            else:
-                                cur.execute("INSERT INTO users (username) VALUES (?)", (claim_username,))
-                                user_id = cur.lastrowid
-                            cur.execute("UPDATE dishes SET owner_id = ?, edit_token = NULL, edit_token_created_at = NULL WHERE id = ?", (user_id, cid))
-                            conn.commit()
-                            st.success("投稿をアカウントに紐付けました。プロフィールで確認できます。")
-                    finally:
-                        conn.close()
+                            cur.execute("INSERT INTO users (username) VALUES (?)", (claim_username,))
+                            user_id = cur.lastrowid
+                        cur.execute("UPDATE dishes SET owner_id = ?, edit_token = NULL, edit_token_created_at = NULL WHERE id = ?", (user_id, cid))
+                        return True
+
+                    decision = get_rate_limiter().hit(
+                        "claim", client_keys(display_name=claim_username, ip=client_ip())
+                    )
+                    if not decision.allowed:
+                        st.error(rate_limited_message(decision))
+                    elif run_write(_claim):
+                        st.success("投稿をアカウントに紐付けました。プロフィールで確認できます。")
+                    else:
+                        st.error("投稿が見つからないか、編集トークンが一致しません。")
 
     with st.sidebar.expander("プロフィールを見る（ユーザー名で検索）"):
         prof_name = st.text_input("ユーザー名を入力", key="profile_username")
@@ -415,27 +640,17 @@ def main() -> None:
             if not prof_name:
                 st.error("ユーザー名を入力してください。")
             else:
-                conn = get_connection()
-                try:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id FROM users WHERE username = ?", (prof_name,))
-                    row = cur.fetchone()
-                    if not row:
-                        st.info("該当ユーザーが見つかりません。")
-                    else:
-                        uid = row[0]
-                        cur.execute("SELECT COUNT(*) FROM dishes WHERE owner_id = ?", (uid,))
-                        cnt = cur.fetchone()[0]
-                        st.write(f"投稿数: {cnt}")
-                        if cnt >= 10:
-                            st.success("Badge: Contributor（投稿10件以上）")
-                        # list recipes
-                        cur.execute("SELECT id, name, created_at FROM dishes WHERE owner_id = ? ORDER BY created_at DESC LIMIT 100", (uid,))
-                        rows = cur.fetchall()
-                        for r in rows:
-                            st.markdown(f"- [{r[1]}] (ID: {r[0]}) — {r[2]}")
-                finally:
-                    conn.close()
+                profile = fetch_profile(prof_name)
+                if profile is None:
+                    st.info("該当ユーザーが見つかりません。")
+                else:
+                    cnt, rows = profile
+                    st.write(f"投稿数: {cnt}")
+                    if cnt >= 10:
+                        st.success("Badge: Contributor（投稿10件以上）")
+                    # list recipes
+                    for r in rows:
+                        st.markdown(f"- [{r[1]}] (ID: {r[0]}) — {r[2]}")
 
     # Turnstile セッション検証（PoC）: ログイン / Claim 時に検証してセッションにフラグを立てる
     # 将来的に FastAPI に切り出すことを想定して、ここでは同期的に siteverify へ問い合わせる。
@@ -486,23 +701,42 @@ def main() -> None:
         reg_user = st.text_input("新規ユーザー名", key="reg_user")
         reg_pass = st.text_input("新規パスワード", type="password", key="reg_pass")
         if st.button("登録する", key="do_register"):
+            register_keys = client_keys(display_name=reg_user, ip=client_ip())
             if not reg_user or not reg_pass:
+                # 入力漏れで弾く操作では枠を使わない。枠を消費するのは実際に登録を試みるときだけ
                 st.error("ユーザー名とパスワードを入力してください。")
+            elif (
+                not (register_decision := get_rate_limiter().check("register", register_keys)).allowed
+                or not (register_decision := get_rate_limiter().hit("register", register_keys)).allowed
+            ):
+                st.error(rate_limited_message(register_decision))
             else:
-                conn = get_connection()
-                try:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id FROM users WHERE username = ?", (reg_user,))
-                    if cur.fetchone():
-                        st.error("そのユーザー名は既に使われています。別の名前を選んでください。")
-                    else:
-                        # Hash password using CryptContext (argon2 preferred).
-                        ph = pwd_ctx.hash(reg_pass)
-                        cur.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (reg_user, ph))
-                        conn.commit()
+                with read_connection() as conn:
+                    taken = conn.execute("SELECT 1 FROM users WHERE username = ?", (reg_user,)).fetchone()
+                if taken:
+                    st.error("そのユーザー名は既に使われています。別の名前を選んでください。")
+                else:
+                    # Hash password (argon2 preferred).
+                    # 書き込みスレッドを塞がないよう、ハッシュ計算は投入前に済ませる
+                    try:
+                        ph = pwd_hasher.hash(reg_pass)
+                    except HashingBusyError:
+                        # 混雑中、またはワーカーが落ちて作り直しても計算できなかった
+                        ph = None
+
+                    def _register(conn: sqlite3.Connection) -> bool:
+                        # 確認後に同名で登録された場合に備えて書き込み側でも確かめる
+                        if conn.execute("SELECT 1 FROM users WHERE username = ?", (reg_user,)).fetchone():
+                            return False
+                        conn.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (reg_user, ph))
+                        return True
+
+                    if ph is None:
+                        st.error(HASHING_BUSY_MESSAGE)
+                    elif run_write(_register):
                         st.success("登録しました。ログインしてください。")
-                finally:
-                    conn.close()
+                    else:
+                        st.error("そのユーザー名は既に使われています。別の名前を選んでください。")
 
         st.write("---")
         # Login
@@ -510,51 +744,58 @@ def main() -> None:
         login_user = st.text_input("ユーザー名", key="login_user")
         login_pass = st.text_input("パスワード", type="password", key="login_pass")
         if st.button("ログイン", key="do_login"):
+            login_keys = client_keys(display_name=login_user, ip=client_ip())
             if not login_user or not login_pass:
                 st.error("ユーザー名とパスワードを入力してください。")
+            elif (
+                not (login_decision := get_rate_limiter().check("login", login_keys)).allowed
+                # 連続失敗中のキーはパスワード検証（argon2）の前に断る
+                or not (login_decision := login_throttle.check(login_keys)).allowed
+                # 入力漏れ・連続失敗で断る操作では枠を使わず、検証を試みるときだけ消費する
+                or not (login_decision := get_rate_limiter().hit("login", login_keys)).allowed
+            ):
+                st.error(rate_limited_message(login_decision))
             else:
-                conn = get_connection()
-                try:
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, password_hash FROM users WHERE username = ?", (login_user,))
-                    row = cur.fetchone()
-                    if not row:
-                        st.error("ユーザーが存在しません。")
+                with read_connection() as conn:
+                    row = conn.execute(
+                        "SELECT id, password_hash FROM users WHERE username = ?", (login_user,)
+                    ).fetchone()
+                if not row:
+                    login_throttle.record_failure(login_keys)
+                    st.error("ユーザーが存在しません。")
+                else:
+                    uid = row[0]
+                    ph = row[1]
+                    if not ph:
+                        st.error("このアカウントはパスワードが設定されていません。")
                     else:
-                        uid = row[0]
-                        ph = row[1]
-                        if not ph:
-                            st.error("このアカウントはパスワードが設定されていません。")
+                        verified = False
+                        busy = False
+                        try:
+                            verified = pwd_hasher.verify(login_pass, ph)
+                        except HashingBusyError:
+                            # 混雑・ワーカー停止（HashingUnavailableError）はパスワードの不一致ではないので、
+                            # 失敗として数えない
+                            busy = True
+                        except Exception:
+                            log_event(logger, logging.ERROR, "password_verify_failed", exc_info=True)
+                            busy = True
+
+                        if busy:
+                            st.error(HASHING_BUSY_MESSAGE)
+                        elif verified:
+                            # If stored hash does not match current policy, re-hash.
+                            # 作り直しはバックグラウンドのキューに任せ、ログインの応答を待たせない
+                            if pwd_hasher.needs_update(ph):
+                                get_rehash_queue().enqueue(uid, login_pass, ph)
+
+                            login_throttle.record_success(client_keys(display_name=login_user))
+                            st.session_state["user_id"] = uid
+                            st.session_state["username"] = login_user
+                            st.success("ログインしました。投稿フォームに戻って投稿できます。")
                         else:
-                            verified = False
-                            try:
-                                verified = pwd_ctx.verify(login_pass, ph)
-                            except Exception:
-                                verified = False
-
-                            if verified:
-                                # If stored hash does not match current policy, re-hash
-                                try:
-                                    if pwd_ctx.needs_update(ph):
-                                        new_hash = pwd_ctx.hash(login_pass)
-                                        cur.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, uid))
-                                        conn.commit()
-                                except Exception:
-                                    # Do not block login if re-hash / DB update fails; log to debug file
-                                    try:
-                                        debug_log = Path("/workspaces/CoCock_app") / "turnstile_debug.log"
-                                        with debug_log.open("a", encoding="utf-8") as df:
-                                            df.write(f"{datetime.utcnow().isoformat()} WARN rehash_failed uid={uid}\n")
-                                    except Exception:
-                                        pass
-
-                                st.session_state["user_id"] = uid
-                                st.session_state["username"] = login_user
-                                st.success("ログインしました。投稿フォームに戻って投稿できます。")
-                            else:
-                                st.error("パスワードが違います。")
-                finally:
-                    conn.close()
+                            login_throttle.record_failure(login_keys)
+                            st.error("パスワードが違います。")
 
         if st.session_state.get("user_id"):
             if st.button("ログアウト", key="do_logout"):
@@ -572,7 +813,11 @@ def main() -> None:
             if not user_id:
                 st.info("投稿するにはログインが必要です。サイドバーの登録/ログインからアカウントでログインしてください。")
             photo_file = st.file_uploader(
-                "料理の写真", type=["png", "jpg", "jpeg"], accept_multiple_files=False
+                "料理の写真",
+                type=["png", "jpg", "jpeg"],
+                accept_multiple_files=False,
+                help=f"{get_photo_ingester().settings.max_bytes // (1024 * 1024)} MB まで。"
+                "保存時に縮小・再圧縮し、撮影位置などの EXIF 情報は取り除きます。",
             )
             name = st.text_input("料理名", placeholder="鶏むね肉の照り焼き")
             recipe_url = st.text_input("参考レシピ URL", placeholder="https://example.com")
@@ -670,25 +915,18 @@ def main() -> None:
                 if honeypot_website and honeypot_website.strip():
                     # ログに残す（マイグレーションがない場合は無視される）
                     try:
-                        conn_log = get_connection()
-                        try:
-                            conn_log.execute(
+                        run_write(
+                            lambda conn_log: conn_log.execute(
                                 "INSERT INTO submission_attempts (author_display_name) VALUES (?)",
                                 (f"HONEYPOT:{honeypot_website}",),
                             )
-                            conn_log.commit()
-                        finally:
-                            conn_log.close()
+                        )
                     except Exception:
                         # ログ保存に失敗しても処理は続けずブロックのみ行う
                         pass
                     st.error("不正な入力が検出されました（スパム対策）。投稿は受け付けられません。")
                     submitted = False
                     # フォーム内の処理を中断
-                # セッションごとの簡易レート制限
-                if submitted and st.session_state.get("submissions_in_session", 0) >= 5:
-                    st.error("このブラウザからの投稿が多すぎます。後でもう一度お試しください。")
-                    submitted = False
                 cleaned_name = name.strip()
                 cleaned_url = recipe_url.strip() or None
                 cleaned_memo = memo_user.strip()
@@ -708,60 +946,53 @@ def main() -> None:
                             # owner is the logged-in user
                             owner_id: int | None = st.session_state.get("user_id")
 
-                            # DB ベースの頻度チェック（ユーザー単位）: 過去24時間に多すぎる投稿があればブロック
-                            try:
-                                if owner_id is not None:
-                                    conn_chk = get_connection()
-                                    try:
-                                        cur_chk = conn_chk.cursor()
-                                        cur_chk.execute(
-                                            "SELECT COUNT(*) FROM dishes WHERE owner_id = ? AND created_at >= datetime('now', '-24 hours')",
-                                            (owner_id,),
-                                        )
-                                        cnt_recent = cur_chk.fetchone()[0]
-                                        if cnt_recent >= 20:
-                                            st.error("このアカウントからの投稿が多すぎます（24時間以内に20件を超えています）。しばらくお待ちください。")
-                                            # ブロックするために submitted を False にする
-                                            submitted = False
-                                    finally:
-                                        conn_chk.close()
-                            except Exception:
-                                # DB が整っていない（マイグレーション未適用等）の可能性。無視して続行する。
-                                pass
+                            # 頻度チェック（ユーザー・表示名・IP 単位）。上限は RATE_LIMIT_POST で変更できる。
+                            # ここでは確認だけにして、枠は保存できたときに消費する
+                            post_keys = client_keys(user_id=owner_id, display_name=username, ip=client_ip())
+                            post_decision = get_rate_limiter().check("post", post_keys)
+                            if not post_decision.allowed:
+                                st.error(rate_limited_message(post_decision))
+                                # ブロックするために submitted を False にする
+                                submitted = False
 
+                            dish_id = None
                             if submitted:
                                 # 実際に保存する
-                                dish_id = insert_dish(
-                                    cleaned_name,
-                                    cleaned_url,
-                                    cleaned_memo,
-                                    tags_raw,
-                                    favorite_flag,
-                                    photo_file,
-                                    is_public=is_public_flag,
-                                    owner_id=owner_id,
-                                )
+                                try:
+                                    dish_id = insert_dish(
+                                        cleaned_name,
+                                        cleaned_url,
+                                        cleaned_memo,
+                                        tags_raw,
+                                        favorite_flag,
+                                        photo_file,
+                                        is_public=is_public_flag,
+                                        owner_id=owner_id,
+                                    )
+                                except (UploadTooLargeError, InvalidPhotoError, PhotoProcessingUnavailableError) as exc:
+                                    # 写真が上限を超えている・画像として読めない・処理するプロセスが使えない。
+                                    # 料理は保存していない
+                                    st.error(f"写真を保存できませんでした: {exc}")
+
+                            if dish_id is not None:
+                                get_rate_limiter().hit("post", post_keys)
 
                                 # 投稿成功ログを残す（submission_attempts） — マイグレーションがない場合は黙って無視
                                 try:
-                                    conn_log2 = get_connection()
-                                    try:
-                                        conn_log2.execute(
+                                    run_write(
+                                        lambda conn_log2: conn_log2.execute(
                                             "INSERT INTO submission_attempts (author_display_name) VALUES (?)",
                                             (username or None,),
                                         )
-                                        conn_log2.commit()
-                                    finally:
-                                        conn_log2.close()
+                                    )
                                 except Exception:
                                     pass
 
                                 # セッション側の状態更新と成功メッセージはここで確実に行う
                                 st.session_state["last_saved_id"] = dish_id
-                                st.session_state["submissions_in_session"] = st.session_state.get("submissions_in_session", 0) + 1
                                 st.success("料理を登録しました。")
                             else:
-                                # ここでは submitted == False のケース（頻度チェック等で弾かれた）を扱う
+                                # 保存しなかったケース（頻度チェック等で弾かれた・写真を受け付けなかった）を扱う
                                 if owner_id is None:
                                     st.error("投稿するにはログインが必要です（owner_id が見つかりません）。")
                                 # それ以外の理由で submitted=False の場合は既に適切なエラーメッセージが表示されているはず
@@ -781,22 +1012,27 @@ def main() -> None:
             )
 
     with tabs[1]:
-        all_tags = fetch_all_tags()
+        tag_counts = dict(fetch_tag_counts())
         st.subheader("料理一覧")
 
         search_col, favorite_col = st.columns([3, 1])
         with search_col:
             st.text_input(
-                "キーワード検索（料理名 / URL / メモ）",
+                "キーワード検索（料理名 / メモ / タグ / URL）",
                 key="search_keyword",
                 placeholder="鶏 / パスタ / https://example.com",
             )
         with favorite_col:
             favorite_only = st.toggle("お気に入りのみ", key="favorite_only_filter")
 
+        # タグボタン経由で追加された表記違いのタグも選択肢から外れないようにする
+        tag_options = sorted(
+            set(tag_counts) | set(st.session_state.get("tag_filter", [])), key=str.lower
+        )
         st.multiselect(
             "タグフィルタ",
-            options=all_tags,
+            options=tag_options,
+            format_func=lambda t: f"{t} ({tag_counts[t]})" if t in tag_counts else t,
             key="tag_filter",
             help="タグボタンをクリックしても追加できます。",
         )
@@ -811,27 +1047,25 @@ def main() -> None:
         selected_tags = st.session_state.get("tag_filter", [])
         favorite_only = st.session_state.get("favorite_only_filter", False)
 
-        dishes = fetch_dishes(keyword=keyword, tags=selected_tags, favorite_only=favorite_only)
-
-        st.caption(f"{len(dishes)} 件ヒット（最大 50 件表示）")
-        if not dishes:
-            st.info("まだ料理が登録されていないか、条件に一致する料理がありません。")
-        else:
-            for row in dishes:
-                render_dish_card(row)
+        render_paged_dishes(
+            "list_pages",
+            LIST_PAGE_SIZE,
+            "まだ料理が登録されていないか、条件に一致する料理がありません。",
+            keyword=keyword,
+            tags=list(selected_tags),
+            favorite_only=favorite_only,
+        )
 
     with tabs[2]:
         st.subheader("公開ギャラリー")
         st.caption("公開フラグが立っているレシピのみ表示します。")
 
-        # simple gallery: show up to 200 public items
-        public_items = fetch_dishes(public_only=True, limit=200)
-        st.caption(f"{len(public_items)} 件公開中（最大200件表示）")
-        if not public_items:
-            st.info("公開されているレシピはありません。登録フォームから公開してみましょう。")
-        else:
-            for row in public_items:
-                render_dish_card(row)
+        render_paged_dishes(
+            "gallery_pages",
+            GALLERY_PAGE_SIZE,
+            "公開されているレシピはありません。登録フォームから公開してみましょう。",
+            public_only=True,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,359 @@
+"""Cloudflare Turnstile の siteverify クライアント。
+
+- `requests.Session` を使い回して siteverify への接続を keep-alive で再利用する
+- 失敗した結果だけをトークンの SHA-256 をキーに `TURNSTILE_CACHE_TTL_SECONDS` 秒だけ覚えておく
+  （同じ無効なトークンで siteverify を何度も呼ばない）。成功は覚えない: トークンは 1 回限りなので、
+  成功を共有すると別のセッションが同じトークンを使い回せてしまう。成功後の rerun は
+  セッション側の `turnstile_verified_at` で判定する
+- 同じトークンの検証が重なった場合、siteverify へ問い合わせるのは 1 回だけで、
+  後から来た呼び出しはその完了を待ってから失敗を返す（成功は最初の呼び出しだけのもの）
+
+接続エラーやタイムアウトは「失敗」として返すが、キャッシュには入れない（次の呼び出しで再試行する）。
+問い合わせ先は `TURNSTILE_SITEVERIFY_URL` で変更でき、scripts/fake_siteverify.py の
+ローカルサーバーに向ければオフラインで負荷試験できる。
+
+後半はトークンの受け渡し（handoff）。Turnstile ウィジェットのページからアプリへ遷移するとき、
+長いトークンの代わりに `turnstile_token_id` クエリで短い値を渡す。値は次のどちらか:
+- 署名付き封筒 `v1.<期限>.<トークン>.<署名>`: HMAC-SHA256 で署名され期限を持つ。アプリは
+  `TURNSTILE_HANDOFF_KEY` でその場で検証するので、ネットワーク呼び出しが要らない
+- token_store の id: 従来どおり scripts/token_store.py に `/retrieve` で問い合わせる（フォールバック）
+"""
+
+from __future__ import annotations
+
+import base64
+import binascii
+import hashlib
+import heapq
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app_logging import get_logger, log_event
+from db import _env_float, _env_int
+
+logger = get_logger("turnstile")
+
+SITEVERIFY_URL = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
+
+
+def test_mode_enabled() -> bool:
+    """CI / E2E 用: `TURNSTILE_TEST_MODE` が有効なら外部 API を呼ばずに成功扱いにする。"""
+    test_mode = os.environ.get("TURNSTILE_TEST_MODE")
+    return bool(test_mode and test_mode.lower() in ("1", "true", "yes"))
+
+
+class TurnstileClient:
+    """スレッドセーフな siteverify クライアント（接続プール + 失敗のキャッシュ + 同一トークンの合流）。
+
+    `secret` を省略すると呼び出しのたびに `TURNSTILE_SECRET` を読む。
+    """
+
+    def __init__(
+        self,
+        secret: Optional[str] = None,
+        url: str = SITEVERIFY_URL,
+        cache_ttl: float = 300.0,
+        cache_maxsize: int = 1024,
+        pool_maxsize: int = 10,
+    ) -> None:
+        self.secret = secret
+        self.url = url
+        self.cache_ttl = cache_ttl
+        self.cache_maxsize = max(1, cache_maxsize)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_maxsize))
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # 失敗したトークンのハッシュ -> 期限
+        self._failures: "OrderedDict[str, float]" = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.requests = 0
+        self.joined = 0
+        self.errors = 0
+
+    @staticmethod
+    def _key(token: str) -> str:
+        # トークンそのものはメモリに残さない
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def verify(self, token: str, timeout: float = 5.0, remoteip: Optional[str] = None) -> bool:
+        if test_mode_enabled():
+            return True
+        secret = self.secret if self.secret is not None else os.environ.get("TURNSTILE_SECRET")
+        if not secret or not token:
+            # No secret configured: do not attempt real verification here.
+            return False
+
+        key = self._key(token)
+        with self._lock:
+            now = time.monotonic()
+            expires_at = self._failures.get(key)
+            if expires_at is not None:
+                if expires_at > now:
+                    self._failures.move_to_end(key)
+                    self.hits += 1
+                    return False
+                del self._failures[key]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.joined += 1
+
+        if not owner:
+            # 先の呼び出しが成功していればトークンはもう使用済み、失敗ならこちらも失敗
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+            return False
+
+        ok: Optional[bool] = None
+        try:
+            ok = self._siteverify(secret, token, timeout, remoteip)
+            return bool(ok)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if ok is False:
+                    self._failures[key] = time.monotonic() + self.cache_ttl
+                    self._failures.move_to_end(key)
+                    while len(self._failures) > self.cache_maxsize:
+                        self._failures.popitem(last=False)
+            future.set_result(bool(ok))
+
+    def _siteverify(self, secret: str, token: str, timeout: float, remoteip: Optional[str]) -> Optional[bool]:
+        """siteverify の結果。接続エラーなどで判定できなかった場合は None。"""
+        data = {"secret": secret, "response": token}
+        if remoteip:
+            data["remoteip"] = remoteip
+        with self._lock:
+            self.requests += 1
+        try:
+            resp = self._session.post(self.url, data=data, timeout=timeout)
+            resp.raise_for_status()
+            return bool(resp.json().get("success"))
+        except (requests.RequestException, ValueError) as exc:
+            with self._lock:
+                self.errors += 1
+            log_event(logger, logging.WARNING, "siteverify_failed", error=type(exc).__name__)
+            return None
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "cached_failures": len(self._failures),
+                "inflight": len(self._inflight),
+                "hits": self.hits,
+                "requests": self.requests,
+                "joined": self.joined,
+                "errors": self.errors,
+            }
+
+    def close(self) -> None:
+        self._session.close()
+
+
+_client: Optional[TurnstileClient] = None
+_client_lock = threading.Lock()
+
+
+def get_turnstile_client() -> TurnstileClient:
+    """プロセス共通の `TurnstileClient` を返す（初回呼び出しで生成）。
+
+    `TURNSTILE_SECRET` / `TURNSTILE_SITEVERIFY_URL` / `TURNSTILE_CACHE_TTL_SECONDS` /
+    `TURNSTILE_POOL_SIZE` を読む。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = TurnstileClient(
+                    url=os.environ.get("TURNSTILE_SITEVERIFY_URL", SITEVERIFY_URL),
+                    cache_ttl=_env_float("TURNSTILE_CACHE_TTL_SECONDS", 300.0),
+                    pool_maxsize=_env_int("TURNSTILE_POOL_SIZE", 10),
+                )
+    return _client
+
+
+HANDOFF_VERSION = "v1"
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _handoff_signature(key: bytes, signed_part: str) -> str:
+    return _b64encode(hmac.new(key, signed_part.encode("ascii"), hashlib.sha256).digest())
+
+
+def sign_handoff(token: str, key: bytes, ttl: float = 120.0, now: Optional[float] = None) -> str:
+    """トークンを `ttl` 秒だけ有効な署名付き封筒にする（URL のクエリにそのまま載せられる）。"""
+    expires_at = int((time.time() if now is None else now) + ttl)
+    signed_part = f"{HANDOFF_VERSION}.{expires_at:x}.{_b64encode(token.encode('utf-8'))}"
+    return f"{signed_part}.{_handoff_signature(key, signed_part)}"
+
+
+def open_handoff(value: str, key: bytes, now: Optional[float] = None) -> Optional[str]:
+    """署名と期限を確かめてトークンを取り出す。改ざん・期限切れ・形式違いなら None。"""
+    try:
+        version, expires_hex, payload, signature = value.split(".")
+        if version != HANDOFF_VERSION:
+            return None
+        expected = _handoff_signature(key, f"{version}.{expires_hex}.{payload}")
+        if not hmac.compare_digest(expected, signature):
+            return None
+        if int(expires_hex, 16) < (time.time() if now is None else now):
+            return None
+        return _b64decode(payload).decode("utf-8")
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def is_signed_handoff(value: str) -> bool:
+    return value.startswith(HANDOFF_VERSION + ".")
+
+
+class SignedHandoff:
+    """署名付き封筒をローカルで検証するバックエンド。
+
+    同じ封筒は期限まで 1 回しか受け付けない（token_store の /retrieve と同じく使い捨て）。
+    使用済みの署名は期限が切れるまで覚えておき、期限切れのものだけを捨てる。期限が
+    `max_ttl` 秒より先の封筒は受け付けないので、覚える数は `max_ttl × max_rate` で足りる。
+    それでも期限内の署名で埋まっている間は、新しい封筒を拒否する（古い署名を忘れて
+    使い回しを許すよりは、ログインをやり直してもらう）。
+    """
+
+    def __init__(
+        self, key: bytes, max_ttl: float = 300.0, max_rate: float = 20.0, clock=time.time
+    ) -> None:
+        self.key = key
+        self.max_ttl = max_ttl
+        self.max_used = max(1, int(max_ttl * max_rate))
+        self._clock = clock
+        # 署名 -> 期限。期限順の取り出しは _expiries（(期限, 署名) のヒープ）で行う
+        self._used: dict[str, float] = {}
+        self._expiries: list[tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    def resolve(self, value: str) -> Optional[str]:
+        now = self._clock()
+        token = open_handoff(value, self.key, now)
+        if token is None:
+            return None
+        signature = value.rsplit(".", 1)[1]
+        expires_at = float(int(value.split(".")[1], 16))
+        if expires_at > now + self.max_ttl:
+            log_event(logger, logging.WARNING, "handoff_ttl_too_long", ttl=round(expires_at - now))
+            return None
+        with self._lock:
+            while self._expiries and self._expiries[0][0] < now:
+                _, expired = heapq.heappop(self._expiries)
+                del self._used[expired]
+            if signature in self._used:
+                return None
+            if len(self._used) >= self.max_used:
+                log_event(logger, logging.WARNING, "handoff_seen_full", size=len(self._used))
+                return None
+            self._used[signature] = expires_at
+            heapq.heappush(self._expiries, (expires_at, signature))
+        return token
+
+
+class TokenStoreHandoff:
+    """scripts/token_store.py に id を問い合わせるバックエンド（別プロセスが必要）。"""
+
+    def __init__(self, base_url: str = "http://127.0.0.1:8765", timeout: float = 1.0) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def resolve(self, value: str) -> Optional[str]:
+        try:
+            resp = self._session.get(f"{self.base_url}/retrieve", params={"id": value}, timeout=self.timeout)
+            if resp.status_code != 200:
+                log_event(logger, logging.DEBUG, "token_store_miss", status=resp.status_code)
+                return None
+            return resp.json().get("token") or None
+        except (requests.RequestException, ValueError) as exc:
+            log_event(logger, logging.WARNING, "token_store_failed", error=type(exc).__name__)
+            return None
+
+
+class HandoffResolver:
+    """`turnstile_token_id` の値をトークンに戻す。
+
+    署名付き封筒なら `signed` でローカルに検証し、それ以外の値は `fallback`（token_store）に渡す。
+    どちらも未設定なら None を返す。
+    """
+
+    def __init__(self, signed: Optional[SignedHandoff] = None, fallback: Optional[TokenStoreHandoff] = None) -> None:
+        self.signed = signed
+        self.fallback = fallback
+
+    def resolve(self, value: str) -> tuple[Optional[str], str]:
+        """(トークン, 使ったバックエンド名) を返す。"""
+        if is_signed_handoff(value):
+            if self.signed is None:
+                return None, "signed"
+            return self.signed.resolve(value), "signed"
+        if self.fallback is None:
+            return None, "none"
+        return self.fallback.resolve(value), "token_store"
+
+    def needs_network(self, value: str) -> bool:
+        """解決に token_store への問い合わせが必要か（署名付き封筒はローカルで済む）。"""
+        return not is_signed_handoff(value) and self.fallback is not None
+
+    def resolve_async(self, value: str) -> "Future[tuple[Optional[str], str]]":
+        """`resolve()` を共有のスレッドで実行する。Streamlit のスクリプトスレッドを待たせない用。"""
+        return _handoff_executor.submit(self.resolve, value)
+
+
+# token_store への問い合わせ用（1 秒のタイムアウトで返るので少数で足りる）
+_handoff_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="turnstile-handoff")
+
+
+_resolver: Optional[HandoffResolver] = None
+
+
+def get_handoff_resolver() -> HandoffResolver:
+    """プロセス共通の `HandoffResolver` を返す。
+
+    `TURNSTILE_HANDOFF_KEY` があれば署名付き封筒を受け付ける。token_store へのフォールバックは
+    `TURNSTILE_HANDOFF_FALLBACK=0` で無効にでき、問い合わせ先は `TOKEN_STORE_URL` で変えられる。
+    封筒の期限の上限は `TURNSTILE_HANDOFF_MAX_TTL_SECONDS`（token_store の `--ttl` 以上にする）、
+    使用済みの署名を覚える数はそれと `TURNSTILE_HANDOFF_MAX_RATE`（1 秒あたりの封筒数）で決まる。
+    """
+    global _resolver
+    if _resolver is None:
+        with _client_lock:
+            if _resolver is None:
+                key = os.environ.get("TURNSTILE_HANDOFF_KEY")
+                max_ttl = _env_float("TURNSTILE_HANDOFF_MAX_TTL_SECONDS", 300.0)
+                max_rate = _env_float("TURNSTILE_HANDOFF_MAX_RATE", 20.0)
+                fallback = os.environ.get("TURNSTILE_HANDOFF_FALLBACK", "1").lower() not in ("0", "false", "no")
+                _resolver = HandoffResolver(
+                    signed=SignedHandoff(key.encode("utf-8"), max_ttl, max_rate) if key else None,
+                    fallback=TokenStoreHandoff(os.environ.get("TOKEN_STORE_URL", "http://127.0.0.1:8765"))
+                    if fallback
+                    else None,
+                )
+    return _resolver